@@ -103,6 +103,33 @@ DATABASES = {
     },
 }
 
+# Cache
+# Local memory by default, any Django cache backend (e.g. Redis or Memcached) can be plugged in via the env
+CACHES = {
+    'default': {
+        'BACKEND': env('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': env('CACHE_LOCATION', default='wedding-website-backend'),
+    },
+}
+# Whether the cache is shared by every process - the local memory cache isn't, so data changed by management commands
+# (e.g. run_upload_worker or import_guests) is only invalidated in their own process, and is cached for less time
+CACHE_IS_SHARED = env.bool(
+    'CACHE_IS_SHARED',
+    default=CACHES['default']['BACKEND'] not in (
+        'django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache'
+    ),
+)
+INVITATION_CACHE_TIMEOUT = env.int('INVITATION_CACHE_TIMEOUT', default=300)
+INVITATION_NOT_FOUND_CACHE_TIMEOUT = env.int('INVITATION_NOT_FOUND_CACHE_TIMEOUT', default=30)
+# The RSVP stats are invalidated as guests change - if the cache isn't shared, changes made by the import_guests command
+# aren't invalidated in the web processes, so the stats are only cached briefly
+GUEST_STATS_CACHE_TIMEOUT = env.int('GUEST_STATS_CACHE_TIMEOUT', default=3600 if CACHE_IS_SHARED else 60)
+# The gallery manifest is kept up to date as pictures are added and deleted, so it can be cached for a long time - if
+# the cache isn't shared, it's also checked against the gallery's version before it's served (see get_gallery_manifest)
+GALLERY_MANIFEST_CACHE_TIMEOUT = env.int(
+    'GALLERY_MANIFEST_CACHE_TIMEOUT', default=86400 if CACHE_IS_SHARED else 3600
+)
+
 # REST framework setup
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
@@ -165,6 +192,44 @@ MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 DEFAULT_FILE_STORAGE = 'custom_storages.MediaStorage'
 
+# File Upload Settings
+# Multipart uploads larger than this are streamed to a temp file rather than held in memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = env.int('FILE_UPLOAD_MAX_MEMORY_SIZE', default=1048576)  # 1MB
+FILE_UPLOAD_TEMP_DIR = env('FILE_UPLOAD_TEMP_DIR', default=None)
+# The default upload handlers, which also hash each file (sha256) as it's received
+FILE_UPLOAD_HANDLERS = [
+    'utils.helpers.HashingMemoryFileUploadHandler',
+    'utils.helpers.HashingTemporaryFileUploadHandler',
+]
+# Upload limits - the max number of pictures per request, and the max size (bytes) of each picture and of all the
+# pictures in a request, as uploaded (base 64 strings are measured before they're decoded)
+PICTURE_UPLOAD_MAX_FILES = env.int('PICTURE_UPLOAD_MAX_FILES', default=20)
+PICTURE_UPLOAD_MAX_FILE_SIZE = env.int('PICTURE_UPLOAD_MAX_FILE_SIZE', default=20971520)  # 20MB
+PICTURE_UPLOAD_MAX_TOTAL_SIZE = env.int('PICTURE_UPLOAD_MAX_TOTAL_SIZE', default=52428800)  # 50MB
+# JSON uploads are read into memory in full, so are capped at the max total size in base 64 (4/3), plus 1MB
+DATA_UPLOAD_MAX_MEMORY_SIZE = PICTURE_UPLOAD_MAX_TOTAL_SIZE * 4 // 3 + 1048576
+# Upload rate limit for each gallery code - a token bucket of pictures, refilled at the rate (pictures per minute)
+PICTURE_UPLOAD_RATE_LIMIT = env.int('PICTURE_UPLOAD_RATE_LIMIT', default=120)
+PICTURE_UPLOAD_RATE_LIMIT_BURST = env.int('PICTURE_UPLOAD_RATE_LIMIT_BURST', default=60)
+# Number of pictures written to storage concurrently per upload request
+PICTURE_UPLOAD_WORKERS = env.int('PICTURE_UPLOAD_WORKERS', default=4)
+# Asynchronous uploads - pictures processing for longer than the timeout (seconds) are reclaimed by another worker
+UPLOAD_JOB_TIMEOUT = env.int('UPLOAD_JOB_TIMEOUT', default=600)
+UPLOAD_JOB_MAX_ATTEMPTS = env.int('UPLOAD_JOB_MAX_ATTEMPTS', default=3)
+# Uploaded pictures are re-encoded at this quality (1-100), with their longest edge capped at the max dimension (px)
+PICTURE_MAX_DIMENSION = env.int('PICTURE_MAX_DIMENSION', default=2560)
+PICTURE_QUALITY = env.int('PICTURE_QUALITY', default=85)
+# Encoding quality (1-100) of the thumbnail/medium/large renditions generated for each picture
+PICTURE_RENDITION_QUALITY = env.int('PICTURE_RENDITION_QUALITY', default=80)
+
+# Presigned uploads - pictures uploaded straight to the bucket, which must be confirmed within the expiry (seconds)
+PRESIGNED_UPLOAD_EXPIRY = env.int('PRESIGNED_UPLOAD_EXPIRY', default=3600)
+PRESIGNED_UPLOAD_MAX_SIZE = env.int('PRESIGNED_UPLOAD_MAX_SIZE', default=20971520)  # 20MB
+
+# Orphaned media files are only deleted by the reconcile_media command once they're older than this (seconds), so
+# files of uploads that haven't been saved (or confirmed, see PRESIGNED_UPLOAD_EXPIRY) yet are kept
+MEDIA_RECONCILE_MIN_AGE = env.int('MEDIA_RECONCILE_MIN_AGE', default=86400)
+
 # S3 BUCKET SETTINGS
 AWS_S3_OBJECT_PARAMETERS = {
     'Expires': 'Thu, 31 Dec 2099 20:00:00 GMT',
@@ -175,13 +240,34 @@ AWS_S3_REGION_NAME = env('AWS_S3_REGION_NAME', default='')
 AWS_ACCESS_KEY_ID = env('AWS_ACCESS_KEY_ID', default='')
 AWS_SECRET_ACCESS_KEY = env('AWS_SECRET_ACCESS_KEY', default='')
 AWS_S3_CUSTOM_DOMAIN = f'{AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com'
+# Allows using an S3-compatible stand-in (e.g. MinIO) locally
+AWS_S3_ENDPOINT_URL = env('AWS_S3_ENDPOINT_URL', default=None)
 AWS_DEFAULT_ACL = None
+# S3 connections are shared by all threads (see custom_storages), so the pool should allow a connection for each
+# concurrent upload worker across the process's requests
+AWS_S3_MAX_POOL_CONNECTIONS = env.int('AWS_S3_MAX_POOL_CONNECTIONS', default=50)
+AWS_S3_MAX_ATTEMPTS = env.int('AWS_S3_MAX_ATTEMPTS', default=5)
+AWS_S3_RETRY_MODE = env('AWS_S3_RETRY_MODE', default='standard')
+# Files larger than the threshold are uploaded in parts of the chunk size, up to the max concurrency parts at a time
+AWS_S3_MULTIPART_THRESHOLD = env.int('AWS_S3_MULTIPART_THRESHOLD', default=16777216)  # 16MB
+AWS_S3_MULTIPART_CHUNKSIZE = env.int('AWS_S3_MULTIPART_CHUNKSIZE', default=8388608)  # 8MB
+AWS_S3_MAX_CONCURRENCY = env.int('AWS_S3_MAX_CONCURRENCY', default=4)
+# Media storage - 's3', 'local' (MEDIA_ROOT, e.g. for development) or 'memory' (the default for tests)
+STORAGE_BACKEND = env('STORAGE_BACKEND', default='memory' if env.bool('TESTING', default=False) else 's3')
+MEDIA_STORAGE_BACKENDS = {
+    's3': 'custom_storages.MediaStorage',
+    'local': 'custom_storages.LocalMediaStorage',
+    'memory': 'custom_storages.InMemoryMediaStorage',
+}
 STORAGES = {
     'default': {
-        'BACKEND': 'custom_storages.MediaStorage'
+        'BACKEND': MEDIA_STORAGE_BACKENDS[STORAGE_BACKEND]
     },
     'staticfiles': {
-        'BACKEND': 'custom_storages.StaticStorage'
+        'BACKEND': (
+            'custom_storages.StaticStorage' if STORAGE_BACKEND == 's3'
+            else 'django.contrib.staticfiles.storage.StaticFilesStorage'
+        )
     },
     'OPTIONS': {
         'access_key': AWS_ACCESS_KEY_ID,
@@ -223,6 +309,14 @@ FRONTEND_DASHBOARD = env('FRONTEND_DASHBOARD', default='')
 # GALLERY CODE
 GALLERY_CODE = env('GALLERY_CODE', default='')
 
+# GALLERY PAGINATION
+GALLERY_PAGE_SIZE = env.int('GALLERY_PAGE_SIZE', default=50)
+GALLERY_MAX_PAGE_SIZE = env.int('GALLERY_MAX_PAGE_SIZE', default=200)
+
+# GALLERY ARCHIVE - pictures are read from storage in chunks (bytes), with the next few pictures opened in parallel
+PICTURE_ARCHIVE_CHUNK_SIZE = env.int('PICTURE_ARCHIVE_CHUNK_SIZE', default=1048576)  # 1MB
+PICTURE_ARCHIVE_PREFETCH = env.int('PICTURE_ARCHIVE_PREFETCH', default=4)
+
 # Testing
 TESTING = env.bool('TESTING', default=False)
 
@@ -1,7 +1,9 @@
+from django.db.models import prefetch_related_objects
+
 from rest_framework import serializers
 
 from guests.models import Guest, Invitation
-from memories.models import Picture
+from memories.models import Picture, UploadJob, UploadJobPicture
 
 
 class GuestSerializer(serializers.ModelSerializer):
@@ -17,15 +19,20 @@ class InvitationSerializer(serializers.ModelSerializer):
     invitation_type = serializers.SerializerMethodField()
 
     @staticmethod
-    def get_invitation_type(obj):
-        """ Method to redefine the invitation_type field """
-        guests = obj.guests.all()
+    def get_invitation_guests(obj):
+        """ Return the invitation's guests, prefetching them once if they haven't already been prefetched """
+        if 'guests' not in getattr(obj, '_prefetched_objects_cache', {}):
+            prefetch_related_objects([obj], 'guests')
+        return obj.guests.all()
+
+    def get_invitation_type(self, obj):
+        """ Method to redefine the invitation_type field - computed from the prefetched guests """
+        guests = self.get_invitation_guests(obj)
         return 'party_only' if all(guest.party_only for guest in guests) else 'wedding'
 
-    @staticmethod
-    def get_guests(obj):
+    def get_guests(self, obj):
         """ Method to redefine the guests field """
-        return GuestSerializer(obj.guests.all(), many=True).data
+        return GuestSerializer(self.get_invitation_guests(obj), many=True).data
 
     class Meta:
         model = Invitation
@@ -35,12 +42,54 @@ class InvitationSerializer(serializers.ModelSerializer):
 class PictureSerializer(serializers.ModelSerializer):
     """ A serializer for returning picture data """
     url = serializers.SerializerMethodField()
+    thumbnail = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
 
     @staticmethod
     def get_url(obj):
         """ Method to redefine the url field """
-        return obj.file.url
+        return obj.get_url()
+
+    @staticmethod
+    def get_thumbnail(obj):
+        """ Method to get the thumbnail rendition's URL, or the original's URL if there are no renditions """
+        return obj.get_rendition_url(rendition='thumbnail')
+
+    @staticmethod
+    def get_srcset(obj):
+        """ Method to get a srcset string of the renditions for each format, e.g. {'webp': 'url 200w, url 800w'} """
+        return obj.get_srcset()
 
     class Meta:
         model = Picture
-        fields = ('picture_uuid', 'url')
+        fields = ('picture_uuid', 'url', 'thumbnail', 'srcset')
+
+
+class UploadJobPictureSerializer(serializers.ModelSerializer):
+    """ A serializer for returning the progress of a picture in an upload job """
+    picture = PictureSerializer(read_only=True)
+
+    class Meta:
+        model = UploadJobPicture
+        fields = ('name', 'status', 'error', 'picture')
+
+
+class UploadJobSerializer(serializers.ModelSerializer):
+    """ A serializer for returning the progress of an upload job, and each of its pictures """
+    progress = serializers.SerializerMethodField()
+    pictures = serializers.SerializerMethodField()
+
+    @staticmethod
+    def get_progress(obj):
+        """ Method to get the job's status and the number of pictures with each status """
+        return obj.get_progress()
+
+    @staticmethod
+    def get_pictures(obj):
+        """ Method to get the job's pictures, without loading the staged data """
+        job_pictures = obj.pictures.select_related('picture').defer('data').order_by('id')
+        return UploadJobPictureSerializer(job_pictures, many=True).data
+
+    class Meta:
+        model = UploadJob
+        fields = ('job_uuid', 'progress', 'pictures')
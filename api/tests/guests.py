@@ -1,6 +1,12 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import TestCase, Client
 from django.urls import reverse
 
+from rest_framework_simplejwt.tokens import RefreshToken
+
 from api.serializers import GuestSerializer, InvitationSerializer
 from data.seed_tests import seed_invitations
 
@@ -95,6 +101,17 @@ class InvitationSerializerTest(TestCase):
                 else:
                     self.assertEqual(guest.get(field, ''), getattr(self.guests[index], field))
 
+    def test_guests_queried_once(self):
+        """ Confirm the 'guests' and 'invitation_type' fields share a single guests query """
+        with self.assertNumQueries(1):
+            InvitationSerializer(self.invitation).data
+
+    def test_prefetched_guests_not_queried(self):
+        """ Confirm we don't query the guests again if they have already been prefetched """
+        invitation = self.invitation.get_invitation(code=self.invitation.code)
+        with self.assertNumQueries(0):
+            InvitationSerializer(invitation).data
+
 
 #                                              -- VIEW TESTS --
 class InvitationTest(TestCase):
@@ -133,6 +150,10 @@ class InvitationTest(TestCase):
         cls.failure_kwargs = {'code': 'invalid_code'}
         cls.success_kwargs = {'code': cls.invitation_1.code}
 
+    def setUp(self):
+        """ Clear the invitation cache between tests """
+        cache.clear()
+
     #                                                                                                      Generic tests
     def test_success(self):
         """ Confirm we return a 200 status code on success """
@@ -151,6 +172,84 @@ class InvitationTest(TestCase):
         response_json = response.json()
         self.assertEqual('', response_json.get('Sorry, we can\'t find an invitation with that code', ''))
 
+    def test_get_invitation_query_count(self):
+        """ Confirm we get the invitation and its guests in a fixed number of queries (invitation + guests) """
+        with self.assertNumQueries(2):
+            client.get(
+                reverse('api:invitation', kwargs=self.success_kwargs),
+                content_type='application/json',
+            )
+
+    def test_get_invitation_cached_returns_zero_queries(self):
+        """ Confirm a repeated GET is served from the cache without querying the DB """
+        url = reverse('api:invitation', kwargs=self.success_kwargs)
+        first_response = client.get(url, content_type='application/json')
+        with self.assertNumQueries(0):
+            response = client.get(url, content_type='application/json')
+        self.assertEqual(response.json(), first_response.json())
+
+    def test_get_invitation_not_found_cached_returns_zero_queries(self):
+        """ Confirm a repeated GET for a code that doesn't exist is served from the cache without querying the DB """
+        url = reverse('api:invitation', kwargs={'code': 'notacode'})
+        client.get(url, content_type='application/json')
+        with self.assertNumQueries(0):
+            response = client.get(url, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('error_message', ''), 'Sorry, we can\'t find an invitation with that code')
+
+    def test_respond_to_invitation_invalidates_cached_invitation(self):
+        """ Confirm we return the updated invitation on GET after responding to it """
+        url = reverse('api:invitation', kwargs=self.success_kwargs)
+        client.get(url, content_type='application/json')
+        client.post(url, content_type='application/json', data=self.data)
+        response = client.get(url, content_type='application/json')
+        invitation = response.json().get('invitation', {})
+        self.assertTrue(invitation.get('responded'))
+        self.assertEqual(invitation.get('guests', [])[0].get('name', ''), 'Darth Vader')
+
+    def test_get_invitation_returns_conditional_headers(self):
+        """ Confirm we return the ETag, Last-Modified and Cache-Control headers """
+        response = client.get(reverse('api:invitation', kwargs=self.success_kwargs), content_type='application/json')
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_get_invitation_etag_match_returns_not_modified(self):
+        """ Confirm we return 304 Not Modified, without a body, if the client's ETag is current """
+        url = reverse('api:invitation', kwargs=self.success_kwargs)
+        etag = client.get(url, content_type='application/json')['ETag']
+        response = client.get(url, content_type='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+
+    def test_get_invitation_last_modified_match_returns_not_modified(self):
+        """ Confirm we return 304 Not Modified if the client's copy is as new as the last modified date """
+        url = reverse('api:invitation', kwargs=self.success_kwargs)
+        last_modified = client.get(url, content_type='application/json')['Last-Modified']
+        response = client.get(url, content_type='application/json', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_get_invitation_etag_changes_after_response(self):
+        """ Confirm we return the full invitation with a new ETag after the invitation is responded to """
+        url = reverse('api:invitation', kwargs=self.success_kwargs)
+        etag = client.get(url, content_type='application/json')['ETag']
+        client.post(url, content_type='application/json', data=self.data)
+        response = client.get(url, content_type='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_respond_to_invitation_query_count(self):
+        """ Confirm we respond to and return the invitation in a fixed number of queries """
+        # Invitation + guests, then savepoint, invitation lock, guests bulk update, invitation update, release savepoint
+        with self.assertNumQueries(7):
+            client.post(
+                reverse('api:invitation', kwargs=self.success_kwargs),
+                content_type='application/json',
+                data=self.data,
+            )
+
     #                                                                                                     Get invitation
     def test_get_invitation_success_returns_invitation_data(self):
         """ Confirm we return the invitation data, including guests, on success """
@@ -253,6 +352,17 @@ class InvitationTest(TestCase):
             for field in fields:
                 self.assertEqual(getattr(guest, field), guest_data.get(field, ''))
 
+    def test_respond_to_invitation_code_in_any_case(self):
+        """ Confirm guests can respond with their code in any case, as they can view the invitation """
+        response = client.post(
+            reverse('api:invitation', kwargs={'code': self.invitation_1.code.upper()}),
+            content_type='application/json',
+            data=self.data,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.invitation_1.refresh_from_db()
+        self.assertTrue(self.invitation_1.responded)
+
     def test_respond_to_invitation_success_updates_invitation(self):
         """ Confirm we update the invitation on success """
         client.post(
@@ -264,3 +374,86 @@ class InvitationTest(TestCase):
         self.invitation_1.refresh_from_db()
         self.assertTrue(self.invitation_1.responded)
         self.assertEqual(self.invitation_1.additional_info, invitation_data.get('additional_info', ''))
+
+
+class ExportGuestsTest(TestCase):
+    """ Test suite for export_guests view """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        seed_invitations(invitation_count=2)
+        User = get_user_model()
+        admin = User.objects.create(email='admin@admin.co.uk', username='admin@admin.co.uk')
+        user = User.objects.create(email='user@user.co.uk', username='user@user.co.uk', role='user')
+        cls.admin_headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(admin).access_token}'}
+        cls.user_headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+    def test_unauthenticated_returns_error(self):
+        """ Confirm we return a 401 status code if the user isn't authenticated """
+        response = client.get(reverse('api:export_guests'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_user_returns_error(self):
+        """ Confirm we return a 401 status code if the user isn't an admin """
+        response = client.get(reverse('api:export_guests'), **self.user_headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_invalid_file_type_returns_error(self):
+        """ Confirm we return an error if the file type isn't csv or json """
+        response = client.get(reverse('api:export_guests'), {'file_type': 'xml'}, **self.admin_headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('error_message', ''), 'Sorry, the file type must be csv or json')
+
+    def test_export_csv_streams_guest_list(self):
+        """ Confirm we stream the guest list as CSV by default """
+        response = client.get(reverse('api:export_guests'), **self.admin_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        lines = b''.join(response.streaming_content).decode().strip().splitlines()
+        self.assertEqual(lines[0], 'invitation,code,name,party_only,wedding,party,attending_status')
+        self.assertEqual(len(lines), 5)
+
+    def test_export_json_streams_guest_list(self):
+        """ Confirm we stream the guest list as JSON """
+        response = client.get(reverse('api:export_guests'), {'file_type': 'json'}, **self.admin_headers)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        guests = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(len(guests), 4)
+        self.assertEqual(guests[0].get('attending_status', ''), 'Pending')
+
+
+class GuestStatsTest(TestCase):
+    """ Test suite for guest_stats view """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        seed_invitations(invitation_count=2)
+        User = get_user_model()
+        admin = User.objects.create(email='admin@admin.co.uk', username='admin@admin.co.uk')
+        user = User.objects.create(email='user@user.co.uk', username='user@user.co.uk', role='user')
+        cls.admin_headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(admin).access_token}'}
+        cls.user_headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+    def setUp(self):
+        """ Clear the cached stats between tests """
+        cache.clear()
+
+    def test_user_returns_error(self):
+        """ Confirm we return a 401 status code if the user isn't an admin """
+        response = client.get(reverse('api:guest_stats'), **self.user_headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_success_returns_stats(self):
+        """ Confirm we return the RSVP stats on success """
+        response = client.get(reverse('api:guest_stats'), **self.admin_headers)
+        response_json = response.json()
+        self.assertEqual(response.status_code, 200)
+        stats = response_json.get('stats', {})
+        self.assertEqual(stats.get('guests'), 4)
+        self.assertEqual(stats.get('attending_status', {}).get('Pending'), 4)
+        self.assertEqual(stats.get('invitations_pending'), 2)
+        self.assertEqual(stats.get('response_rate'), 0)
+        self.assertIn('hits', response_json.get('invitation_cache', {}))
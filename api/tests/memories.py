@@ -1,9 +1,25 @@
-from django.test import TestCase, Client
+import base64
+import hashlib
+import zipfile
+from io import BytesIO
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import TestCase, Client, override_settings
 from django.urls import reverse
 from django.conf import settings
+from django.core import signing
+
+from rest_framework_simplejwt.tokens import RefreshToken
 
-from memories.models import Picture
+from memories.models import Picture, UploadJob, UploadJobPicture
 from api.serializers import PictureSerializer
+from data.constants import PRESIGNED_UPLOAD_SALT
+from data.seed_tests import seed_pictures, generate_base_64_images
 from utils.helpers import delete_test_files
 
 client = Client()
@@ -44,6 +60,18 @@ class PictureSerializerTest(TestCase):
         serializer = PictureSerializer(self.picture).data
         self.assertEqual(serializer.get('url', ''), self.picture.file.url)
 
+    def test_thumbnail(self):
+        """ Confirm we return the thumbnail rendition's URL in the 'thumbnail' field """
+        serializer = PictureSerializer(self.picture).data
+        self.assertEqual(serializer.get('thumbnail', ''), self.picture.get_rendition_url(rendition='thumbnail'))
+        self.assertTrue(serializer.get('thumbnail', '').endswith('-thumbnail.jpg'))
+
+    def test_srcset(self):
+        """ Confirm we return a srcset string of the renditions for each format in the 'srcset' field """
+        serializer = PictureSerializer(self.picture).data
+        self.assertEqual(serializer.get('srcset', {}), self.picture.get_srcset())
+        self.assertEqual(set(serializer.get('srcset', {})), {'webp', 'jpeg'})
+
     def test_url_is_s3_url(self):
         """ Confirm the 'url' field is an S3 URL """
         serializer = PictureSerializer(self.picture).data
@@ -62,9 +90,9 @@ class PicturesTest(TestCase):
         """ Initialise test data """
         cls.temp_picture = Picture()
         pictures = []
-        for i in range(5):
+        for i, image in enumerate(generate_base_64_images(image_count=5)):
             picture = {
-                'fileSrc': settings.TEST_BASE_64_IMAGE,
+                'fileSrc': image,
                 'name': f'picture-{i}.gif',
             }
             pictures.append(picture)
@@ -72,6 +100,10 @@ class PicturesTest(TestCase):
         cls.invalid_kwargs = {'code': 'invalid_code'}
         cls.data = {'pictures': pictures}
 
+    def setUp(self):
+        """ Clear the cached gallery manifest between tests """
+        cache.clear()
+
     @classmethod
     def tearDownClass(cls):
         """ Custom teardown to delete temp files created in tests """
@@ -132,6 +164,93 @@ class PicturesTest(TestCase):
                     url = f'https://{settings.AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com/memories/test/{picture_name}'
                     self.assertIn(url, picture.get('url', ''))
 
+    def test_get_pictures_returns_conditional_headers(self):
+        """ Confirm we return the ETag, Last-Modified and Cache-Control headers """
+        Picture.objects.create(file='memories/test/picture.gif')
+        response = client.get(reverse('api:pictures', kwargs=self.valid_kwargs), content_type='application/json')
+        self.assertTrue(response.has_header('ETag'))
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertIn('no-cache', response['Cache-Control'])
+
+    def test_get_pictures_etag_match_returns_not_modified(self):
+        """ Confirm we return 304 Not Modified, without a body, if the client's ETag is current """
+        Picture.objects.create(file='memories/test/picture.gif')
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        etag = client.get(url, content_type='application/json')['ETag']
+        with self.assertNumQueries(1):
+            response = client.get(url, content_type='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_get_pictures_etag_changes_after_upload(self):
+        """ Confirm we return the full gallery with a new ETag after a picture is added """
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        etag = client.get(url, content_type='application/json')['ETag']
+        Picture.objects.create(file='memories/test/picture.gif')
+        response = client.get(url, content_type='application/json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_get_pictures_paginated(self):
+        """ Confirm we return a page of pictures with cursors, and follow the next cursor to the next page """
+        seed_pictures(picture_count=5)
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        response_json = client.get(url, {'page_size': 3}).json()
+        self.assertEqual(len(response_json.get('pictures', [])), 3)
+        self.assertIsNone(response_json.get('previous'))
+        response_json = client.get(url, {'page_size': 3, 'cursor': response_json.get('next')}).json()
+        self.assertEqual(len(response_json.get('pictures', [])), 2)
+        self.assertIsNone(response_json.get('next'))
+        self.assertIsNotNone(response_json.get('previous'))
+
+    def test_get_pictures_all_returns_all_pictures(self):
+        """ Confirm we return all pictures, without cursors, with the 'all' query param """
+        seed_pictures(picture_count=5)
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        response_json = client.get(url, {'all': 'true', 'page_size': 2}).json()
+        self.assertEqual(len(response_json.get('pictures', [])), 5)
+        self.assertNotIn('next', response_json)
+
+    @override_settings(CACHE_IS_SHARED=True)
+    def test_get_pictures_all_served_from_manifest(self):
+        """ Confirm we return the same data from the cached gallery manifest, without querying the DB once cached """
+        seed_pictures(picture_count=3)
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        client.get(url, {'all': 'true'})
+        with self.assertNumQueries(0):
+            response = client.get(url, {'all': 'true'})
+        self.assertEqual(response.json(), {
+            'success': True, 'pictures': PictureSerializer(self.temp_picture.get_pictures(), many=True).data
+        })
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_get_pictures_all_etag_match_returns_not_modified(self):
+        """ Confirm we return 304 Not Modified if the client's ETag matches the gallery manifest """
+        seed_pictures(picture_count=2)
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        etag = client.get(url, {'all': 'true'})['ETag']
+        response = client.get(url, {'all': 'true'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_get_pictures_all_includes_uploaded_and_excludes_deleted_pictures(self):
+        """ Confirm the gallery manifest is updated when pictures are uploaded or deleted """
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        etag = client.get(url, {'all': 'true'})['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(url, content_type='application/json', data=self.data)
+        response = client.get(url, {'all': 'true'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json().get('pictures', [])), 5)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.temp_picture.get_pictures().first().delete()
+        self.assertEqual(len(client.get(url, {'all': 'true'}).json().get('pictures', [])), 4)
+
+    def test_get_pictures_invalid_cursor_returns_error(self):
+        """ Confirm we return an error if the cursor is invalid """
+        response = client.get(reverse('api:pictures', kwargs=self.valid_kwargs), {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('error_message', ''), 'Sorry, that page isn\'t valid')
+
     #                                                                                                    Upload pictures
     def test_upload_pictures_empty_pictures_list_returns_error(self):
         """ Confirm we return an empty list and error message when passed an empty list """
@@ -177,3 +296,349 @@ class PicturesTest(TestCase):
             picture_name = self.data.get('pictures', [])[index].get('name', '').split('.')[0]
             url = f'https://{settings.AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com/memories/test/{picture_name}'
             self.assertIn(url, picture.get('url', ''))
+
+    def test_upload_pictures_multipart_creates_and_returns_correct_data(self):
+        """ Confirm we create and return the uploaded pictures for a multipart/form-data upload """
+        images = [base64.b64decode(image.split(';base64,')[-1]) for image in generate_base_64_images(image_count=3)]
+        picture_files = [
+            SimpleUploadedFile(f'picture-{i}.gif', image, content_type='image/gif') for i, image in enumerate(images)
+        ]
+        response = client.post(reverse('api:pictures', kwargs=self.valid_kwargs), data={'pictures': picture_files})
+        pictures = response.json().get('pictures', [])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(pictures), 3)
+        for index, picture in enumerate(pictures):
+            url = f'https://{settings.AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com/memories/test/picture-{index}-'
+            self.assertIn(url, picture.get('url', ''))
+
+    def test_upload_pictures_multipart_non_image_returns_error(self):
+        """ Confirm we don't store multipart files that aren't images """
+        picture_file = SimpleUploadedFile('evil.html', b'<script>alert(1)</script>', content_type='text/html')
+        response = client.post(reverse('api:pictures', kwargs=self.valid_kwargs), data={'pictures': [picture_file]})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Picture.objects.exists())
+
+    def test_upload_pictures_multipart_hashed_as_received(self):
+        """ Confirm multipart uploads, in memory or in temp files, are hashed as they're received, not read again """
+        images = [base64.b64decode(image.split(';base64,')[-1]) for image in generate_base_64_images(image_count=2)]
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        with patch('memories.models.hash_file') as hash_file:
+            for image, max_memory_size in zip(images, (1048576, 10)):
+                with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=max_memory_size):
+                    picture_file = SimpleUploadedFile('picture.gif', image, content_type='image/gif')
+                    client.post(url, data={'pictures': [picture_file]})
+        hash_file.assert_not_called()
+        self.assertEqual(
+            set(Picture.objects.values_list('sha256', flat=True)),
+            {hashlib.sha256(image).hexdigest() for image in images},
+        )
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=10)
+    def test_upload_pictures_multipart_streams_to_temp_files(self):
+        """ Confirm multipart uploads larger than FILE_UPLOAD_MAX_MEMORY_SIZE are streamed to temp files """
+        image = base64.b64decode(settings.TEST_BASE_64_IMAGE.split(';base64,')[-1])
+        with patch('memories.models.Picture.upload_pictures', wraps=Picture.upload_pictures) as upload_pictures:
+            client.post(
+                reverse('api:pictures', kwargs=self.valid_kwargs),
+                data={'pictures': [SimpleUploadedFile('picture.gif', image, content_type='image/gif')]},
+            )
+        picture_files = upload_pictures.call_args.kwargs.get('picture_files', [])
+        self.assertIsInstance(picture_files[0], TemporaryUploadedFile)
+
+    def test_upload_pictures_returns_result_for_each_picture(self):
+        """ Confirm we return the success or error for each picture, and upload the valid pictures """
+        self.data['pictures'].append({'fileSrc': 'invalid', 'name': 'invalid.gif'})
+        response = client.post(
+            reverse('api:pictures', kwargs=self.valid_kwargs),
+            content_type='application/json',
+            data=self.data,
+        )
+        response_json = response.json()
+        results = response_json.get('results', [])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len(response_json.get('pictures', [])), 5)
+        self.assertTrue(all(result.get('success') for result in results[:5]))
+        self.assertEqual(results[-1], {
+            'name': 'invalid.gif',
+            'success': False,
+            'picture_uuid': None,
+            'error': 'We were unable to read this picture',
+            'error_code': 'unreadable',
+        })
+
+    @override_settings(PICTURE_UPLOAD_MAX_FILES=4)
+    def test_upload_pictures_too_many_pictures_returns_error(self):
+        """ Confirm we return an error, and don't create any pictures, if more than the max files are uploaded """
+        response = client.post(
+            reverse('api:pictures', kwargs=self.valid_kwargs),
+            content_type='application/json',
+            data=self.data,
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('error_message', ''), 'Please upload up to 4 pictures at a time')
+        self.assertFalse(Picture.objects.exists())
+
+    @override_settings(PICTURE_UPLOAD_RATE_LIMIT=60, PICTURE_UPLOAD_RATE_LIMIT_BURST=8)
+    def test_upload_pictures_rate_limited_returns_too_many_requests(self):
+        """ Confirm we return a 429 error, with a Retry-After header, once the gallery code's rate limit is exceeded """
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        response = client.post(url, content_type='application/json', data=self.data)
+        self.assertEqual(response.status_code, 200)
+
+        response = client.post(url, content_type='application/json', data=self.data)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(
+            response.json().get('error_message', ''), 'You\'re uploading too quickly, please try again in a moment'
+        )
+        # Up to 2 more tokens are needed (less any refilled during the first upload), at 1 token per second
+        self.assertIn(response['Retry-After'], ('1', '2'))
+        self.assertEqual(Picture.objects.count(), len(self.data['pictures']))
+
+    @override_settings(PICTURE_UPLOAD_RATE_LIMIT=60, PICTURE_UPLOAD_RATE_LIMIT_BURST=2)
+    def test_upload_pictures_over_rate_limit_burst_returns_error(self):
+        """ Confirm we return a 400 error, rather than a 429, for uploads that could never fit in the rate limit """
+        response = client.post(
+            reverse('api:pictures', kwargs=self.valid_kwargs), content_type='application/json', data=self.data
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('error_message', ''), 'Please upload up to 2 pictures at a time')
+        self.assertNotIn('Retry-After', response)
+        self.assertFalse(Picture.objects.exists())
+
+    @override_settings(PICTURE_UPLOAD_MAX_FILES=4, PICTURE_UPLOAD_RATE_LIMIT=60, PICTURE_UPLOAD_RATE_LIMIT_BURST=5)
+    def test_upload_pictures_over_limits_doesnt_use_rate_limit(self):
+        """ Confirm requests rejected for the upload limits don't take tokens from the gallery code's rate limit """
+        url = reverse('api:pictures', kwargs=self.valid_kwargs)
+        response = client.post(url, content_type='application/json', data=self.data)
+        self.assertEqual(response.status_code, 400)
+        response = client.post(url, content_type='application/json', data={'pictures': self.data['pictures'][:4]})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(PICTURE_UPLOAD_MAX_FILE_SIZE=10)
+    def test_upload_pictures_all_failed_returns_result_for_each_picture(self):
+        """ Confirm we return the error code for each picture along with the error, if every picture fails """
+        response = client.post(
+            reverse('api:pictures', kwargs=self.valid_kwargs),
+            content_type='application/json',
+            data={'pictures': [*self.data['pictures'][:1], {'fileSrc': 'invalid', 'name': 'invalid.gif'}]},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [result.get('error_code') for result in response.json().get('results', [])], ['too_large', 'unreadable']
+        )
+
+    def test_upload_pictures_async_stages_pictures_and_returns_job(self):
+        """ Confirm we stage the pictures for background processing and return the job's uuid """
+        response = client.post(
+            f'{reverse("api:pictures", kwargs=self.valid_kwargs)}?async=true',
+            content_type='application/json',
+            data=self.data,
+        )
+        response_json = response.json()
+        self.assertEqual(response.status_code, 202)
+        upload_job = UploadJob.objects.get()
+        self.assertEqual(response_json.get('job_uuid'), str(upload_job.job_uuid))
+        self.assertEqual(upload_job.pictures.count(), 5)
+        self.assertFalse(Picture.objects.exists())
+
+
+class PictureUploadsTest(TestCase):
+    """ Test suite for picture_uploads and confirm_picture_uploads views """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        cls.valid_kwargs = {'code': settings.GALLERY_CODE}
+        cls.invalid_kwargs = {'code': 'invalid_code'}
+        cls.data = {'pictures': [{'name': 'picture.jpg', 'contentType': 'image/jpeg'}]}
+
+    def setUp(self):
+        """ Get the file field's storage - not in setUpTestData, which would give each test a copy - and clear the
+        upload rate limits between tests """
+        self.storage = Picture._meta.get_field('file').storage
+        cache.clear()
+
+    def test_invalid_code_returns_error(self):
+        """ Confirm we return an error if the code is invalid """
+        for url in ('api:picture_uploads', 'api:confirm_picture_uploads'):
+            response = client.post(reverse(url, kwargs=self.invalid_kwargs), content_type='application/json', data={})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json().get('error_message', ''), 'Sorry, that code isn\'t valid')
+
+    @override_settings(PICTURE_UPLOAD_MAX_FILES=2, PICTURE_UPLOAD_RATE_LIMIT_BURST=2)
+    def test_picture_uploads_over_max_files_returns_error(self):
+        """ Confirm we return an error, without taking rate limit tokens, if more than the max files are requested """
+        url = reverse('api:picture_uploads', kwargs=self.valid_kwargs)
+        response = client.post(url, content_type='application/json', data={'pictures': self.data['pictures'] * 3})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('error_message', ''), 'Please upload up to 2 pictures at a time')
+        with patch.object(self.storage, 'generate_presigned_upload', create=True, return_value={}):
+            response = client.post(url, content_type='application/json', data={'pictures': self.data['pictures'] * 2})
+        self.assertEqual(response.status_code, 200)
+
+    def test_picture_uploads_returns_presigned_uploads(self):
+        """ Confirm we return a presigned upload for each picture, using the requested method """
+        presigned_upload = {'method': 'PUT', 'url': 'https://upload', 'fields': {}, 'headers': {}}
+        with patch.object(
+            self.storage, 'generate_presigned_upload', create=True, return_value=presigned_upload
+        ) as generate_presigned_upload:
+            response = client.post(
+                reverse('api:picture_uploads', kwargs=self.valid_kwargs),
+                content_type='application/json',
+                data={**self.data, 'method': 'put'},
+            )
+        uploads = response.json().get('uploads', [])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(uploads[0].get('url'), 'https://upload')
+        self.assertTrue(uploads[0].get('token'))
+        self.assertEqual(generate_presigned_upload.call_args.kwargs.get('method'), 'put')
+
+    def test_picture_uploads_empty_pictures_list_returns_error(self):
+        """ Confirm we return an error if there are no pictures """
+        with patch.object(self.storage, 'generate_presigned_upload', create=True):
+            response = client.post(
+                reverse('api:picture_uploads', kwargs=self.valid_kwargs),
+                content_type='application/json',
+                data={'pictures': []},
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('error_message', ''), 'Please upload at least one picture')
+
+    def test_confirm_picture_uploads_creates_and_returns_pictures(self):
+        """ Confirm we create and return the pictures for the uploaded files """
+        presigned_upload = {'method': 'POST', 'url': 'https://upload', 'fields': {}, 'headers': {}}
+        with patch.object(self.storage, 'generate_presigned_upload', create=True, return_value=presigned_upload):
+            uploads = client.post(
+                reverse('api:picture_uploads', kwargs=self.valid_kwargs),
+                content_type='application/json',
+                data=self.data,
+            ).json().get('uploads', [])
+        metadata = {'size': 100, 'content_type': 'image/jpeg'}
+        with patch.object(self.storage, 'get_object_metadata', create=True, return_value=metadata):
+            response = client.post(
+                reverse('api:confirm_picture_uploads', kwargs=self.valid_kwargs),
+                content_type='application/json',
+                data={'tokens': [upload.get('token') for upload in uploads]},
+            )
+        response_json = response.json()
+        picture = Picture.objects.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_json.get('results', [])[0].get('picture_uuid'), str(picture.picture_uuid))
+        self.assertEqual(response_json.get('pictures', []), PictureSerializer([picture], many=True).data)
+
+    def test_confirm_picture_uploads_not_uploaded_returns_error(self):
+        """ Confirm we return an error if none of the files have been uploaded """
+        with patch.object(self.storage, 'get_object_metadata', create=True, return_value=None):
+            response = client.post(
+                reverse('api:confirm_picture_uploads', kwargs=self.valid_kwargs),
+                content_type='application/json',
+                data={'tokens': [signing.dumps('memories/test/missing.jpg', salt=PRESIGNED_UPLOAD_SALT)]},
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Picture.objects.exists())
+
+
+class UploadJobTest(TestCase):
+    """ Test suite for upload_job view """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        images = generate_base_64_images(image_count=2)
+        pictures = [{'fileSrc': image, 'name': f'picture-{i}.gif'} for i, image in enumerate(images)]
+        cls.upload_job, error = UploadJob.create_upload_job(picture_files=pictures)
+        cls.valid_kwargs = {'code': settings.GALLERY_CODE, 'job_uuid': cls.upload_job.job_uuid}
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Custom teardown to delete temp files created in tests """
+        # For deleting S3 bucket files
+        delete_test_files()
+
+        super().tearDownClass()
+
+    def test_invalid_code_returns_error(self):
+        """ Confirm we return an error if the code is invalid """
+        response = client.get(reverse('api:upload_job', kwargs={**self.valid_kwargs, 'code': 'invalid_code'}))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('error_message', ''), 'Sorry, that code isn\'t valid')
+
+    def test_invalid_job_uuid_returns_error(self):
+        """ Confirm we return an error if the job doesn't exist """
+        for job_uuid in ('invalid', '00000000-0000-0000-0000-000000000000'):
+            response = client.get(reverse('api:upload_job', kwargs={**self.valid_kwargs, 'job_uuid': job_uuid}))
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json().get('error_message', ''), 'Sorry, we couldn\'t find that upload')
+
+    def test_pending_job_returns_progress(self):
+        """ Confirm we return the job's progress and each picture's status before it's processed """
+        response = client.get(reverse('api:upload_job', kwargs=self.valid_kwargs))
+        job = response.json().get('job', {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(job.get('progress', {}).get('status'), 'pending')
+        self.assertEqual(
+            job.get('pictures'), [
+                {'name': f'picture-{i}.gif', 'status': 'pending', 'error': '', 'picture': None} for i in range(2)
+            ]
+        )
+
+    def test_complete_job_returns_pictures(self):
+        """ Confirm we return the uploaded picture for each processed picture """
+        UploadJobPicture.process_pictures(job_pictures=UploadJobPicture.claim_pictures(batch_size=10))
+        response = client.get(reverse('api:upload_job', kwargs=self.valid_kwargs))
+        job = response.json().get('job', {})
+        self.assertEqual(job.get('progress', {}).get('status'), 'complete')
+        for job_picture in job.get('pictures', []):
+            self.assertEqual(job_picture.get('status'), 'complete')
+            self.assertTrue(Picture.objects.filter(picture_uuid=job_picture.get('picture', {}).get('picture_uuid')))
+
+
+class ExportPicturesTest(TestCase):
+    """ Test suite for export_pictures view """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        cls.name = default_storage.save('memories/test/export.gif', ContentFile(b'picture'))
+        Picture.objects.create(file=cls.name)
+        User = get_user_model()
+        admin = User.objects.create(email='admin@admin.co.uk', username='admin@admin.co.uk')
+        user = User.objects.create(email='user@user.co.uk', username='user@user.co.uk', role='user')
+        cls.admin_headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(admin).access_token}'}
+        cls.user_headers = {'HTTP_AUTHORIZATION': f'Bearer {RefreshToken.for_user(user).access_token}'}
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Custom teardown to delete temp files created in tests """
+        # For deleting S3 bucket files
+        delete_test_files()
+
+        super().tearDownClass()
+
+    def test_unauthenticated_returns_error(self):
+        """ Confirm we return a 401 status code if the user isn't authenticated """
+        response = client.get(reverse('api:export_pictures'))
+        self.assertEqual(response.status_code, 401)
+
+    def test_user_returns_error(self):
+        """ Confirm we return a 401 status code if the user isn't an admin """
+        response = client.get(reverse('api:export_pictures'), **self.user_headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_invalid_dates_returns_error(self):
+        """ Confirm we return an error if the dates are invalid """
+        response = client.get(reverse('api:export_pictures'), {'start': 'invalid'}, **self.admin_headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json().get('error_message', ''), 'Sorry, those dates aren\'t valid')
+
+    def test_export_streams_archive(self):
+        """ Confirm we stream a ZIP archive of the pictures """
+        response = client.get(reverse('api:export_pictures'), **self.admin_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="pictures.zip"')
+        with zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.read('export.gif'), b'picture')
@@ -1,6 +1,9 @@
 from django.urls import path
 
-from .views import invitation, pictures
+from .views import (
+    invitation, export_guests, guest_stats, pictures, upload_job, picture_uploads, confirm_picture_uploads,
+    export_pictures,
+)
 
 
 app_name = 'api'
@@ -8,7 +11,13 @@ app_name = 'api'
 urlpatterns = [
     # guests views
     path('invitation/<str:code>', invitation, name='invitation'),
+    path('guests/export', export_guests, name='export_guests'),
+    path('guests/stats', guest_stats, name='guest_stats'),
 
     # memories views
+    path('pictures/export', export_pictures, name='export_pictures'),
     path('pictures/<str:code>', pictures, name='pictures'),
+    path('pictures/<str:code>/jobs/<str:job_uuid>', upload_job, name='upload_job'),
+    path('pictures/<str:code>/uploads', picture_uploads, name='picture_uploads'),
+    path('pictures/<str:code>/uploads/confirm', confirm_picture_uploads, name='confirm_picture_uploads'),
 ]
@@ -2,13 +2,15 @@ from rest_framework.response import Response
 from rest_framework import status
 
 
-def error_message(message, request_status=status.HTTP_400_BAD_REQUEST):
+def error_message(message, request_status=status.HTTP_400_BAD_REQUEST, extra_data=None):
     """
     A helper function to return a standard error response, and override the response status_code
+    Any extra_data (e.g. the result for each uploaded picture) is added to the response
     """
     data = {
         'success': False,
         'error_message': message,
+        **(extra_data or {}),
     }
 
     return Response(data, status=request_status)
@@ -1,11 +1,18 @@
+from django.http import StreamingHttpResponse
+
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 
-from guests.models import Invitation
+from accounts.decorators import is_active_admin
+from data.constants import GUEST_LIST_FIELDS
+from guests.models import Invitation, Guest
 from api.serializers import InvitationSerializer
 from api.views.accounts import error_message
+from utils.helpers import (
+    stream_csv, stream_json, get_cache_stats, get_not_modified_response, set_conditional_headers,
+)
 
 
 @api_view(['GET', 'POST'])
@@ -19,18 +26,79 @@ def invitation(request, **kwargs):
     data = request.data
     temp_invitation = Invitation()
     success_data = {'success': True}
-
-    matching_invitation = temp_invitation.get_invitation(code=code)
-    if not matching_invitation:
-        return error_message(message='Sorry, we can\'t find an invitation with that code')
+    etag, last_modified = None, None
 
     if request.method == 'POST':
+        matching_invitation = temp_invitation.get_invitation(code=code)
+        if not matching_invitation:
+            return error_message(message='Sorry, we can\'t find an invitation with that code')
+
         success, error = matching_invitation.process_invitation_response(data=data)
         if not success:
             return error_message(message=error)
 
+        invitation_data = InvitationSerializer(matching_invitation).data
+    else:
+        # Serve the invitation from the cache, to avoid hitting the DB for repeated (and invalid) lookups
+        cached_invitation = temp_invitation.get_cached_invitation(code=code)
+        if not cached_invitation:
+            return error_message(message='Sorry, we can\'t find an invitation with that code')
+
+        # Return 304 Not Modified if the client's copy is current
+        etag, last_modified = cached_invitation.get('etag'), cached_invitation.get('last_modified')
+        not_modified_response = get_not_modified_response(request, etag=etag, last_modified=last_modified)
+        if not_modified_response:
+            return set_conditional_headers(
+                not_modified_response, etag=etag, last_modified=last_modified, private=True, no_cache=True
+            )
+
+        invitation_data = cached_invitation.get('invitation')
+
     # Same response for GET and POST
-    invitation_data = InvitationSerializer(matching_invitation).data
     success_data['invitation'] = invitation_data
 
+    response = Response(success_data, status=status.HTTP_200_OK)
+    if etag:
+        set_conditional_headers(response, etag=etag, last_modified=last_modified, private=True, no_cache=True)
+
+    return response
+
+
+@api_view(['GET'])
+@is_active_admin
+def export_guests(request):
+    """
+    GET - Stream the guest list, with invitation details and attending status, as CSV (default) or JSON
+    Use the 'file_type' query param to choose the format ('format' is reserved by DRF for content negotiation)
+    """
+    file_type = request.query_params.get('file_type', 'csv').lower()
+    temp_guest = Guest()
+
+    if file_type == 'csv':
+        content = stream_csv(rows=temp_guest.get_guest_list(), fields=GUEST_LIST_FIELDS)
+        content_type = 'text/csv'
+    elif file_type == 'json':
+        content = stream_json(rows=temp_guest.get_guest_list())
+        content_type = 'application/json'
+    else:
+        return error_message(message='Sorry, the file type must be csv or json')
+
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="guest-list.{file_type}"'
+    return response
+
+
+@api_view(['GET'])
+@is_active_admin
+def guest_stats(request):
+    """
+    GET - Return the RSVP stats - guest headcounts by attending status, invitations pending and the response rate
+    """
+    temp_guest = Guest()
+    success_data = {
+        'success': True,
+        'stats': temp_guest.get_stats(),
+        'invitation_cache': get_cache_stats(name='invitation'),
+    }
+
     return Response(success_data, status=status.HTTP_200_OK)
@@ -1,39 +1,225 @@
+import math
+
 from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import AllowAny
 
-from memories.models import Picture
-from api.serializers import PictureSerializer
+from accounts.decorators import is_active_admin
+from memories.models import Picture, UploadJob
+from api.serializers import PictureSerializer, UploadJobSerializer
 from api.views.accounts import error_message
+from utils.helpers import get_not_modified_response, set_conditional_headers
+
+
+def get_page_size(page_size):
+    """ Return the requested gallery page size, capped at the max page size, or the default page size if invalid """
+    try:
+        return min(max(int(page_size), 1), settings.GALLERY_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return settings.GALLERY_PAGE_SIZE
+
+
+def get_rate_limit_error(code, picture_files):
+    """
+    Return a 429 error response if the gallery code's upload rate limit has been exceeded, or a 400 if the upload is
+    larger than the limit's burst (so could never be allowed), else None
+    """
+    picture_count = len(picture_files) if isinstance(picture_files, list) else 1
+    wait = Picture.take_upload_tokens(code=code, picture_count=picture_count)
+    if wait is None:
+        return error_message(
+            message=f'Please upload up to {settings.PICTURE_UPLOAD_RATE_LIMIT_BURST} pictures at a time'
+        )
+    if not wait:
+        return None
+
+    response = error_message(
+        message='You\'re uploading too quickly, please try again in a moment',
+        request_status=status.HTTP_429_TOO_MANY_REQUESTS,
+    )
+    response['Retry-After'] = math.ceil(wait)
+    return response
 
 
 @api_view(['GET', 'POST'])
 @permission_classes((AllowAny,))
 def pictures(request, **kwargs):
     """
-    GET - Return a list of all Picture instances
-    POST - Allow user to upload a list of images
+    GET - Return a page of Picture instances, with the cursors for the next/previous pages
+        - Use the 'cursor' and 'page_size' query params to page through the gallery
+        - Use the 'all=true' query param to return all Picture instances, from the cached gallery manifest
+    POST - Allow user to upload a list of images, either as multipart/form-data files or base 64 strings in JSON
+         - Use the 'async=true' query param to stage the images for background processing, and return the job's uuid
+         - Uploads are limited in count and size (see Picture.check_upload_limits) and rate limited per gallery code
     """
     code = kwargs.get('code', '')
-    picture_files = request.data.get('pictures', [])
+    # Multipart uploads are streamed to temp files by Django's upload handlers
+    picture_files = request.FILES.getlist('pictures') if request.FILES else request.data.get('pictures', [])
     temp_picture = Picture()
     success_data = {'success': True}
+    etag, last_modified = None, None
 
     if not code.lower() == settings.GALLERY_CODE.lower():
         return error_message(message='Sorry, that code isn\'t valid')
 
+    # Uploads are limited per gallery code (see Picture.take_upload_tokens), one token per picture - requests over the
+    # count and size limits are rejected first, so they don't use up the gallery code's tokens
     if request.method == 'POST':
-        uploaded_pictures, error = temp_picture.create_pictures(picture_files=picture_files)
+        sizes, error = Picture.check_upload_limits(picture_files=picture_files)
+        if error:
+            return error_message(message=error)
+        rate_limit_error = get_rate_limit_error(code=code, picture_files=picture_files)
+        if rate_limit_error:
+            return rate_limit_error
+
+    if request.method == 'POST' and request.query_params.get('async', '').lower() == 'true':
+        upload_job, error = UploadJob.create_upload_job(picture_files=picture_files)
         if error:
             return error_message(message=error)
+
+        # The pictures are processed by the run_upload_worker command - use the upload_job view to check progress
+        return Response({'success': True, 'job_uuid': upload_job.job_uuid}, status=status.HTTP_202_ACCEPTED)
+    elif request.method == 'POST':
+        uploaded_pictures, results, error = temp_picture.upload_pictures(picture_files=picture_files)
+        if error:
+            # Report the error for each picture (e.g. too_large or unreadable) along with the overall error
+            return error_message(message=error, extra_data={'results': results})
+
+        # Report the success or error for each picture, as some pictures may have failed to upload
+        success_data['results'] = results
+    elif request.query_params.get('all', '').lower() == 'true':
+        # Serve the whole gallery from the pre-encoded manifest, without querying the DB
+        manifest = temp_picture.get_gallery_manifest()
+        etag, last_modified = manifest.get('etag'), manifest.get('last_modified')
+        response = get_not_modified_response(request, etag=etag, last_modified=last_modified)
+        if not response:
+            response = HttpResponse(manifest.get('content'), content_type='application/json')
+        return set_conditional_headers(response, etag=etag, last_modified=last_modified, public=True, no_cache=True)
     else:
-        uploaded_pictures = temp_picture.get_pictures()
+        # Return 304 Not Modified if the client's copy of the gallery is current
+        etag, last_modified = temp_picture.get_pictures_version()
+        not_modified_response = get_not_modified_response(request, etag=etag, last_modified=last_modified)
+        if not_modified_response:
+            return set_conditional_headers(
+                not_modified_response, etag=etag, last_modified=last_modified, public=True, no_cache=True
+            )
+
+        page, error = temp_picture.get_pictures_page(
+            cursor=request.query_params.get('cursor', ''),
+            page_size=get_page_size(request.query_params.get('page_size')),
+        )
+        if error:
+            return error_message(message=error)
+
+        uploaded_pictures = page.get('pictures', [])
+        success_data['next'] = page.get('next')
+        success_data['previous'] = page.get('previous')
 
     # Same response for GET and POST
     uploaded_pictures_data = PictureSerializer(uploaded_pictures, many=True).data
     success_data['pictures'] = uploaded_pictures_data
 
+    response = Response(success_data, status=status.HTTP_200_OK)
+    if etag:
+        set_conditional_headers(response, etag=etag, last_modified=last_modified, public=True, no_cache=True)
+
+    return response
+
+
+@api_view(['POST'])
+@permission_classes((AllowAny,))
+def picture_uploads(request, **kwargs):
+    """
+    POST - Return a presigned upload for each of a list of images (dicts with a 'name' and a 'contentType'), to upload
+           them straight to storage - then pass each upload's token to the confirm_picture_uploads view
+         - Use the 'method' field to choose a presigned 'post' (the default, which limits the size) or 'put'
+    """
+    code = kwargs.get('code', '')
+    picture_files = request.data.get('pictures', [])
+    method = 'put' if str(request.data.get('method', '')).lower() == 'put' else 'post'
+
+    if not code.lower() == settings.GALLERY_CODE.lower():
+        return error_message(message='Sorry, that code isn\'t valid')
+
+    # Requests over the max files are rejected before they take tokens from the rate limit (see pictures)
+    error = Picture.check_upload_count(picture_files=picture_files)
+    if error:
+        return error_message(message=error)
+    rate_limit_error = get_rate_limit_error(code=code, picture_files=picture_files)
+    if rate_limit_error:
+        return rate_limit_error
+
+    uploads, error = Picture.create_presigned_uploads(picture_files=picture_files, method=method)
+    if error:
+        return error_message(message=error)
+
+    return Response({'success': True, 'uploads': uploads}, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes((AllowAny,))
+def confirm_picture_uploads(request, **kwargs):
+    """
+    POST - Create pictures for a list of upload tokens (see picture_uploads), once the images have been uploaded
+    """
+    code = kwargs.get('code', '')
+    tokens = request.data.get('tokens', [])
+
+    if not code.lower() == settings.GALLERY_CODE.lower():
+        return error_message(message='Sorry, that code isn\'t valid')
+
+    uploaded_pictures, results, error = Picture.confirm_presigned_uploads(tokens=tokens)
+    if error:
+        return error_message(message=error, extra_data={'results': results})
+
+    success_data = {
+        'success': True,
+        'results': results,
+        'pictures': PictureSerializer(uploaded_pictures, many=True).data,
+    }
+    return Response(success_data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes((AllowAny,))
+def upload_job(request, **kwargs):
+    """
+    GET - Return the progress of an asynchronous upload job, and the status of each of its pictures
+    """
+    code = kwargs.get('code', '')
+    job_uuid = kwargs.get('job_uuid', '')
+
+    if not code.lower() == settings.GALLERY_CODE.lower():
+        return error_message(message='Sorry, that code isn\'t valid')
+
+    job = UploadJob.get_upload_job(job_uuid=job_uuid)
+    if not job:
+        return error_message(message='Sorry, we couldn\'t find that upload')
+
+    success_data = {'success': True, 'job': UploadJobSerializer(job).data}
     return Response(success_data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@is_active_admin
+def export_pictures(request):
+    """
+    GET - Stream a ZIP archive of the gallery's pictures (see Picture.stream_archive)
+    Use the 'start' and 'end' query params (ISO dates or datetimes) to archive the pictures created in a date range,
+    e.g. to resume a download that failed, and 'include_hidden=true' to include hidden pictures
+    """
+    archive_pictures, error = Picture.get_archive_pictures(
+        start=request.query_params.get('start', ''),
+        end=request.query_params.get('end', ''),
+        include_hidden=request.query_params.get('include_hidden', '').lower() == 'true',
+    )
+    if error:
+        return error_message(message=error)
+
+    response = StreamingHttpResponse(Picture.stream_archive(pictures=archive_pictures), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="pictures.zip"'
+    return response
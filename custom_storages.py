@@ -1,14 +1,237 @@
+import mimetypes
+import posixpath
+import threading
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from django.conf import settings
+from django.core.files.storage import FileSystemStorage, InMemoryStorage
+from django.utils.encoding import filepath_to_uri
+from django.utils.functional import cached_property
 
 from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
+
+
+# S3 connections (boto3 resources), shared by every storage with the same credentials, region and endpoint - see
+# SharedConnectionS3Storage
+S3_CONNECTIONS = {}
+S3_CONNECTIONS_LOCK = threading.Lock()
+# Max number of keys S3 deletes in a single DeleteObjects request
+S3_DELETE_BATCH_SIZE = 1000
+
+
+class SharedConnectionS3Storage(S3Boto3Storage):
+    """
+    S3 storage that shares one connection, and its pool of HTTP connections, across all threads and instances -
+    S3Boto3Storage creates a boto3 session and connection for each thread, so each upload request's worker threads
+    would otherwise set up new connections
+    The connection's client is thread-safe, and the storage creates a new boto3 Object for each file it reads or writes
+    """
+
+    def get_default_settings(self):
+        default_settings = super().get_default_settings()
+        return {
+            **default_settings,
+            'client_config': Config(
+                s3={'addressing_style': default_settings['addressing_style']},
+                signature_version=default_settings['signature_version'],
+                max_pool_connections=settings.AWS_S3_MAX_POOL_CONNECTIONS,
+                retries={'max_attempts': settings.AWS_S3_MAX_ATTEMPTS, 'mode': settings.AWS_S3_RETRY_MODE},
+            ),
+            'transfer_config': TransferConfig(
+                multipart_threshold=settings.AWS_S3_MULTIPART_THRESHOLD,
+                multipart_chunksize=settings.AWS_S3_MULTIPART_CHUNKSIZE,
+                max_concurrency=settings.AWS_S3_MAX_CONCURRENCY,
+            ),
+        }
+
+    @property
+    def connection(self):
+        key = (
+            self.access_key, self.secret_key, self.security_token, self.session_profile, self.region_name,
+            self.use_ssl, self.endpoint_url, self.verify,
+        )
+        connection = S3_CONNECTIONS.get(key)
+        if connection is None:
+            with S3_CONNECTIONS_LOCK:
+                connection = S3_CONNECTIONS.get(key)
+                if connection is None:
+                    connection = S3_CONNECTIONS[key] = self._create_session().resource(
+                        's3',
+                        region_name=self.region_name,
+                        use_ssl=self.use_ssl,
+                        endpoint_url=self.endpoint_url,
+                        config=self.client_config,
+                        verify=self.verify,
+                    )
+
+        return connection
+
+    def list_files(self, prefix=''):
+        """
+        Yield the name, size and modified time of every file under a prefix (e.g. 'memories/'), listing up to 1,000
+        keys per request
+        """
+        key_prefix = self._normalize_name(clean_name(prefix))
+        location = f'{self.location.strip("/")}/' if self.location else ''
+        paginator = self.connection.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=key_prefix):
+            for entry in page.get('Contents', []):
+                yield {'name': entry['Key'][len(location):], 'size': entry['Size'], 'modified': entry['LastModified']}
 
+    def list_names(self, prefix=''):
+        """ Yield the name of every file under a prefix (see list_files) """
+        for file in self.list_files(prefix):
+            yield file['name']
 
-class StaticStorage(S3Boto3Storage):
+    def delete_many(self, names):
+        """
+        Delete files in batches of up to 1,000 keys per request, rather than a request per file
+        Returns the names of any files that couldn't be deleted
+        """
+        names = list(names)
+        failed_names = []
+        location = f'{self.location.strip("/")}/' if self.location else ''
+        client = self.connection.meta.client
+        for start in range(0, len(names), S3_DELETE_BATCH_SIZE):
+            keys = [
+                {'Key': self._normalize_name(clean_name(name))} for name in names[start:start + S3_DELETE_BATCH_SIZE]
+            ]
+            response = client.delete_objects(Bucket=self.bucket_name, Delete={'Objects': keys, 'Quiet': True})
+            failed_names.extend(error['Key'][len(location):] for error in response.get('Errors', []))
+
+        return failed_names
+
+    def iter_chunks(self, name, chunk_size):
+        """ Yield a file's content in chunks, streamed from the bucket - S3File downloads the whole file first """
+        response = self.connection.meta.client.get_object(
+            Bucket=self.bucket_name, Key=self._normalize_name(clean_name(name))
+        )
+        body = response['Body']
+        try:
+            yield from body.iter_chunks(chunk_size)
+        finally:
+            body.close()
+
+
+class StaticStorage(SharedConnectionS3Storage):
     """ Custom MediaStorage class to point to the correct S3 bucket name """
     bucket_name = settings.AWS_STORAGE_BUCKET_NAME
 
 
-class MediaStorage(S3Boto3Storage):
+class MediaStorage(SharedConnectionS3Storage):
     """ Custom MediaStorage class to point to the correct S3 bucket name """
     bucket_name = settings.AWS_STORAGE_BUCKET_NAME
     custom_domain = f'{settings.AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com'
+
+    @cached_property
+    def public_url_base(self):
+        """
+        The base URL of the bucket's files on the custom domain, so a file's URL can be built by appending its quoted
+        name, without the storage's URL machinery - or None if file URLs must be signed
+        """
+        if not self.custom_domain or (self.querystring_auth and self.cloudfront_signer):
+            return None
+
+        location = f'{self.location.strip("/")}/' if self.location else ''
+        return f'{self.url_protocol}//{self.custom_domain}/{filepath_to_uri(location)}'
+
+    def generate_presigned_upload(self, name, content_type, max_size, expires_in, method='post'):
+        """
+        Generate a presigned POST (URL and form fields) or PUT (URL and headers) to upload a file straight to the
+        bucket, without it passing through the web server - the POST also limits the file's size
+        """
+        key = self._normalize_name(clean_name(name))
+        client = self.connection.meta.client
+        headers = {'Content-Type': content_type}
+        if self.object_parameters.get('CacheControl'):
+            headers['Cache-Control'] = self.object_parameters['CacheControl']
+
+        if method == 'put':
+            params = {'Bucket': self.bucket_name, 'Key': key, 'ContentType': content_type}
+            if 'Cache-Control' in headers:
+                params['CacheControl'] = headers['Cache-Control']
+            url = client.generate_presigned_url('put_object', Params=params, ExpiresIn=expires_in)
+            return {'method': 'PUT', 'url': url, 'fields': {}, 'headers': headers}
+
+        conditions = [{field: value} for field, value in headers.items()]
+        conditions.append(['content-length-range', 1, max_size])
+        post = client.generate_presigned_post(
+            self.bucket_name, key, Fields=headers, Conditions=conditions, ExpiresIn=expires_in
+        )
+        return {'method': 'POST', 'url': post['url'], 'fields': post['fields'], 'headers': {}}
+
+    def get_object_metadata(self, name):
+        """ Get the size and content type of a file in the bucket with a HEAD request, or None if it doesn't exist """
+        try:
+            response = self.connection.meta.client.head_object(
+                Bucket=self.bucket_name, Key=self._normalize_name(clean_name(name))
+            )
+        except ClientError as error:
+            if error.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+                return None
+            raise
+
+        return {'size': response.get('ContentLength', 0), 'content_type': response.get('ContentType', '')}
+
+
+class LocalMediaStorageMixin:
+    """ The MediaStorage methods (other than presigned uploads) for storages that don't use S3 """
+
+    @cached_property
+    def public_url_base(self):
+        """ The base URL of the storage's files (see MediaStorage.public_url_base) """
+        return self.base_url
+
+    def get_object_metadata(self, name):
+        """ Get the size and content type (from its extension) of a file, or None if it doesn't exist """
+        if not self.exists(name):
+            return None
+
+        return {'size': self.size(name), 'content_type': mimetypes.guess_type(name)[0] or ''}
+
+    def list_names(self, prefix=''):
+        """ Yield the name of every file under a prefix (directory, e.g. 'memories/') """
+        prefix = prefix.strip('/')
+        if prefix and not self.exists(prefix):
+            return
+
+        directories, files = self.listdir(prefix)
+        for file in files:
+            yield posixpath.join(prefix, file)
+        for directory in directories:
+            yield from self.list_names(posixpath.join(prefix, directory))
+
+    def iter_chunks(self, name, chunk_size):
+        """ Yield a file's content in chunks """
+        with self.open(name, 'rb') as file:
+            yield from file.chunks(chunk_size)
+
+    def list_files(self, prefix=''):
+        """ Yield the name, size and modified time of every file under a prefix (see the S3 list_files) """
+        for name in self.list_names(prefix):
+            yield {'name': name, 'size': self.size(name), 'modified': self.get_modified_time(name)}
+
+    def delete_many(self, names):
+        """ Delete files, returning the names of any files that couldn't be deleted (see the S3 delete_many) """
+        for name in names:
+            self.delete(name)
+
+        return []
+
+
+class LocalMediaStorage(LocalMediaStorageMixin, FileSystemStorage):
+    """ Media storage in MEDIA_ROOT on the local filesystem, e.g. for development without an S3 bucket """
+
+
+class InMemoryMediaStorage(LocalMediaStorageMixin, InMemoryStorage):
+    """
+    Media storage held in memory, for tests - files have the same URLs they would have in the S3 bucket, and are lost
+    when the process exits
+    """
+
+    def __init__(self, location=None, base_url=None, *args, **kwargs):
+        base_url = base_url or f'https://{settings.AWS_S3_CUSTOM_DOMAIN}/'
+        super().__init__(location, base_url, *args, **kwargs)
@@ -1 +1,39 @@
 RANDOM_STRING_LENGTH = 10
+
+# Invitation code allocation
+CODE_BATCH_SIZE = 1000
+CODE_ALLOCATION_ATTEMPTS = 5
+
+# Guest list import
+IMPORT_CHUNK_SIZE = 500
+
+# Guest list export
+EXPORT_CHUNK_SIZE = 2000
+GUEST_LIST_FIELDS = ('invitation', 'code', 'name', 'party_only', 'wedding', 'party', 'attending_status')
+
+# Cache keys
+INVITATION_CACHE_KEY = 'invitation:{code}'
+GUEST_STATS_CACHE_KEY = 'guest-stats'
+GALLERY_MANIFEST_CACHE_KEY = 'gallery-manifest'
+GALLERY_MANIFEST_ENTRIES_CACHE_KEY = 'gallery-manifest:entries'
+GALLERY_MANIFEST_LOCK_KEY = 'gallery-manifest:lock'
+GALLERY_MANIFEST_STALE_KEY = 'gallery-manifest:stale'
+UPLOAD_RATE_LIMIT_CACHE_KEY = 'upload-rate-limit:{code}'
+CACHE_COUNTER_KEY = 'cache-counter:{name}:{counter}'
+
+# Picture renditions - the longest edge (px) of each rendition, and the formats each rendition is stored in
+PICTURE_RENDITIONS = {'thumbnail': 200, 'medium': 800, 'large': 1600}
+PICTURE_RENDITION_FORMATS = ('webp', 'jpeg')
+
+# Picture upload errors, by the error code returned with each picture's result
+UPLOAD_ERRORS = {
+    'unreadable': 'We were unable to read this picture',
+    'too_large': 'This picture is too large',
+    'upload_failed': 'We were unable to upload this picture',
+    'save_failed': 'We were unable to save this picture',
+    'invalid_upload': 'Sorry, that upload isn\'t valid',
+    'not_found': 'We couldn\'t find this picture, please upload it again',
+}
+
+# Presigned uploads
+PRESIGNED_UPLOAD_SALT = 'memories.presigned-upload'
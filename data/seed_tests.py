@@ -1,4 +1,10 @@
+import base64
+from io import BytesIO
+
+from PIL import Image
+
 from guests.models import Invitation, Guest
+from memories.models import Picture
 
 
 def seed_guests(invitation, guests_count=1):
@@ -19,3 +25,22 @@ def seed_invitations(invitation_count=1):
         seed_guests(invitation=invitation, guests_count=2)
 
     return Invitation.objects.all()
+
+
+def seed_pictures(picture_count=1):
+    """ Create pictures without uploading files, for tests that don't need the file itself """
+    for i in range(picture_count):
+        Picture.objects.create(file=f'memories/test/picture-{i + 1}.gif')
+
+    return Picture.objects.all()
+
+
+def generate_base_64_images(image_count=1):
+    """ Create distinct base 64 GIF strings, so uploaded test pictures aren't matched as duplicates of each other """
+    images = []
+    for i in range(image_count):
+        buffer = BytesIO()
+        Image.new('RGB', (1, 1), color=(i % 256, i // 256 % 256, 0)).save(buffer, format='GIF')
+        images.append(f'data:image/gif;base64,{base64.b64encode(buffer.getvalue()).decode()}')
+
+    return images
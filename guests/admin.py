@@ -81,15 +81,15 @@ class GuestAttendingStatusListFilter(admin.SimpleListFilter):
         ]
 
     def queryset(self, request, queryset):
-        """ Return the queryset filtered by the filter value """
-        if self.value() == 'wedding':
-            return queryset.filter(wedding=True, invitation__responded=True)
-        if self.value() == 'party':
-            return queryset.filter(party=True, invitation__responded=True)
-        if self.value() == 'none':
-            return queryset.filter(wedding=False, party=False, invitation__responded=True)
-        if self.value() == 'pending':
-            return queryset.filter(invitation__responded=False)
+        """ Return the queryset filtered by the filter value, using the annotated attending status """
+        attending_statuses = {
+            'wedding': ('Both', 'Wedding only'),
+            'party': ('Both', 'Party only'),
+            'none': ('No',),
+            'pending': ('Pending',),
+        }.get(self.value())
+        if attending_statuses:
+            return queryset.with_attending_status().filter(annotated_attending_status__in=attending_statuses)
 
         return queryset
 
@@ -100,6 +100,7 @@ class GuestAdmin(admin.ModelAdmin):
     list_filter = ('party_only', GuestAttendingStatusListFilter)
     search_fields = ('name',)
     raw_id_fields = ('invitation',)
+    list_select_related = ('invitation',)
 
     fieldsets = (
         (
@@ -119,6 +120,10 @@ class GuestAdmin(admin.ModelAdmin):
         ),
     )
 
+    def get_queryset(self, request):
+        """ Override to annotate the attending status, so the changelist renders and sorts it without extra queries """
+        return super().get_queryset(request).with_attending_status()
+
     def get_party_name(self, obj):
         """ Custom field to get the invitation's name """
         return obj.invitation.name if obj.invitation.name else ''
@@ -130,6 +135,7 @@ class GuestAdmin(admin.ModelAdmin):
         return obj.attending_status
     get_attending_status.short_description = 'Attending Status'
     get_attending_status.allow_tags = True
+    get_attending_status.admin_order_field = 'annotated_attending_status'
 
     def has_add_permission(self, request, obj=None):
         """ Override to disallow adding guests """
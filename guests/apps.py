@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class GuestsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'guests'
+
+    def ready(self):
+        """ Import signals to register the cache invalidation receivers """
+        from . import signals
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from guests.models import Guest
+from data.constants import GUEST_LIST_FIELDS
+from utils.helpers import stream_csv, stream_json
+
+
+class Command(BaseCommand):
+    """
+    Export the guest list, with invitation details and attending status, as CSV or JSON
+    The guests are streamed from the DB in chunks and written as they're fetched, so memory use stays flat
+    """
+    help = 'Export the guest list as CSV or JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=('csv', 'json'), default='csv', help='Export file format')
+        parser.add_argument('--output', help='Path to write the export to - defaults to stdout')
+
+    def handle(self, *args, **options):
+        rows = Guest.get_guest_list()
+        if options['format'] == 'csv':
+            content = stream_csv(rows=rows, fields=GUEST_LIST_FIELDS)
+        else:
+            content = stream_json(rows=rows)
+
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as file:
+                file.writelines(content)
+            self.stderr.write(self.style.SUCCESS(f'Exported the guest list to {options["output"]}'))
+        else:
+            for chunk in content:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,142 @@
+import csv
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from guests.models import Invitation, Guest
+from data.constants import IMPORT_CHUNK_SIZE
+
+
+TRUE_VALUES = ('true', 'yes', 'y', '1')
+
+
+class Command(BaseCommand):
+    """
+    Import invitations and guests from a CSV or JSONL guest list
+
+    Each row is a guest with 'invitation', 'name' and (optional) 'party_only' values - consecutive rows with the same
+    invitation name are grouped into a single invitation, so the file should be sorted by invitation. The file is
+    streamed and invitations are created in chunks, so memory use doesn't grow with the size of the file.
+    The whole file is validated before anything is imported (streaming it twice), so an invalid row doesn't leave a
+    partial import.
+    """
+    help = 'Import invitations and guests from a CSV or JSONL guest list'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path to the CSV or JSONL guest list')
+        parser.add_argument(
+            '--format', choices=('csv', 'jsonl'), help='File format - defaults to the file extension'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help='Number of invitations to create per transaction'
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or path.rsplit('.', 1)[-1].lower()
+        chunk_size = options['chunk_size']
+        if file_format not in ('csv', 'jsonl'):
+            raise CommandError('Please specify the file format with --format (csv or jsonl)')
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        start = time.perf_counter()
+        invitation_count, guest_count = 0, 0
+        try:
+            with open(path, newline='', encoding='utf-8') as file:
+                for _ in self.group_rows(self.read_rows(file, file_format)):
+                    pass
+                file.seek(0)
+                rows = self.read_rows(file, file_format)
+                for chunk in self.chunk_invitations(self.group_rows(rows), chunk_size=chunk_size):
+                    created_invitations, created_guests = self.import_chunk(chunk)
+                    invitation_count += created_invitations
+                    guest_count += created_guests
+        except OSError as error:
+            raise CommandError(f'Unable to read {path}: {error}')
+
+        duration = time.perf_counter() - start
+        # Each row is a guest
+        rows_per_second = guest_count / duration if duration else guest_count
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {invitation_count} invitations and {guest_count} guests in {duration:.2f}s '
+            f'({rows_per_second:.0f} rows/s)'
+        ))
+        if not settings.CACHE_IS_SHARED:
+            self.stdout.write(self.style.WARNING(
+                f'The cache isn\'t shared, so the RSVP stats may be out of date for up to '
+                f'{settings.GUEST_STATS_CACHE_TIMEOUT}s'
+            ))
+
+    def read_rows(self, file, file_format):
+        """ Yield a dict for each row of a CSV or JSONL file """
+        return csv.DictReader(file) if file_format == 'csv' else self.read_jsonl(file)
+
+    @staticmethod
+    def read_jsonl(file):
+        """ Yield a dict for each non-empty line of a JSONL file """
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                raise CommandError(f'Invalid JSON on line {line_number}')
+
+    @staticmethod
+    def group_rows(rows):
+        """ Yield (invitation name, guest rows) for each run of consecutive rows with the same invitation name """
+        invitation_name, guest_rows = None, []
+        for row_number, row in enumerate(rows, start=1):
+            if not isinstance(row, dict):
+                raise CommandError(f'Row {row_number} must be an object: {row}')
+            row_invitation_name = (row.get('invitation') or '').strip()
+            if not row_invitation_name or not (row.get('name') or '').strip():
+                raise CommandError(f'Each row must have an invitation and a name (row {row_number}): {row}')
+            if guest_rows and row_invitation_name != invitation_name:
+                yield invitation_name, guest_rows
+                guest_rows = []
+            invitation_name = row_invitation_name
+            guest_rows.append(row)
+
+        if guest_rows:
+            yield invitation_name, guest_rows
+
+    @staticmethod
+    def chunk_invitations(invitations, chunk_size):
+        """ Yield lists of up to chunk_size (invitation name, guest rows) tuples """
+        chunk = []
+        for invitation in invitations:
+            chunk.append(invitation)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def import_chunk(chunk):
+        """ Create the invitations and guests for a chunk in a single transaction, returning the counts created """
+        new_invitations = [Invitation(name=invitation_name) for invitation_name, guest_rows in chunk]
+        with transaction.atomic():
+            invitations = Invitation.create_invitations(invitations=new_invitations, batch_size=len(chunk))
+            # The created invitations may be re-fetched (without a guaranteed order), so match them up by code
+            invitations_by_code = {invitation.code: invitation for invitation in invitations}
+            guests = []
+            for new_invitation, (invitation_name, guest_rows) in zip(new_invitations, chunk):
+                for row in guest_rows:
+                    guests.append(Guest(
+                        invitation=invitations_by_code[new_invitation.code],
+                        name=row.get('name').strip(),
+                        party_only=str(row.get('party_only', '')).strip().lower() in TRUE_VALUES,
+                    ))
+            Guest.objects.bulk_create(guests, batch_size=IMPORT_CHUNK_SIZE)
+
+        # bulk_create() doesn't send post_save signals, so invalidate the cached RSVP stats
+        Guest.invalidate_stats_cache()
+
+        return len(invitations), len(guests)
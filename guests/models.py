@@ -1,10 +1,16 @@
 import uuid
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, connection, transaction, DatabaseError, IntegrityError
+from django.utils import timezone
 
 from model_utils.models import TimeStampedModel
 
-from utils.helpers import generate_random_string
+from data.constants import (
+    INVITATION_CACHE_KEY, GUEST_STATS_CACHE_KEY, CODE_BATCH_SIZE, CODE_ALLOCATION_ATTEMPTS, EXPORT_CHUNK_SIZE,
+)
+from utils.helpers import generate_random_string, generate_random_strings, increment_cache_counter, generate_etag
 
 # Create your models here.
 class Invitation(TimeStampedModel):
@@ -25,26 +31,147 @@ class Invitation(TimeStampedModel):
         return f'{self.name} ({'' if self.responded else 'not '}responded)'
 
     def save(self, *args, **kwargs):
-        """ Override save() to generate a unique code when creating a new Invitation """
-        if not self.code:
-            code = generate_random_string()
-            while Invitation.objects.filter(code=code).exists():
-                code = generate_random_string()
+        """
+        Override save() to generate a unique code when creating a new Invitation
+        Rather than checking the code is free before inserting (which races with other inserts), rely on the unique
+        constraint and retry with a new code if it's already taken
+        """
+        if self.code:
+            return super(Invitation, self).save(*args, **kwargs)
 
-            self.code = code
+        for attempt in range(CODE_ALLOCATION_ATTEMPTS):
+            self.code = generate_random_string()
+            try:
+                with transaction.atomic():
+                    return super(Invitation, self).save(*args, **kwargs)
+            except IntegrityError:
+                # Re-raise if the error wasn't caused by the code, or we've run out of attempts
+                code_taken = Invitation.objects.filter(code=self.code).exists()
+                self.code = None
+                if not code_taken or attempt == CODE_ALLOCATION_ATTEMPTS - 1:
+                    raise
+
+    @staticmethod
+    def generate_codes(count):
+        """
+        Generate a list of unique codes that aren't already in use by an invitation
+        Candidates are checked against the DB in batches, with a single IN query per batch
+        """
+        codes = set()
+        while len(codes) < count:
+            candidates = generate_random_strings(count=min(count - len(codes), CODE_BATCH_SIZE)) - codes
+            existing_codes = Invitation.objects.filter(code__in=candidates).values_list('code', flat=True)
+            codes.update(candidates.difference(existing_codes))
+
+        return list(codes)
+
+    @staticmethod
+    def create_invitations(invitations, batch_size=CODE_BATCH_SIZE):
+        """
+        Create a list of unsaved Invitation instances in batches, allocating the codes for each batch up front
+        A batch is retried with fresh codes if one of its codes is taken between generating and inserting them
+        """
+        created_invitations = []
+        for index in range(0, len(invitations), batch_size):
+            batch = invitations[index:index + batch_size]
+            for attempt in range(CODE_ALLOCATION_ATTEMPTS):
+                codes = Invitation.generate_codes(count=len(batch))
+                for invitation, code in zip(batch, codes):
+                    invitation.code = code
+                try:
+                    with transaction.atomic():
+                        batch = Invitation.objects.bulk_create(batch)
+                    break
+                except IntegrityError:
+                    if attempt == CODE_ALLOCATION_ATTEMPTS - 1:
+                        raise
 
-        super(Invitation, self).save(*args, **kwargs)
+            # Backends that can't return the inserted rows (e.g. MySQL) don't set the primary keys
+            if not connection.features.can_return_rows_from_bulk_insert:
+                batch = list(Invitation.objects.filter(code__in=[invitation.code for invitation in batch]))
+            created_invitations.extend(batch)
+
+        return created_invitations
+
+    @staticmethod
+    def normalize_code(code):
+        """
+        Normalize an invitation code as entered by a guest - codes are generated in lowercase, so lowercase it
+        Returns None if it can't be a valid code
+        """
+        code = code.lower()
+        if not code.isalnum() or len(code) > Invitation._meta.get_field('code').max_length:
+            return None
+
+        return code
 
     @staticmethod
     def get_invitation(code):
-        """ Get an invitation by code """
+        """ Get an invitation by code (see normalize_code) """
+        code = Invitation.normalize_code(code)
+        if not code:
+            return None
+
         try:
-            invitation = Invitation.objects.get(code=code)
+            # Prefetch the guests so the serializer and RSVP processing share a single guests query
+            invitation = Invitation.objects.prefetch_related('guests').get(code=code)
         except Invitation.DoesNotExist:
             invitation = None
 
         return invitation
 
+    @staticmethod
+    def get_cached_invitation(code):
+        """
+        Get the cache entry for an invitation by code - the serialized invitation data, including guests, with its ETag
+        and last modified date for conditional requests. Served from the cache where possible
+        Codes that don't match an invitation are cached briefly as an empty dict, so repeated lookups don't hit the DB
+        """
+        # Import here to prevent circular import error
+        from api.serializers import InvitationSerializer
+
+        # Normalise the code so the same invitation shares a cache entry however its code was entered
+        code = Invitation.normalize_code(code)
+        if not code:
+            return None
+
+        cache_key = INVITATION_CACHE_KEY.format(code=code)
+        cached_invitation = cache.get(cache_key)
+        if cached_invitation is not None:
+            increment_cache_counter(name='invitation', counter='hits')
+            return cached_invitation or None
+
+        increment_cache_counter(name='invitation', counter='misses')
+        invitation = Invitation.get_invitation(code=code)
+        if not invitation:
+            cache.set(cache_key, {}, timeout=settings.INVITATION_NOT_FOUND_CACHE_TIMEOUT)
+            return None
+
+        invitation_data = dict(InvitationSerializer(invitation).data)
+        cached_invitation = {
+            'invitation': invitation_data,
+            'etag': generate_etag(invitation_data),
+            # The guests are prefetched, so the last modified date doesn't need another query
+            'last_modified': max(
+                [invitation.modified] + [guest.modified for guest in invitation.guests.all()]
+            ),
+        }
+        cache.set(cache_key, cached_invitation, timeout=settings.INVITATION_CACHE_TIMEOUT)
+
+        return cached_invitation
+
+    @staticmethod
+    def get_invitation_data(code):
+        """ Get the serialized invitation data, including guests, by code - served from the cache where possible """
+        cached_invitation = Invitation.get_cached_invitation(code=code)
+        return cached_invitation.get('invitation') if cached_invitation else None
+
+    @staticmethod
+    def invalidate_invitation_cache(code):
+        """ Remove the cached invitation data for a code """
+        if code:
+            cache.delete(INVITATION_CACHE_KEY.format(code=code.lower()))
+
     def get_invitation_guest(self, guest_uuid):
         """ Get a guest for an invitation by guest_uuid """
         try:
@@ -55,10 +182,18 @@ class Invitation(TimeStampedModel):
         return guest
 
     def process_invitation_response(self, data):
-        """ Process the response to an invitation and update the details for each associated guest """
+        """
+        Process the response to an invitation and update the details for each associated guest
+
+        The whole payload is validated up front, then the guests and the invitation are written in a single
+        transaction - the invitation row is locked so concurrent responses can't both pass the responded check
+        """
         # Import here to prevent circular import error
         from .forms import InvitationForm, GuestForm
 
+        guests_error = 'Sorry, we were unable to update the details for some guests, please try again'
+        invitation_error = 'Sorry, we were unable to update the details for this invitation, please try again'
+
         # Return error if there is no invitation or guests data
         invitation_data = data.get('invitation', {})
         guests_data = data.get('guests', [])
@@ -69,25 +204,65 @@ class Invitation(TimeStampedModel):
         if self.responded:
             return False, 'It looks like you\'ve already responded to this invitation'
 
-        # Update details for each associated guest
+        # Validate the details for each associated guest - use the (prefetched) guests so they are updated in place
+        invitation_guests = {str(guest.guest_uuid): guest for guest in self.guests.all()}
+        updated_guests = []
+        now = timezone.now()
         for guest_data in guests_data:
-            guest_uuid = guest_data.get('guest_uuid', '')
-            try:
-                guest = self.get_invitation_guest(guest_uuid=guest_uuid)
-                guest_form = GuestForm(instance=guest, data=guest_data)
-                guest_form.save()
-            except:
-                return False, 'Sorry, we were unable to update the details for some guests, please try again'
+            guest = invitation_guests.get(str(guest_data.get('guest_uuid', '')))
+            if not guest:
+                return False, guests_error
+            guest_form = GuestForm(instance=guest, data=guest_data)
+            if not guest_form.is_valid():
+                return False, guests_error
+            # bulk_update() doesn't call pre_save(), so set the modified timestamp manually
+            guest.modified = now
+            updated_guests.append(guest)
+
+        invitation_form = InvitationForm(instance=self, data=invitation_data)
+        if not invitation_form.is_valid():
+            return False, invitation_error
 
         try:
-            invitation_form = InvitationForm(instance=self, data=invitation_data)
-            invitation_form.save()
-        except:
-            return False, 'Sorry, we were unable to update the details for this invitation, please try again'
+            with transaction.atomic():
+                # Lock the invitation row and re-check it hasn't been responded to since it was fetched
+                locked_invitation = Invitation.objects.select_for_update().only('responded').get(pk=self.pk)
+                if locked_invitation.responded:
+                    return False, 'It looks like you\'ve already responded to this invitation'
+
+                Guest.objects.bulk_update(updated_guests, fields=(*GuestForm.Meta.fields, 'modified'))
+                # Saving the invitation sends post_save, which invalidates the cached invitation - but bulk_update()
+                # doesn't send it for the guests, so invalidate the stats they're counted in once committed
+                invitation_form.save()
+                transaction.on_commit(Guest.invalidate_stats_cache)
+        except DatabaseError:
+            return False, invitation_error
 
         return True, ''
 
 
+class GuestQuerySet(models.QuerySet):
+    """
+    Custom Guest queryset to allow computing the attending status in the DB
+    """
+
+    def with_attending_status(self):
+        """
+        Annotate each guest's attending status (see Guest.get_attending_status), so it can be sorted and filtered on
+        in the DB without loading each guest's invitation
+        """
+        return self.annotate(
+            annotated_attending_status=models.Case(
+                models.When(invitation__responded=False, then=models.Value('Pending')),
+                models.When(wedding=True, party=True, then=models.Value('Both')),
+                models.When(wedding=True, then=models.Value('Wedding only')),
+                models.When(party=True, then=models.Value('Party only')),
+                default=models.Value('No'),
+                output_field=models.CharField(),
+            )
+        )
+
+
 class Guest(TimeStampedModel):
     """
     Guest model to allow creating a guest for an invitation
@@ -99,26 +274,114 @@ class Guest(TimeStampedModel):
     wedding = models.BooleanField(default=False)
     party = models.BooleanField(default=False)
 
+    objects = GuestQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Guest'
         verbose_name_plural = 'Guests'
 
     @property
     def attending_status(self):
-        """ Get the string representation of the guest's attending status """
+        """
+        Get the string representation of the guest's attending status
+        Use the status annotated by with_attending_status() where available, to avoid loading the invitation
+        """
+        if hasattr(self, 'annotated_attending_status'):
+            return self.annotated_attending_status
+
+        return self.get_attending_status(responded=self.invitation.responded, wedding=self.wedding, party=self.party)
+
+    @staticmethod
+    def get_attending_status(responded, wedding, party):
+        """ Get the string representation of an attending status from the invitation's responded status """
         attending_status = 'Pending'
-        if self.invitation.responded:
-            if self.wedding and self.party:
+        if responded:
+            if wedding and party:
                 attending_status = 'Both'
-            elif self.wedding and not self.party:
+            elif wedding and not party:
                 attending_status = 'Wedding only'
-            elif not self.wedding and self.party:
+            elif not wedding and party:
                 attending_status = 'Party only'
             else:
                 attending_status = 'No'
 
         return attending_status
 
+    @staticmethod
+    def get_stats():
+        """
+        Get the RSVP stats (guest headcounts by attending status and invitation response rate)
+        The stats are computed with a single aggregate query and cached until guests or invitations change - or, if the
+        cache isn't shared by every process (see CACHE_IS_SHARED), for a short time, as changes made by other processes
+        (e.g. the import_guests command) aren't invalidated in this process's cache
+        """
+        stats = cache.get(GUEST_STATS_CACHE_KEY)
+        if stats is not None:
+            return stats
+
+        responded = models.Q(invitation__responded=True)
+        counts = Guest.objects.aggregate(
+            guests=models.Count('id'),
+            status_both=models.Count('id', filter=responded & models.Q(wedding=True, party=True)),
+            status_wedding_only=models.Count('id', filter=responded & models.Q(wedding=True, party=False)),
+            status_party_only=models.Count('id', filter=responded & models.Q(wedding=False, party=True)),
+            status_no=models.Count('id', filter=responded & models.Q(wedding=False, party=False)),
+            status_pending=models.Count('id', filter=~responded),
+            invited_party_only=models.Count('id', filter=models.Q(party_only=True)),
+            invitations=models.Count('invitation', distinct=True),
+            invitations_responded=models.Count('invitation', distinct=True, filter=responded),
+        )
+        invitations, invitations_responded = counts['invitations'], counts['invitations_responded']
+        stats = {
+            'guests': counts['guests'],
+            'attending_status': {
+                'Both': counts['status_both'],
+                'Wedding only': counts['status_wedding_only'],
+                'Party only': counts['status_party_only'],
+                'No': counts['status_no'],
+                'Pending': counts['status_pending'],
+            },
+            'wedding': counts['status_both'] + counts['status_wedding_only'],
+            'party': counts['status_both'] + counts['status_party_only'],
+            'invited': {
+                'wedding': counts['guests'] - counts['invited_party_only'],
+                'party_only': counts['invited_party_only'],
+            },
+            'invitations': invitations,
+            'invitations_responded': invitations_responded,
+            'invitations_pending': invitations - invitations_responded,
+            'response_rate': round(invitations_responded / invitations, 4) if invitations else 0,
+        }
+        cache.set(GUEST_STATS_CACHE_KEY, stats, timeout=settings.GUEST_STATS_CACHE_TIMEOUT)
+
+        return stats
+
+    @staticmethod
+    def invalidate_stats_cache():
+        """ Remove the cached RSVP stats """
+        cache.delete(GUEST_STATS_CACHE_KEY)
+
+    @staticmethod
+    def get_guest_list():
+        """
+        Yield a dict for each guest, with their invitation details and attending status, for exporting the guest list
+        The rows are fetched with a single joined values() query and streamed in chunks, so memory use stays flat
+        """
+        guests = Guest.objects.with_attending_status().order_by('invitation__name', 'invitation_id', 'id').values(
+            'name', 'party_only', 'wedding', 'party', 'invitation__name', 'invitation__code',
+            'annotated_attending_status',
+        )
+        for guest in guests.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            yield {
+                'invitation': guest['invitation__name'],
+                'code': guest['invitation__code'],
+                'name': guest['name'],
+                'party_only': guest['party_only'],
+                'wedding': guest['wedding'],
+                'party': guest['party'],
+                'attending_status': guest['annotated_attending_status'],
+            }
+
 
     def __str__(self):
         return f'{self.name} - {self.attending_status}'
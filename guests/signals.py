@@ -0,0 +1,22 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Invitation, Guest
+
+
+@receiver((post_save, post_delete), sender=Invitation)
+def invalidate_invitation_cache(sender, instance, **kwargs):
+    """ Remove the cached invitation data and RSVP stats when an invitation is saved or deleted """
+    instance.invalidate_invitation_cache(code=instance.code)
+    Guest.invalidate_stats_cache()
+
+
+@receiver((post_save, post_delete), sender=Guest)
+def invalidate_guest_invitation_cache(sender, instance, **kwargs):
+    """ Remove the cached data for the guest's invitation, and the RSVP stats, when a guest is saved or deleted """
+    if Guest.invitation.is_cached(instance):
+        code = instance.invitation.code
+    else:
+        code = Invitation.objects.filter(pk=instance.invitation_id).values_list('code', flat=True).first()
+    Invitation.invalidate_invitation_cache(code=code)
+    Guest.invalidate_stats_cache()
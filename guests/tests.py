@@ -1,10 +1,24 @@
-from django.conf import settings
-from django.test import TestCase
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest.mock import patch
 
-from data.seed_tests import seed_invitations
-from .models import Invitation
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from data.seed_tests import seed_invitations, seed_guests
+from .models import Invitation, Guest
 from .forms import InvitationForm, GuestForm
-from api.serializers import GuestSerializer
+from api.serializers import GuestSerializer, InvitationSerializer
+from utils.helpers import get_cache_stats
 
 
 #                                              -- FORM TESTS --
@@ -119,6 +133,53 @@ class InvitationTest(TestCase):
         """ Test we create an alphanumeric code """
         self.assertTrue(self.invitation_1.code.isalnum())
 
+    def test_save_code_taken_retries_with_new_code(self):
+        """ Confirm we retry with a new code if the generated code is already taken """
+        with patch('guests.models.generate_random_string', side_effect=[self.invitation_1.code, 'newcode123']):
+            invitation = Invitation.objects.create(name='Invitation 3')
+        self.assertEqual(invitation.code, 'newcode123')
+
+    def test_save_keeps_existing_code(self):
+        """ Confirm we don't generate a new code for an invitation that already has one """
+        code = self.invitation_1.code
+        self.invitation_1.save()
+        self.invitation_1.refresh_from_db()
+        self.assertEqual(self.invitation_1.code, code)
+
+    #                                                                                              generate_codes(count)
+    def test_generate_codes_returns_unique_unused_codes(self):
+        """ Confirm we return the requested number of distinct codes that aren't used by an invitation """
+        codes = self.temp_invitation.generate_codes(count=50)
+        self.assertEqual(len(set(codes)), 50)
+        self.assertFalse(Invitation.objects.filter(code__in=codes).exists())
+
+    def test_generate_codes_skips_used_codes(self):
+        """ Confirm we don't return codes that are already used by an invitation """
+        with patch('guests.models.generate_random_strings', side_effect=[{self.invitation_1.code}, {'newcode123'}]):
+            codes = self.temp_invitation.generate_codes(count=1)
+        self.assertEqual(codes, ['newcode123'])
+
+    #                                                                        create_invitations(invitations, batch_size)
+    def test_create_invitations_creates_invitations_with_codes(self):
+        """ Confirm we create the invitations, each with a unique code """
+        invitations = self.temp_invitation.create_invitations(
+            invitations=[Invitation(name=f'Imported {i}') for i in range(25)],
+            batch_size=10,
+        )
+        self.assertEqual(len(invitations), 25)
+        codes = Invitation.objects.filter(name__startswith='Imported').values_list('code', flat=True)
+        self.assertEqual(len(set(codes)), 25)
+        for invitation in invitations:
+            self.assertIsNotNone(invitation.pk)
+
+    def test_create_invitations_query_count_per_batch(self):
+        """ Confirm we create each batch in a fixed number of queries, regardless of the batch size """
+        with CaptureQueriesContext(connection) as small_batch:
+            self.temp_invitation.create_invitations(invitations=[Invitation(name=f'Small {i}') for i in range(2)])
+        with CaptureQueriesContext(connection) as large_batch:
+            self.temp_invitation.create_invitations(invitations=[Invitation(name=f'Large {i}') for i in range(100)])
+        self.assertEqual(len(small_batch.captured_queries), len(large_batch.captured_queries))
+
     #                                                                                               get_invitation(code)
     def test_get_invitation_code_not_found_returns_none(self):
         """ Confirm we return None if an invitation with the specified code doesn't exist """
@@ -130,6 +191,48 @@ class InvitationTest(TestCase):
         invitation = self.invitation_1.get_invitation(code=self.invitation_1.code)
         self.assertEqual(invitation, self.invitation_1)
 
+    #                                                                                          get_invitation_data(code)
+    def test_get_invitation_data_code_not_found_returns_none(self):
+        """ Confirm we return None if an invitation with the specified code doesn't exist """
+        cache.clear()
+        self.assertIsNone(self.temp_invitation.get_invitation_data(code='notacode'))
+        # Confirm the negative entry is served from the cache
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.temp_invitation.get_invitation_data(code='notacode'))
+
+    def test_get_invitation_data_returns_serialized_invitation(self):
+        """ Confirm we return the serialized invitation data on success """
+        cache.clear()
+        invitation_data = self.temp_invitation.get_invitation_data(code=self.invitation_1.code)
+        self.assertEqual(invitation_data, InvitationSerializer(self.invitation_1).data)
+
+    def test_get_invitation_data_counts_hits_and_misses(self):
+        """ Confirm we count cache hits and misses """
+        cache.clear()
+        self.temp_invitation.get_invitation_data(code=self.invitation_1.code)
+        self.temp_invitation.get_invitation_data(code=self.invitation_1.code)
+        self.temp_invitation.get_invitation_data(code=self.invitation_1.code.upper())
+        self.assertEqual(get_cache_stats(name='invitation'), {'hits': 2, 'misses': 1})
+
+    def test_invitation_save_invalidates_cached_data(self):
+        """ Confirm saving an invitation removes its cached data """
+        cache.clear()
+        self.temp_invitation.get_invitation_data(code=self.invitation_1.code)
+        self.invitation_1.name = 'Updated Invitation'
+        self.invitation_1.save()
+        invitation_data = self.temp_invitation.get_invitation_data(code=self.invitation_1.code)
+        self.assertEqual(invitation_data.get('name', ''), 'Updated Invitation')
+
+    def test_guest_save_invalidates_cached_data(self):
+        """ Confirm saving a guest removes its invitation's cached data """
+        cache.clear()
+        self.temp_invitation.get_invitation_data(code=self.invitation_1.code)
+        guest = Guest.objects.get(pk=self.invitation_1_guest.pk)
+        guest.name = 'Updated Guest'
+        guest.save()
+        invitation_data = self.temp_invitation.get_invitation_data(code=self.invitation_1.code)
+        self.assertIn('Updated Guest', [guest.get('name', '') for guest in invitation_data.get('guests', [])])
+
     #                                                                             get_invitation_guest(self, guest_uuid)
     def test_get_invitation_guest_not_found_returns_none(self):
         """ Confirm we return None if a guest with the specified guest_uuid doesn't exist """
@@ -184,6 +287,48 @@ class InvitationTest(TestCase):
         self.assertFalse(success)
         self.assertEqual(error, 'Sorry, we were unable to update the details for some guests, please try again')
 
+    def test_process_invitation_invalid_guest_does_not_update_any_guests(self):
+        """ Confirm we don't update any guests or the invitation if one of the guests is invalid """
+        invalid_guest = {
+            'guest_uuid': str(self.invitation_2_guest.guest_uuid),
+            'name': 'Obi-Wan Kenobi',
+            'wedding': True,
+            'party': True,
+        }
+        self.data['guests'].append(invalid_guest)
+        self.invitation_1.process_invitation_response(data=self.data)
+        for guest in Invitation.objects.get(pk=self.invitation_1.pk).guests.all():
+            self.assertNotIn(guest.name, ['Darth Vader', 'Obi-Wan Kenobi'])
+            self.assertFalse(guest.wedding)
+        self.assertFalse(Invitation.objects.get(pk=self.invitation_1.pk).responded)
+
+    def test_process_invitation_responded_since_fetched_returns_error(self):
+        """ Confirm we return an error if the invitation was responded to after it was fetched """
+        Invitation.objects.filter(pk=self.invitation_1.pk).update(responded=True)
+        success, error = self.invitation_1.process_invitation_response(data=self.data)
+        self.assertFalse(success)
+        self.assertEqual(error, 'It looks like you\'ve already responded to this invitation')
+        self.assertFalse(self.invitation_1.guests.filter(name='Darth Vader').exists())
+
+    def test_process_invitation_query_count_independent_of_party_size(self):
+        """ Confirm the number of queries doesn't grow with the number of guests """
+        seed_guests(invitation=self.invitation_2, guests_count=8)
+        query_counts = []
+        for invitation in (self.invitation_1, self.invitation_2):
+            invitation = invitation.get_invitation(code=invitation.code)
+            data = {
+                'invitation': {'responded': True},
+                'guests': [
+                    {'guest_uuid': str(guest.guest_uuid), 'name': guest.name, 'wedding': True, 'party': True}
+                    for guest in invitation.guests.all()
+                ],
+            }
+            with CaptureQueriesContext(connection) as context:
+                success, error = invitation.process_invitation_response(data=data)
+            self.assertTrue(success)
+            query_counts.append(len(context.captured_queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
     def test_process_invitation_success_updates_guests(self):
         """ Confirm we update the invitation's guests on success """
         self.invitation_1.process_invitation_response(data=self.data)
@@ -262,3 +407,302 @@ class GuestTest(TestCase):
         self.guest_1.party = False
         self.guest_1.save()
         self.assertEqual(self.guest_1.attending_status, 'No')
+
+
+class GuestQuerySetTest(TestCase):
+    """ Test module for GuestQuerySet """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        invitations = seed_invitations(invitation_count=2)
+        cls.pending_invitation = invitations.last()
+        cls.invitation = invitations.first()
+        cls.invitation.responded = True
+        cls.invitation.save()
+        guests = cls.invitation.guests.all()
+        seed_guests(invitation=cls.invitation, guests_count=2)
+        # One guest for each responded attending status
+        for guest, (wedding, party) in zip(guests, ((True, True), (True, False), (False, True), (False, False))):
+            guest.wedding, guest.party = wedding, party
+            guest.save()
+
+    #                                                                                     with_attending_status(self)
+    def test_with_attending_status_matches_property(self):
+        """ Confirm the annotated attending status matches the attending_status property for every guest """
+        for guest in Guest.objects.with_attending_status():
+            expected = Guest.objects.get(pk=guest.pk).attending_status
+            self.assertEqual(guest.annotated_attending_status, expected)
+
+    def test_with_attending_status_covers_all_statuses(self):
+        """ Confirm we annotate every attending status """
+        statuses = set(Guest.objects.with_attending_status().values_list('annotated_attending_status', flat=True))
+        self.assertEqual(statuses, {'Pending', 'Both', 'Wedding only', 'Party only', 'No'})
+
+    def test_with_attending_status_property_does_not_query_invitation(self):
+        """ Confirm the attending_status property uses the annotation instead of loading the invitation """
+        guests = list(Guest.objects.with_attending_status())
+        with self.assertNumQueries(0):
+            for guest in guests:
+                guest.attending_status
+                str(guest)
+
+    def test_with_attending_status_filter(self):
+        """ Confirm we can filter on the annotated attending status in the DB """
+        guests = Guest.objects.with_attending_status().filter(annotated_attending_status='Pending')
+        self.assertQuerySetEqual(guests, self.pending_invitation.guests.all(), ordered=False)
+
+
+class GuestStatsTest(TestCase):
+    """ Test module for Guest.get_stats() """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        cls.temp_guest = Guest()
+        invitations = seed_invitations(invitation_count=3)
+        cls.invitation = invitations.first()
+        cls.invitation.responded = True
+        cls.invitation.save()
+        guests = cls.invitation.guests.all()
+        guests.filter(pk=guests.first().pk).update(wedding=True, party=True)
+        guests.filter(pk=guests.last().pk).update(party=True)
+        invitations.last().guests.update(party_only=True)
+        cls.pending_invitation = invitations[1]
+
+    def setUp(self):
+        """ Clear the cached stats between tests """
+        cache.clear()
+
+    def test_get_stats_returns_headcounts(self):
+        """ Confirm we return the guest headcounts by attending status """
+        stats = self.temp_guest.get_stats()
+        self.assertEqual(stats.get('guests'), 6)
+        self.assertEqual(
+            stats.get('attending_status'), {'Both': 1, 'Wedding only': 0, 'Party only': 1, 'No': 0, 'Pending': 4}
+        )
+        self.assertEqual(stats.get('wedding'), 1)
+        self.assertEqual(stats.get('party'), 2)
+        self.assertEqual(stats.get('invited'), {'wedding': 4, 'party_only': 2})
+
+    def test_get_stats_returns_invitation_counts(self):
+        """ Confirm we return the invitations pending and the response rate """
+        stats = self.temp_guest.get_stats()
+        self.assertEqual(stats.get('invitations'), 3)
+        self.assertEqual(stats.get('invitations_responded'), 1)
+        self.assertEqual(stats.get('invitations_pending'), 2)
+        self.assertEqual(stats.get('response_rate'), round(1 / 3, 4))
+
+    def test_get_stats_single_query_then_cached(self):
+        """ Confirm we compute the stats in a single query, and serve them from the cache afterwards """
+        with self.assertNumQueries(1):
+            self.temp_guest.get_stats()
+        with self.assertNumQueries(0):
+            self.temp_guest.get_stats()
+
+    def test_get_stats_invalidated_by_invitation_response(self):
+        """ Confirm we recompute the stats after an invitation is responded to """
+        self.temp_guest.get_stats()
+        invitation = Invitation.get_invitation(code=self.pending_invitation.code)
+        data = {
+            'invitation': {'responded': True},
+            'guests': [
+                {'guest_uuid': str(guest.guest_uuid), 'name': guest.name, 'wedding': True, 'party': False}
+                for guest in invitation.guests.all()
+            ],
+        }
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            invitation.process_invitation_response(data=data)
+        self.assertEqual(callbacks, [Guest.invalidate_stats_cache])
+        stats = self.temp_guest.get_stats()
+        self.assertEqual(stats.get('attending_status', {}).get('Wedding only'), 2)
+        self.assertEqual(stats.get('invitations_pending'), 1)
+
+    def test_get_stats_invalidated_by_guest_save(self):
+        """ Confirm we recompute the stats after a guest is added """
+        self.temp_guest.get_stats()
+        seed_guests(invitation=self.pending_invitation, guests_count=1)
+        self.assertEqual(self.temp_guest.get_stats().get('guests'), 7)
+
+
+class GuestAdminTest(TestCase):
+    """ Test module for GuestAdmin """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        invitations = seed_invitations(invitation_count=2)
+        cls.invitation = invitations.first()
+        cls.invitation.responded = True
+        cls.invitation.save()
+        cls.invitation.guests.update(wedding=True)
+        User = get_user_model()
+        cls.admin = User.objects.create(email='admin@admin.co.uk', username='admin@admin.co.uk')
+        cls.url = reverse('admin:guests_guest_changelist')
+
+    def setUp(self):
+        """ Log in as the admin """
+        self.client.force_login(self.admin)
+
+    def test_changelist_query_count_independent_of_guests(self):
+        """ Confirm the changelist doesn't query each guest's invitation """
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(self.url)
+        seed_invitations(invitation_count=10)
+        with self.assertNumQueries(len(context.captured_queries)):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_changelist_filter_by_attending_status(self):
+        """ Confirm we filter the changelist by attending status """
+        response = self.client.get(self.url, {'attending_status': 'wedding'})
+        self.assertQuerySetEqual(
+            response.context['cl'].queryset, self.invitation.guests.all(), ordered=False
+        )
+        response = self.client.get(self.url, {'attending_status': 'pending'})
+        self.assertEqual(response.context['cl'].queryset.count(), 2)
+
+    def test_changelist_sort_by_attending_status(self):
+        """ Confirm we can sort the changelist by attending status """
+        # Attending status is the 6th list_display column
+        response = self.client.get(self.url, {'o': '6'})
+        statuses = [guest.attending_status for guest in response.context['cl'].result_list]
+        self.assertEqual(statuses, sorted(statuses))
+
+
+#                                              -- COMMAND TESTS --
+class ExportGuestsCommandTest(TestCase):
+    """ Test module for export_guests management command """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        cls.invitation = seed_invitations(invitation_count=2).first()
+        cls.invitation.responded = True
+        cls.invitation.save()
+        cls.invitation.guests.update(wedding=True, party=True)
+
+    def test_export_csv(self):
+        """ Confirm we write a CSV row for each guest, with their invitation details and attending status """
+        stdout = StringIO()
+        call_command('export_guests', stdout=stdout)
+        lines = stdout.getvalue().strip().splitlines()
+        self.assertEqual(lines[0], 'invitation,code,name,party_only,wedding,party,attending_status')
+        self.assertEqual(len(lines), Guest.objects.count() + 1)
+        self.assertIn(f'Invitation 1,{self.invitation.code},Guest 1,False,True,True,Both', lines)
+        self.assertIn('Pending', lines[-1])
+
+    def test_export_json(self):
+        """ Confirm we write a JSON list of guests """
+        stdout = StringIO()
+        call_command('export_guests', format='json', stdout=stdout)
+        guests = json.loads(stdout.getvalue())
+        self.assertEqual(len(guests), Guest.objects.count())
+        self.assertEqual(guests[0].get('attending_status', ''), 'Both')
+        self.assertEqual(guests[0].get('code', ''), self.invitation.code)
+
+    def test_export_query_count(self):
+        """ Confirm we export the guest list in a single query """
+        with self.assertNumQueries(1):
+            call_command('export_guests', stdout=StringIO())
+
+
+class ImportGuestsCommandTest(TestCase):
+    """ Test module for import_guests management command """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        cls.rows = [
+            {'invitation': 'The Skywalkers', 'name': 'Luke Skywalker', 'party_only': 'false'},
+            {'invitation': 'The Skywalkers', 'name': 'Leia Organa', 'party_only': 'false'},
+            {'invitation': 'The Solos', 'name': 'Han Solo', 'party_only': 'true'},
+            {'invitation': 'Chewbacca', 'name': 'Chewbacca', 'party_only': ''},
+        ]
+
+    def write_file(self, extension, content):
+        """ Write the content to a temporary file, which is removed after the test """
+        file = tempfile.NamedTemporaryFile('w', suffix=f'.{extension}', delete=False, encoding='utf-8')
+        with file:
+            file.write(content)
+        self.addCleanup(os.remove, file.name)
+        return file.name
+
+    def write_csv(self, rows):
+        """ Write the rows to a temporary CSV file """
+        lines = ['invitation,name,party_only']
+        lines += [f'{row["invitation"]},{row["name"]},{row["party_only"]}' for row in rows]
+        return self.write_file(extension='csv', content='\n'.join(lines))
+
+    def test_import_csv_creates_invitations_and_guests(self):
+        """ Confirm we group the rows into invitations and create the guests for each """
+        call_command('import_guests', self.write_csv(self.rows), stdout=StringIO())
+        self.assertEqual(Invitation.objects.count(), 3)
+        self.assertEqual(Guest.objects.count(), 4)
+        skywalkers = Invitation.objects.get(name='The Skywalkers')
+        self.assertEqual(
+            sorted(skywalkers.guests.values_list('name', flat=True)), ['Leia Organa', 'Luke Skywalker']
+        )
+        self.assertTrue(Guest.objects.get(name='Han Solo').party_only)
+        self.assertFalse(Guest.objects.get(name='Chewbacca').party_only)
+
+    def test_import_creates_unique_codes(self):
+        """ Confirm we create a unique code for each invitation """
+        call_command('import_guests', self.write_csv(self.rows), chunk_size=2, stdout=StringIO())
+        codes = Invitation.objects.values_list('code', flat=True)
+        self.assertEqual(len(set(codes)), 3)
+        for code in codes:
+            self.assertTrue(code.isalnum())
+
+    def test_import_jsonl_creates_invitations_and_guests(self):
+        """ Confirm we import a JSONL guest list """
+        path = self.write_file(extension='jsonl', content='\n'.join(json.dumps(row) for row in self.rows))
+        call_command('import_guests', path, stdout=StringIO())
+        self.assertEqual(Invitation.objects.count(), 3)
+        self.assertEqual(Guest.objects.count(), 4)
+
+    def test_import_reports_throughput(self):
+        """ Confirm we report the number of invitations and guests created, and the throughput """
+        stdout = StringIO()
+        call_command('import_guests', self.write_csv(self.rows), stdout=stdout)
+        self.assertIn('Imported 3 invitations and 4 guests', stdout.getvalue())
+        self.assertIn('rows/s', stdout.getvalue())
+
+    @override_settings(CACHE_IS_SHARED=False, GUEST_STATS_CACHE_TIMEOUT=60)
+    def test_import_cache_not_shared_reports_stale_stats(self):
+        """ Confirm we report how long the stats may be out of date for, if the cache isn't shared """
+        stdout = StringIO()
+        call_command('import_guests', self.write_csv(self.rows), stdout=stdout)
+        self.assertIn('RSVP stats may be out of date for up to 60s', stdout.getvalue())
+        with override_settings(CACHE_IS_SHARED=True):
+            stdout = StringIO()
+            call_command('import_guests', self.write_csv(self.rows), stdout=stdout)
+        self.assertNotIn('out of date', stdout.getvalue())
+
+    def test_import_missing_name_raises_error(self):
+        """ Confirm we raise an error if a row doesn't have a guest name """
+        rows = self.rows + [{'invitation': 'The Solos', 'name': '', 'party_only': ''}]
+        with self.assertRaises(CommandError):
+            call_command('import_guests', self.write_csv(rows), stdout=StringIO())
+
+    def test_import_invalid_row_after_first_chunk_imports_nothing(self):
+        """ Confirm we validate the file first, so an invalid row after the first chunk doesn't import any rows """
+        rows = self.rows + [{'invitation': 'The Solos', 'name': '', 'party_only': ''}]
+        with self.assertRaisesMessage(CommandError, '(row 5)'):
+            call_command('import_guests', self.write_csv(rows), chunk_size=1, stdout=StringIO())
+        self.assertFalse(Invitation.objects.exists())
+        self.assertFalse(Guest.objects.exists())
+
+    def test_import_query_count_independent_of_rows(self):
+        """ Confirm we import a chunk in a fixed number of queries, regardless of the number of rows """
+        query_counts = []
+        for row_count in (10, 50):
+            rows = [
+                {'invitation': f'Invitation {row_count}-{i // 2}', 'name': f'Guest {i}', 'party_only': ''}
+                for i in range(row_count)
+            ]
+            path = self.write_csv(rows)
+            with CaptureQueriesContext(connection) as context:
+                call_command('import_guests', path, stdout=StringIO())
+            query_counts.append(len(context.captured_queries))
+        self.assertEqual(query_counts[0], query_counts[1])
@@ -1,15 +1,42 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.db import transaction
 from django.utils.safestring import mark_safe
 
 from .models import Picture
+from utils.helpers import run_in_background
+
+
+class PictureChangeList(ChangeList):
+    """ Custom ChangeList to only fetch the columns shown in the picture changelist """
+
+    def get_queryset(self, request, exclude_parameters=None):
+        queryset = super().get_queryset(request, exclude_parameters=exclude_parameters)
+        return queryset.only('id', 'file', 'renditions', 'hidden', 'created')
 
 
 # Register your models here.
 class PictureAdmin(admin.ModelAdmin):
     """ Custom PictureAdmin model to allow custom picture create and update functionality """
     model = Picture
-    list_display = ('get_name', 'get_link', 'get_thumbnail')
+    list_display = ('get_name', 'get_link', 'get_thumbnail', 'hidden', 'created')
+    list_filter = ('hidden',)
     readonly_fields = ('get_link', 'get_thumbnail',)
+    actions = ('hide_pictures', 'restore_pictures', 'delete_pictures')
+    # Large galleries are paged without counting every picture on each page
+    list_per_page = 100
+    show_full_result_count = False
+
+
+    def get_changelist(self, request, **kwargs):
+        return PictureChangeList
+
+
+    def get_actions(self, request):
+        """ Replace the default delete action, which deletes (and sends signals for) each picture one at a time """
+        actions = super().get_actions(request)
+        actions.pop('delete_selected', None)
+        return actions
 
 
     def get_name(self, obj):
@@ -23,7 +50,7 @@ class PictureAdmin(admin.ModelAdmin):
     def get_link(self, obj):
         """ Custom field to get the picture's URL - allow clicking it to open it in a new tab """
         if obj.file:
-            return f'<a href="{obj.file.url}" target="blank"/>{obj.file.name}</a>'
+            return f'<a href="{obj.get_url()}" target="blank"/>{obj.file.name}</a>'
         else:
             return 'No link'
     get_link.short_description = 'Link'
@@ -34,12 +61,41 @@ class PictureAdmin(admin.ModelAdmin):
     def get_thumbnail(self, obj):
         """ Custom field to get the picture's thumbnail """
         if obj.file:
-            return f'<img src="{obj.file.url}"  height="100px"/>'
+            return f'<img src="{obj.get_rendition_url(rendition="thumbnail")}"  height="100px"/>'
         else:
             return 'No image'
     get_thumbnail.short_description = 'Thumbnail'
     get_thumbnail.allow_tags = True
 
 
+    def hide_pictures(self, request, queryset):
+        """ Custom action to hide the selected pictures from the gallery, with a single update """
+        hidden = Picture.set_pictures_hidden(pictures=queryset, hidden=True)
+        self.message_user(request, f'Hid {hidden} pictures', messages.SUCCESS)
+    hide_pictures.short_description = 'Hide selected pictures'
+    hide_pictures.allowed_permissions = ('change',)
+
+
+    def restore_pictures(self, request, queryset):
+        """ Custom action to restore the selected hidden pictures to the gallery, with a single update """
+        restored = Picture.set_pictures_hidden(pictures=queryset, hidden=False)
+        self.message_user(request, f'Restored {restored} pictures', messages.SUCCESS)
+    restore_pictures.short_description = 'Restore selected pictures'
+    restore_pictures.allowed_permissions = ('change',)
+
+
+    def delete_pictures(self, request, queryset):
+        """
+        Custom action to delete the selected pictures in bulk - their files are deleted in batches in the background
+        once the pictures are deleted, and any that aren't are deleted by the reconcile_media command
+        """
+        with transaction.atomic():
+            deleted, names = Picture.delete_pictures(pictures=queryset)
+            transaction.on_commit(lambda: run_in_background(Picture.delete_stored_files, names=names))
+        self.message_user(request, f'Deleted {deleted} pictures', messages.SUCCESS)
+    delete_pictures.short_description = 'Delete selected pictures permanently'
+    delete_pictures.allowed_permissions = ('delete',)
+
+
 # Register models
 admin.site.register(Picture, PictureAdmin)
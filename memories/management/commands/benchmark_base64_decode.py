@@ -0,0 +1,105 @@
+import base64
+import json
+import os
+import resource
+import time
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.helpers import convert_base_64_string_to_file
+
+
+class Command(BaseCommand):
+    """
+    Benchmark the decoding of base 64 picture uploads (see convert_base_64_string_to_file) across a range of sizes,
+    reporting the time taken and peak memory of each - and of a plain split and b64decode, to compare against
+    Each decode runs in a forked process to measure its peak memory, so this only runs on Unix
+    Nothing is written to storage or the DB
+    """
+    help = 'Benchmark the decoding of base 64 picture uploads'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='100KB,1MB,5MB,20MB', help='Comma-separated decoded sizes, in KB or MB (e.g. 100KB,5MB)'
+        )
+        parser.add_argument('--repeat', type=int, default=3, help='Number of times to decode each size')
+
+    @staticmethod
+    def parse_size(size):
+        """ Parse a size in KB or MB (e.g. 100KB) to bytes """
+        size = size.strip().upper()
+        for unit, multiplier in (('KB', 1024), ('MB', 1024 * 1024)):
+            if size.endswith(unit):
+                return int(float(size[:-len(unit)]) * multiplier)
+        raise ValueError(f'Invalid size {size}')
+
+    @staticmethod
+    def split_and_decode(base64_string):
+        """ Decode a data URI by splitting it and decoding it in full, for comparison """
+        file_format, file_string = base64_string.split(';base64,')
+        return ContentFile(base64.b64decode(file_string), name='benchmark.jpg')
+
+    @staticmethod
+    def decode(base64_string, decoder):
+        """
+        Decode a data URI in a forked process, so its peak memory can be measured on its own - the child's max RSS
+        starts at its RSS when it's forked, which includes the data URI
+        Returns the time taken (s) and the peak memory (KB), or the error
+        """
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.perf_counter()
+                picture_file = decoder(base64_string)
+                picture_file.close()
+                result = {
+                    'elapsed': time.perf_counter() - start,
+                    'memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+                }
+            except Exception as error:
+                result = {'error': str(error)}
+            with os.fdopen(write_fd, 'w') as pipe:
+                json.dump(result, pipe)
+            os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as pipe:
+            result = json.load(pipe)
+        os.waitpid(pid, 0)
+
+        return result
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [self.parse_size(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma-separated list of sizes in KB or MB (e.g. 100KB,5MB)')
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+
+        decoders = {
+            'chunked': lambda base64_string: convert_base_64_string_to_file(base64_string, filename='benchmark.jpg'),
+            'split': self.split_and_decode,
+        }
+        # Warm up (e.g. load the MIME types) before forking, so it isn't measured for each decode
+        for decoder in decoders.values():
+            decoder(f'data:image/jpeg;base64,{base64.b64encode(b"warm-up").decode()}').close()
+
+        for size in sizes:
+            base64_string = f'data:image/jpeg;base64,{base64.b64encode(os.urandom(size)).decode()}'
+            for name, decoder in decoders.items():
+                results = [self.decode(base64_string, decoder) for _ in range(options['repeat'])]
+                errors = [result['error'] for result in results if 'error' in result]
+                if errors:
+                    raise CommandError(f'Unable to decode {size} bytes ({name}): {errors[0]}')
+
+                elapsed = sum(result['elapsed'] for result in results) / len(results)
+                # ru_maxrss is in KB on Linux
+                memory = max(result['memory'] for result in results) / 1024
+                self.stdout.write(
+                    f'{size / 1024:.0f}KB {name}: {elapsed * 1000:.1f}ms, {memory:.1f}MB peak memory'
+                )
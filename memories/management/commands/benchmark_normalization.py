@@ -0,0 +1,119 @@
+import json
+import os
+import resource
+import time
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+
+from PIL import Image
+
+from utils.helpers import normalize_image
+
+
+class Command(BaseCommand):
+    """
+    Benchmark the normalization of uploaded pictures (see Picture.normalize_picture_file) on a sample corpus - either
+    a directory of pictures, or generated phone-sized JPEGs - reporting throughput, bytes saved and memory per picture
+    Each picture is normalized in a forked process to measure its peak memory, so this only runs on Unix
+    Nothing is written to storage or the DB
+    """
+    help = 'Benchmark the normalization of uploaded pictures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Directory of sample pictures - defaults to generated pictures')
+        parser.add_argument('--count', type=int, default=20, help='Number of pictures to generate')
+        parser.add_argument('--size', default='4032x3024', help='Dimensions (px) of the generated pictures')
+        parser.add_argument('--max-dimension', type=int, default=settings.PICTURE_MAX_DIMENSION)
+        parser.add_argument('--quality', type=int, default=settings.PICTURE_QUALITY)
+
+    @staticmethod
+    def generate_corpus(count, size):
+        """ Generate JPEGs of a given size, with noise so they compress like photos rather than flat colour """
+        width, height = (int(dimension) for dimension in size.lower().split('x'))
+        for index in range(count):
+            buffer = BytesIO()
+            Image.effect_noise((width, height), 64 + index).convert('RGB').save(buffer, format='JPEG', quality=95)
+            yield f'generated-{index}.jpg', buffer.getvalue()
+
+    @staticmethod
+    def read_corpus(path):
+        """ Read every file in a directory """
+        for name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, name)
+            if os.path.isfile(file_path):
+                with open(file_path, 'rb') as file:
+                    yield name, file.read()
+
+    @staticmethod
+    def normalize(content, max_dimension, quality):
+        """
+        Normalize a picture in a forked process, so its peak memory can be measured on its own - the child's max RSS
+        starts at its RSS when it's forked
+        Returns the time taken (s), the normalized size (bytes) and the peak memory (KB), or the error
+        """
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                start = time.perf_counter()
+                normalized_file = normalize_image(
+                    image_file=ContentFile(content), max_dimension=max_dimension, quality=quality
+                )
+                result = {
+                    'elapsed': time.perf_counter() - start,
+                    'size': normalized_file.size if normalized_file else len(content),
+                    'memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+                }
+            except Exception as error:
+                result = {'error': str(error)}
+            with os.fdopen(write_fd, 'w') as pipe:
+                json.dump(result, pipe)
+            os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as pipe:
+            result = json.load(pipe)
+        os.waitpid(pid, 0)
+
+        return result
+
+    def handle(self, *args, **options):
+        if options['path'] and not os.path.isdir(options['path']):
+            raise CommandError(f'{options["path"]} is not a directory')
+        try:
+            corpus = list(
+                self.read_corpus(options['path']) if options['path']
+                else self.generate_corpus(options['count'], options['size'])
+            )
+        except ValueError:
+            raise CommandError('--size must be in the format <width>x<height>')
+
+        results = []
+        for name, content in corpus:
+            result = self.normalize(content, max_dimension=options['max_dimension'], quality=options['quality'])
+            if 'error' in result:
+                self.stderr.write(self.style.WARNING(f'Unable to normalize {name}: {result["error"]}'))
+                continue
+            results.append({**result, 'original_size': len(content)})
+
+        if not results:
+            raise CommandError('No pictures were normalized')
+
+        count = len(results)
+        elapsed = sum(result['elapsed'] for result in results)
+        bytes_before = sum(result['original_size'] for result in results)
+        bytes_after = sum(result['size'] for result in results)
+        # ru_maxrss is in KB on Linux
+        memory = [result['memory'] / 1024 for result in results]
+        self.stdout.write(
+            f'Pictures: {count}\n'
+            f'Throughput: {count / elapsed:.1f} pictures/s ({elapsed / count * 1000:.1f}ms per picture)\n'
+            f'Size: {bytes_before / count / 1024:.0f}KB -> {bytes_after / count / 1024:.0f}KB per picture '
+            f'({(1 - bytes_after / bytes_before) * 100:.0f}% saved)\n'
+            f'Memory: {sum(memory) / count:.1f}MB peak per picture (max {max(memory):.1f}MB)'
+        )
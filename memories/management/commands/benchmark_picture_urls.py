@@ -0,0 +1,72 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.serializers import PictureSerializer
+from data.constants import PICTURE_RENDITIONS, PICTURE_RENDITION_FORMATS
+from memories.models import Picture
+
+
+class Command(BaseCommand):
+    """
+    Benchmark the serialization of gallery pictures (with renditions) using the storage's url() for each file, and
+    using the storage's public URL base (see Picture.get_file_url)
+    Unsaved pictures are used, so nothing is read from the DB or storage
+    """
+    help = 'Benchmark picture URL generation'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000, help='Number of pictures to serialize')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of times to serialize the pictures')
+
+    @staticmethod
+    def create_pictures(count):
+        """ Create unsaved pictures, with the renditions of an uploaded picture """
+        pictures = []
+        for index in range(count):
+            name = f'memories/picture {index}-abcdefghij.jpg'
+            renditions = {
+                rendition: {
+                    'width': size,
+                    'height': size,
+                    'files': {
+                        image_format: Picture.get_rendition_name(name, rendition, image_format)
+                        for image_format in PICTURE_RENDITION_FORMATS
+                    },
+                } for rendition, size in PICTURE_RENDITIONS.items()
+            }
+            pictures.append(Picture(file=name, renditions=renditions))
+
+        return pictures
+
+    @staticmethod
+    def time_serialization(pictures, repeat):
+        """ Return the best time (s) taken to serialize the pictures """
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            PictureSerializer(pictures, many=True).data
+            timings.append(time.perf_counter() - start)
+
+        return min(timings)
+
+    def handle(self, *args, **options):
+        storage = Picture._meta.get_field('file').storage
+        if getattr(storage, 'public_url_base', None) is None:
+            raise CommandError('The file storage has no public URL base, so every URL is built by the storage')
+
+        pictures = self.create_pictures(options['count'])
+        fast = self.time_serialization(pictures, repeat=options['repeat'])
+        # A public URL base of None makes get_file_url fall back to the storage's url()
+        storage.public_url_base = None
+        try:
+            slow = self.time_serialization(pictures, repeat=options['repeat'])
+        finally:
+            del storage.public_url_base
+
+        per_thousand = 1000 / options['count'] * 1000
+        self.stdout.write(
+            f'Pictures: {options["count"]}\n'
+            f'storage.url(): {slow * per_thousand:.1f}ms per 1,000 pictures\n'
+            f'Public URL base: {fast * per_thousand:.1f}ms per 1,000 pictures ({slow / fast:.1f}x faster)'
+        )
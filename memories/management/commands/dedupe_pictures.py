@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+from memories.models import Picture, UploadJobPicture
+from utils.helpers import hash_file
+
+
+class Command(BaseCommand):
+    """
+    Collapse duplicate pictures - pictures with the same sha256 hash - keeping the oldest picture of each, preferring
+    visible pictures to hidden ones
+    Pictures uploaded before hashes were recorded are hashed first, by reading their files from storage concurrently
+    The duplicates' files are deleted from storage in batches once they're deleted
+    """
+    help = 'Delete duplicate pictures, keeping the oldest (visible) picture with each hash'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=settings.PICTURE_UPLOAD_WORKERS, help='Number of pictures to hash at once'
+        )
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of pictures to update per query')
+        parser.add_argument('--dry-run', action='store_true', help='Report the duplicates without deleting them')
+
+    @staticmethod
+    def hash_picture(picture):
+        """ Read a picture's file from storage and hash it """
+        with picture.file.storage.open(picture.file.name, 'rb') as picture_file:
+            return hash_file(file=picture_file)
+
+    def hash_pictures(self, workers, batch_size):
+        """ Record the hash of each picture without one """
+        pictures = Picture.objects.filter(sha256='').only('id', 'file').order_by('id')
+        hashed, last_id = 0, 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # Page on the id, as pictures that can't be read are left without a hash
+                batch = list(pictures.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                futures = [(picture, executor.submit(self.hash_picture, picture)) for picture in batch]
+                updated = []
+                for picture, future in futures:
+                    try:
+                        picture.sha256 = future.result()
+                    except Exception as error:
+                        self.stderr.write(self.style.WARNING(f'Unable to read {picture.file.name}: {error}'))
+                        continue
+                    updated.append(picture)
+
+                Picture.objects.bulk_update(updated, fields=('sha256',))
+                hashed += len(updated)
+
+        return hashed
+
+    def handle(self, *args, **options):
+        hashed = self.hash_pictures(workers=options['workers'], batch_size=options['batch_size'])
+        self.stderr.write(f'Hashed {hashed} pictures')
+
+        duplicate_hashes = list(
+            Picture.objects.exclude(sha256='').values('sha256').annotate(count=models.Count('id'))
+            .filter(count__gt=1).values_list('sha256', flat=True)
+        )
+        deleted = 0
+        for index in range(0, len(duplicate_hashes), options['batch_size']):
+            hashes = duplicate_hashes[index:index + options['batch_size']]
+            kept_pictures = Picture.get_pictures_by_hash(hashes=hashes, include_hidden=True)
+            kept_ids = [picture.id for picture in kept_pictures.values()]
+            duplicates = list(Picture.objects.filter(sha256__in=hashes).exclude(id__in=kept_ids).only('id', 'sha256'))
+            deleted += len(duplicates)
+            if options['dry_run']:
+                continue
+
+            with transaction.atomic():
+                # Point any upload job results at the picture that's kept, before the duplicates are deleted
+                for duplicate in duplicates:
+                    UploadJobPicture.objects.filter(picture=duplicate).update(picture=kept_pictures[duplicate.sha256])
+                count, names = Picture.delete_pictures(
+                    pictures=Picture.objects.filter(id__in=[duplicate.id for duplicate in duplicates])
+                )
+                transaction.on_commit(partial(Picture.delete_stored_files, names=names))
+
+        action = 'Found' if options['dry_run'] else 'Deleted'
+        self.stderr.write(self.style.SUCCESS(f'{action} {deleted} duplicates of {len(duplicate_hashes)} pictures'))
@@ -0,0 +1,55 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from memories.models import Picture
+
+
+class Command(BaseCommand):
+    """
+    Write a ZIP archive of the gallery's pictures to a file (or stdout) as it's streamed (see Picture.stream_archive),
+    so multi-GB galleries are archived in constant memory
+    The pictures are archived from oldest to newest - if the export fails, the created datetime of the last picture
+    archived is reported, so it can be resumed into a new archive with --start (which includes that picture again)
+    """
+    help = 'Export a ZIP archive of the gallery pictures'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', required=True, help='Path of the ZIP file to write, or - for stdout')
+        parser.add_argument('--start', default='', help='Archive pictures created from this ISO date or datetime')
+        parser.add_argument('--end', default='', help='Archive pictures created before this ISO date or datetime')
+        parser.add_argument('--include-hidden', action='store_true', help='Include pictures hidden from the gallery')
+        parser.add_argument('--workers', type=int, default=None, help='Number of pictures to prefetch at once')
+
+    def handle(self, *args, **options):
+        if options['workers'] is not None and options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+
+        pictures, error = Picture.get_archive_pictures(
+            start=options['start'], end=options['end'], include_hidden=options['include_hidden']
+        )
+        if error:
+            raise CommandError(error)
+
+        progress = {'count': 0, 'created': None}
+
+        def on_archived(picture):
+            progress['count'] += 1
+            progress['created'] = picture.created
+
+        to_stdout = options['output'] == '-'
+        output = sys.stdout.buffer if to_stdout else open(options['output'], 'wb')
+        try:
+            for chunk in Picture.stream_archive(pictures=pictures, workers=options['workers'], on_archived=on_archived):
+                output.write(chunk)
+        except Exception as error:
+            resume = ''
+            if progress['created']:
+                resume = f' - resume with --start {timezone.localtime(progress["created"]).isoformat()}'
+            raise CommandError(f'Export failed after {progress["count"]} pictures ({error}){resume}')
+        finally:
+            if not to_stdout:
+                output.close()
+
+        self.stderr.write(self.style.SUCCESS(f'Exported {progress["count"]} pictures to {options["output"]}'))
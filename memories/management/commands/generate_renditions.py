@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from memories.models import Picture
+
+
+class Command(BaseCommand):
+    """
+    Generate the renditions of existing pictures - e.g. pictures uploaded before renditions were introduced
+    Pictures are processed in batches, with each batch's pictures read, resized and stored concurrently
+    """
+    help = 'Generate the thumbnail/medium/large renditions of existing pictures'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=settings.PICTURE_UPLOAD_WORKERS, help='Number of pictures to process at once'
+        )
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of pictures to update per query')
+        parser.add_argument('--force', action='store_true', help='Regenerate the renditions of every picture')
+
+    @staticmethod
+    def create_renditions(picture):
+        """ Read a picture's file from storage and create its renditions """
+        with picture.file.storage.open(picture.file.name, 'rb') as picture_file:
+            return Picture.store_renditions(name=picture.file.name, picture_file=picture_file)
+
+    def handle(self, *args, **options):
+        pictures = Picture.objects.all() if options['force'] else Picture.objects.filter(renditions={})
+        pictures = pictures.order_by('id')
+        processed, failed, last_id = 0, 0, 0
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            while True:
+                # Page on the id, as pictures that can't be processed are left without renditions
+                batch = list(pictures.filter(id__gt=last_id)[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                futures = [(picture, executor.submit(self.create_renditions, picture)) for picture in batch]
+                updated, now = [], timezone.now()
+                for picture, future in futures:
+                    try:
+                        picture.renditions = future.result()
+                    except Exception as error:
+                        self.stderr.write(self.style.WARNING(f'Unable to process {picture.file.name}: {error}'))
+                        picture.renditions = {}
+                    if not picture.renditions:
+                        failed += 1
+                        continue
+                    # Update modified so the gallery's ETag changes
+                    picture.modified = now
+                    updated.append(picture)
+
+                Picture.objects.bulk_update(updated, fields=('renditions', 'modified'))
+                # bulk_update doesn't send post_save signals
+                Picture.update_gallery_manifest(pictures=updated)
+                processed += len(updated)
+                self.stderr.write(f'Processed {processed} pictures')
+
+        self.stderr.write(self.style.SUCCESS(f'Generated renditions for {processed} pictures ({failed} failed)'))
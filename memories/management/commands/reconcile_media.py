@@ -0,0 +1,124 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from memories.models import Picture
+
+
+class Command(BaseCommand):
+    """
+    Reconcile the media storage with the DB - delete orphaned files (files that no picture references, e.g. the files
+    of deleted pictures, which aren't deleted on the request path, or of failed uploads) and, with --check-missing,
+    report files that pictures reference but that are missing from storage
+    The storage is listed a page at a time, the pictures referencing each page's files are looked up with a single
+    query, and each page's orphans are deleted in a batch (see custom_storages) - so memory use doesn't grow with the
+    number of files
+    Files newer than --min-age are never deleted, as they may belong to an upload that hasn't been saved yet
+    Run it on a schedule, e.g. daily - more than one run at once is safe, but wasteful
+    """
+    help = 'Delete orphaned media files, and optionally report files missing from storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', default='memories/', help='Storage prefix (directory) to reconcile')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000, help='Number of files to reconcile, and pictures to read, at once'
+        )
+        parser.add_argument(
+            '--min-age', type=int, default=settings.MEDIA_RECONCILE_MIN_AGE,
+            help='Min age (seconds) of the orphaned files to delete',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Report the orphaned files without deleting them')
+        parser.add_argument(
+            '--check-missing', action='store_true',
+            help='Report files missing from storage - checks each of the pictures\' files with a request',
+        )
+
+    @staticmethod
+    def get_missing_names(storage, prefix, batch_size):
+        """
+        Yield the storage names of the pictures' files and renditions (under the prefix) that aren't in storage,
+        reading the pictures in batches - each name is checked with its own request (a HEAD request on S3)
+        """
+        pictures = Picture.objects.filter(file__startswith=prefix).only('id', 'file', 'renditions').order_by('id')
+        for picture in pictures.iterator(chunk_size=batch_size):
+            for name in picture.get_stored_names():
+                if name.startswith(prefix) and not storage.exists(name):
+                    yield name
+
+    def delete_orphans(self, storage, names):
+        """ Delete a batch of orphaned files, returning the number deleted """
+        failed_names = storage.delete_many(names)
+        for name in failed_names:
+            self.stderr.write(self.style.WARNING(f'Unable to delete {name}'))
+
+        return len(names) - len(failed_names)
+
+    @staticmethod
+    def list_pages(storage, prefix, page_size):
+        """ Yield the files under a prefix (see custom_storages list_files) in pages of up to page_size files """
+        page = []
+        for file in storage.list_files(prefix):
+            page.append(file)
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def reconcile_page(self, files, cutoff, verbosity):
+        """
+        Find the orphaned files in a page of the storage listing, looking up the pictures that reference the page's
+        files with a single query (see Picture.get_referenced_names) - returns the number of referenced and recent
+        files, and the orphaned files
+        """
+        referenced_names = Picture.get_referenced_names(names=[file['name'] for file in files])
+        recent, orphaned_files = 0, []
+        for file in files:
+            if file['name'] in referenced_names:
+                continue
+            # Pictures are saved after their files, so a file saved for an upload that hasn't been saved yet is kept
+            if file['modified'] > cutoff:
+                recent += 1
+                continue
+
+            orphaned_files.append(file)
+            if verbosity > 1:
+                self.stdout.write(f'Orphaned: {file["name"]}')
+
+        return len(referenced_names), recent, orphaned_files
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        storage = Picture._meta.get_field('file').storage
+        cutoff = timezone.now() - timedelta(seconds=options['min_age'])
+
+        listed = referenced = recent = orphaned = orphaned_size = deleted = 0
+        for files in self.list_pages(storage, prefix=options['prefix'], page_size=options['batch_size']):
+            page_referenced, page_recent, orphaned_files = self.reconcile_page(
+                files, cutoff=cutoff, verbosity=options['verbosity']
+            )
+            listed += len(files)
+            referenced += page_referenced
+            recent += page_recent
+            orphaned += len(orphaned_files)
+            orphaned_size += sum(file['size'] for file in orphaned_files)
+            if orphaned_files and not options['dry_run']:
+                deleted += self.delete_orphans(storage, [file['name'] for file in orphaned_files])
+
+        action = 'would be deleted' if options['dry_run'] else f'{deleted} deleted'
+        self.stdout.write(
+            f'Files: {listed} listed, {referenced} referenced by pictures\n'
+            f'Orphaned: {orphaned} files ({orphaned_size / 1024 / 1024:.1f}MB), {action} - '
+            f'{recent} newer files kept'
+        )
+
+        if options['check_missing']:
+            missing = 0
+            for name in self.get_missing_names(storage, prefix=options['prefix'], batch_size=options['batch_size']):
+                missing += 1
+                self.stderr.write(self.style.WARNING(f'Missing: {name}'))
+            self.stdout.write(f'Missing: {missing} files referenced by pictures')
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from memories.models import UploadJobPicture
+
+
+class Command(BaseCommand):
+    """
+    Process the pictures staged by asynchronous uploads - decode, validate and store them, and record each result
+    The queue is the UploadJobPicture table, so no external broker is needed, and several workers can run at once
+    """
+    help = 'Process the asynchronous picture upload queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10, help='Number of pictures to claim at a time')
+        parser.add_argument(
+            '--poll-interval', type=float, default=5, help='Seconds to wait before checking an empty queue again'
+        )
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        processed = 0
+        while True:
+            job_pictures = UploadJobPicture.claim_pictures(batch_size=options['batch_size'])
+            if job_pictures:
+                UploadJobPicture.process_pictures(job_pictures=job_pictures)
+                processed += len(job_pictures)
+                self.stderr.write(f'Processed {processed} pictures')
+            elif options['once']:
+                break
+            else:
+                time.sleep(options['poll_interval'])
+
+        self.stderr.write(self.style.SUCCESS(f'Processed {processed} pictures'))
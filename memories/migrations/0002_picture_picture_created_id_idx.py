@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 02:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memories', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='picture',
+            index=models.Index(fields=['created', 'id'], name='picture_created_id_idx'),
+        ),
+    ]
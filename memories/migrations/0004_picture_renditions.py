@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 02:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memories', '0003_upload_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='picture',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
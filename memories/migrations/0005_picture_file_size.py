@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 02:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memories', '0004_picture_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='picture',
+            name='file_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='picture',
+            name='original_file_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
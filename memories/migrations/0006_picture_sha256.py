@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 02:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memories', '0005_picture_file_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='picture',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.1.4 on 2026-10-18 02:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memories', '0006_picture_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='picture',
+            name='hidden',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='picture',
+            index=models.Index(fields=['hidden', 'created', 'id'], name='picture_hidden_created_id_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='picture',
+            name='picture_created_id_idx',
+        ),
+    ]
@@ -1,50 +1,1053 @@
+import logging
+import mimetypes
+import os
+import threading
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import chain
 
-from django.db import models
+from django.db import models, connection, transaction, DatabaseError
 from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.uploadedfile import UploadedFile, SimpleUploadedFile
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.encoding import filepath_to_uri
 
 from model_utils.models import TimeStampedModel
+from django_cleanup import cleanup
 
-from utils.helpers import generate_random_string, convert_base_64_string_to_file
+from data.constants import (
+    PICTURE_RENDITIONS, PICTURE_RENDITION_FORMATS, PRESIGNED_UPLOAD_SALT, GALLERY_MANIFEST_CACHE_KEY,
+    GALLERY_MANIFEST_ENTRIES_CACHE_KEY, GALLERY_MANIFEST_LOCK_KEY, GALLERY_MANIFEST_STALE_KEY,
+    UPLOAD_RATE_LIMIT_CACHE_KEY, UPLOAD_ERRORS,
+)
+from utils.helpers import (
+    generate_random_string, convert_base_64_string_to_file, generate_etag, encode_cursor, decode_cursor,
+    create_image_renditions, normalize_image, hash_file, generate_content_etag, take_rate_limit_tokens,
+    get_base_64_decoded_size, stream_zip, parse_datetime_param, check_image_mime_type, identify_image,
+)
+
+
+logger = logging.getLogger(__name__)
+# Set while pictures are deleted in bulk (see Picture.delete_pictures), so the post_delete receivers leave the gallery
+# manifest to be updated once, rather than for each picture
+bulk_deletes = threading.local()
 
 
 # Create your models here.
+# Files aren't deleted by django_cleanup on the request path - deleted and replaced files are deleted by the
+# reconcile_media command
+@cleanup.ignore
 class Picture(TimeStampedModel):
     """
     Picture model to allow uploading a picture
     """
     picture_uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     file = models.ImageField(upload_to='memories/', blank=False)
+    # {rendition: {'width', 'height', 'files': {format: stored name}}} - see store_renditions
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+    # The size (bytes) of the picture as uploaded, and as stored after normalize_picture_file
+    original_file_size = models.PositiveBigIntegerField(blank=True, null=True, editable=False)
+    file_size = models.PositiveBigIntegerField(blank=True, null=True, editable=False)
+    # The sha256 hex digest of the picture as uploaded, so a picture that is uploaded again isn't stored again
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    # Hidden pictures (see set_pictures_hidden) are kept, but left out of the gallery
+    hidden = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Supports filtering out hidden pictures, and ordering and cursor pagination of the gallery
+            models.Index(fields=('hidden', 'created', 'id'), name='picture_hidden_created_id_idx'),
+        ]
 
     @staticmethod
     def get_pictures():
-        """ Return all Picture instances, ordered by oldest to newest """
-        return Picture.objects.all().order_by('created')
+        """ Return all Picture instances in the gallery (not hidden), ordered by oldest to newest """
+        return Picture.objects.filter(hidden=False).order_by('created', 'id')
 
     @staticmethod
-    def create_pictures(picture_files):
-        """ Create Picture instances from a list of picture files """
-        pictures, picture_uuids, has_errors, error = [], [], False, 'Please upload at least one picture'
+    def get_pictures_page(cursor='', page_size=None):
+        """
+        Return a page of Picture instances, ordered by oldest to newest, with the cursors for the next/previous pages
+        Pages are keyed on (created, id) rather than an offset, so every page is a single indexed range query
+        """
+        page_size = page_size or settings.GALLERY_PAGE_SIZE
+        page, error = {'pictures': [], 'next': None, 'previous': None}, 'Sorry, that page isn\'t valid'
+
+        direction, created, picture_id = 'next', None, None
+        if cursor:
+            try:
+                direction, created, picture_id = decode_cursor(cursor)
+                created, picture_id = parse_datetime(created), int(picture_id)
+            except (ValueError, TypeError):
+                return page, error
+            if direction not in ('next', 'previous') or not created:
+                return page, error
+
+        pictures = Picture.objects.filter(hidden=False)
+        if direction == 'next':
+            if cursor:
+                after = models.Q(created__gt=created) | models.Q(created=created, id__gt=picture_id)
+                pictures = pictures.filter(after)
+            pictures = list(pictures.order_by('created', 'id')[:page_size + 1])
+            has_more = len(pictures) > page_size
+            pictures = pictures[:page_size]
+            has_next, has_previous = has_more, bool(cursor)
+        else:
+            before = models.Q(created__lt=created) | models.Q(created=created, id__lt=picture_id)
+            pictures = list(pictures.filter(before).order_by('-created', '-id')[:page_size + 1])
+            has_more = len(pictures) > page_size
+            pictures = pictures[:page_size][::-1]
+            has_next, has_previous = True, has_more
+
+        page['pictures'] = pictures
+        if pictures and has_next:
+            page['next'] = encode_cursor(('next', pictures[-1].created.isoformat(), pictures[-1].id))
+        if pictures and has_previous:
+            page['previous'] = encode_cursor(('previous', pictures[0].created.isoformat(), pictures[0].id))
+
+        return page, ''
+
+    @staticmethod
+    def get_gallery_version():
+        """ Get the number of pictures in the gallery, and their latest modified date, with a single aggregate query """
+        return Picture.objects.filter(hidden=False).aggregate(
+            count=models.Count('id'), last_modified=models.Max('modified')
+        )
+
+    @staticmethod
+    def get_pictures_version():
+        """
+        Get the ETag and last modified date of the gallery (see get_gallery_version), for conditional requests
+        The count is included in the ETag so deleting (or hiding) a picture changes it, even though the max modified
+        date doesn't
+        """
+        version = Picture.get_gallery_version()
+        return generate_etag(version), version.get('last_modified')
+
+    @staticmethod
+    def encode_gallery_entries(pictures):
+        """ Encode each picture's gallery entry (see PictureSerializer) as JSON, keyed by picture_uuid """
+        # Imported here, as the serializers import this module
+        from rest_framework.renderers import JSONRenderer
+        from api.serializers import PictureSerializer
+
+        renderer = JSONRenderer()
+        return {
+            str(picture.picture_uuid): {
+                'order': (picture.created, picture.id),
+                'modified': picture.modified,
+                'content': renderer.render(PictureSerializer(picture).data),
+            } for picture in pictures
+        }
+
+    @staticmethod
+    def build_gallery_manifest(entries, last_modified=None):
+        """
+        Build the gallery manifest from encoded gallery entries - the pre-encoded JSON response for the whole gallery
+        (oldest to newest), its ETag and last modified date, and the gallery version it was built from (see
+        is_gallery_manifest_current)
+        """
+        ordered_entries = sorted(entries.values(), key=lambda entry: entry['order'])
+        content = b'{"success":true,"pictures":[' + b','.join(entry['content'] for entry in ordered_entries) + b']}'
+        modified = max((entry['modified'] for entry in ordered_entries), default=None)
+
+        return {
+            'content': content,
+            'etag': generate_content_etag(content=content),
+            'last_modified': max(filter(None, (modified, last_modified)), default=None),
+            'count': len(ordered_entries),
+            'modified': modified,
+        }
+
+    @staticmethod
+    def cache_gallery_manifest(entries, manifest):
+        """
+        Cache the gallery manifest and its entries under separate keys, so serving the manifest doesn't load every
+        entry - the entries are only needed to update it
+        """
+        cache.set_many(
+            {GALLERY_MANIFEST_CACHE_KEY: manifest, GALLERY_MANIFEST_ENTRIES_CACHE_KEY: entries},
+            timeout=settings.GALLERY_MANIFEST_CACHE_TIMEOUT,
+        )
+
+    @staticmethod
+    def is_gallery_manifest_current(manifest):
+        """
+        Check a gallery manifest against the gallery's version (see get_gallery_version) - any added, changed, hidden
+        or deleted picture changes the count or the latest modified date
+        """
+        version = Picture.get_gallery_version()
+        return (version['count'], version['last_modified']) == (manifest['count'], manifest['modified'])
+
+    @staticmethod
+    def get_gallery_manifest():
+        """
+        Get the gallery manifest (see build_gallery_manifest) from the cache, or build and cache it if it isn't cached
+        The manifest is updated as pictures are added and deleted (see update_gallery_manifest), rather than rebuilt
+        If the cache isn't shared by every process (see CACHE_IS_SHARED), pictures changed by other processes (e.g. the
+        run_upload_worker command) aren't in this process's manifest, so it's checked against the gallery's version
+        first, and rebuilt if it's out of date
+        """
+        manifest = cache.get(GALLERY_MANIFEST_CACHE_KEY)
+        if manifest is not None and not settings.CACHE_IS_SHARED and not Picture.is_gallery_manifest_current(manifest):
+            manifest = None
+        if manifest is None:
+            entries = Picture.encode_gallery_entries(Picture.get_pictures())
+            manifest = Picture.build_gallery_manifest(entries=entries)
+            Picture.cache_gallery_manifest(entries=entries, manifest=manifest)
+
+        return manifest
+
+    @staticmethod
+    def update_gallery_manifest(pictures=(), deleted_picture_uuids=()):
+        """
+        Add (or update) pictures in, and remove deleted (or hidden) pictures from, the cached gallery manifest
+        Updates are made under a lock - if another update holds it, the manifest is marked stale and dropped instead,
+        so it's rebuilt on the next request rather than missing either update
+        """
+        manifest_keys = [GALLERY_MANIFEST_CACHE_KEY, GALLERY_MANIFEST_ENTRIES_CACHE_KEY]
+        if not cache.add(GALLERY_MANIFEST_LOCK_KEY, True, timeout=30):
+            cache.set(GALLERY_MANIFEST_STALE_KEY, True, timeout=30)
+            cache.delete_many(manifest_keys)
+            return
+
+        try:
+            cached = cache.get_many(manifest_keys)
+            # There's nothing to update if the manifest isn't cached - it's built with the changes when it's next used
+            # (the manifest is dropped if its entries have been evicted, as it can't be updated without them)
+            if len(cached) < len(manifest_keys):
+                cache.delete_many(manifest_keys)
+                return
+            manifest = cached[GALLERY_MANIFEST_CACHE_KEY]
+
+            pictures = list(pictures)
+            removed_picture_uuids = [
+                *deleted_picture_uuids, *(picture.picture_uuid for picture in pictures if picture.hidden)
+            ]
+            entries = {
+                **cached[GALLERY_MANIFEST_ENTRIES_CACHE_KEY],
+                **Picture.encode_gallery_entries([picture for picture in pictures if not picture.hidden]),
+            }
+            for picture_uuid in removed_picture_uuids:
+                entries.pop(str(picture_uuid), None)
+            # A removed picture's modified date isn't in the manifest, so the time it was removed is used
+            last_modified = timezone.now() if removed_picture_uuids else manifest['last_modified']
+            manifest = Picture.build_gallery_manifest(entries=entries, last_modified=last_modified)
+            Picture.cache_gallery_manifest(entries=entries, manifest=manifest)
+
+            if cache.get(GALLERY_MANIFEST_STALE_KEY):
+                cache.delete_many(manifest_keys)
+        finally:
+            cache.delete_many([GALLERY_MANIFEST_LOCK_KEY, GALLERY_MANIFEST_STALE_KEY])
+
+    @staticmethod
+    def add_to_gallery_manifest(picture_uuids):
+        """
+        Add pictures to the gallery manifest once the transaction commits - for pictures created with bulk_create, which
+        doesn't send post_save signals (the pictures are fetched, as bulk_create may not set their ids)
+        """
+        transaction.on_commit(lambda: Picture.update_gallery_manifest(
+            pictures=Picture.objects.filter(picture_uuid__in=picture_uuids)
+        ))
+
+    @staticmethod
+    def set_pictures_hidden(pictures, hidden=True):
+        """
+        Hide pictures (a queryset) from the gallery, or restore hidden pictures, with a single update query
+        update() doesn't send signals or set the modified date, so the modified date is set here, and the gallery
+        manifest is updated once the transaction commits
+        Returns the number of pictures hidden or restored
+        """
+        pictures = pictures.exclude(hidden=hidden)
+        picture_uuids = list(pictures.values_list('picture_uuid', flat=True))
+        updated = Picture.objects.filter(picture_uuid__in=picture_uuids).update(hidden=hidden, modified=timezone.now())
+        if hidden:
+            transaction.on_commit(lambda: Picture.update_gallery_manifest(deleted_picture_uuids=picture_uuids))
+        else:
+            Picture.add_to_gallery_manifest(picture_uuids=picture_uuids)
+
+        return updated
+
+    @staticmethod
+    def delete_pictures(pictures):
+        """
+        Delete pictures (a queryset) in bulk, and remove them from the gallery manifest with a single update once the
+        transaction commits
+        Returns the number of pictures deleted, and the storage names of their files - which aren't deleted here (see
+        delete_stored_files, and the reconcile_media command)
+        """
+        pictures = list(pictures.only('id', 'picture_uuid', 'file', 'renditions'))
+        names = [name for picture in pictures for name in picture.get_stored_names()]
+        bulk_deletes.active = True
+        try:
+            deleted, deleted_by_model = Picture.objects.filter(id__in=[picture.id for picture in pictures]).delete()
+        finally:
+            bulk_deletes.active = False
+
+        picture_uuids = [picture.picture_uuid for picture in pictures]
+        transaction.on_commit(lambda: Picture.update_gallery_manifest(deleted_picture_uuids=picture_uuids))
+
+        return deleted_by_model.get(Picture._meta.label, 0), names
+
+    @staticmethod
+    def get_upload_filename(original_filename):
+        """ Append a random string to a picture's filename to make it unique, and prefix test files """
+        unique_string = generate_random_string()
+        ext = original_filename.split('.')[-1]
+        filename_without_ext = original_filename.replace(f'.{ext}', '')
+        filename = f'{filename_without_ext}-{unique_string}.{ext}'
+        if settings.TESTING:
+            filename = f'test/{filename}'
+
+        return filename
+
+    @staticmethod
+    def get_original_filename(picture):
+        """ Get the original filename of an uploaded picture (see get_picture_file) """
+        if isinstance(picture, UploadedFile):
+            return picture.name or 'new-file'
+
+        return picture.get('name', 'new-file') if isinstance(picture, dict) else ''
+
+    @staticmethod
+    def get_upload_size(picture):
+        """ Get the size (bytes) of an uploaded picture (see get_picture_file), without decoding it """
+        if isinstance(picture, UploadedFile):
+            return picture.size or 0
+
+        file = picture.get('fileSrc', '') if isinstance(picture, dict) else ''
+        return get_base_64_decoded_size(file) if isinstance(file, (str, bytes)) else 0
+
+    @staticmethod
+    def check_upload_count(picture_files):
+        """ Check the number of uploaded pictures against the upload limits, returning an error if it's over them """
         if not picture_files:
-            return pictures, error
+            return 'Please upload at least one picture'
+        if len(picture_files) > settings.PICTURE_UPLOAD_MAX_FILES:
+            return f'Please upload up to {settings.PICTURE_UPLOAD_MAX_FILES} pictures at a time'
 
-        for picture in picture_files:
+        return ''
+
+    @staticmethod
+    def check_upload_limits(picture_files):
+        """
+        Check a list of uploaded pictures (see get_picture_file) against the upload limits before any are decoded,
+        returning the size of each picture and an error if the request is over the limits - pictures over the max file
+        size are reported by upload_pictures, without failing the whole request
+        """
+        error = Picture.check_upload_count(picture_files=picture_files)
+        if error:
+            return [], error
+
+        sizes = [Picture.get_upload_size(picture=picture) for picture in picture_files]
+        total_size = sum(size for size in sizes if size <= settings.PICTURE_UPLOAD_MAX_FILE_SIZE)
+        if total_size > settings.PICTURE_UPLOAD_MAX_TOTAL_SIZE:
+            return [], 'Your pictures are too large to upload at once, please upload fewer pictures at a time'
+
+        return sizes, ''
+
+    @staticmethod
+    def take_upload_tokens(code, picture_count):
+        """
+        Take a token for each picture from the gallery code's upload rate limit (see take_rate_limit_tokens), returning
+        0 if the upload is allowed, else the number of seconds until it will be, or None if it's larger than the burst
+        """
+        return take_rate_limit_tokens(
+            key=UPLOAD_RATE_LIMIT_CACHE_KEY.format(code=code.lower()),
+            tokens=max(picture_count, 1),
+            rate=settings.PICTURE_UPLOAD_RATE_LIMIT / 60,
+            capacity=settings.PICTURE_UPLOAD_RATE_LIMIT_BURST,
+        )
+
+    @staticmethod
+    def set_result_error(result, error_code):
+        """ Set the error, and its code (see UPLOAD_ERRORS), of a picture's upload result """
+        result['error'], result['error_code'] = UPLOAD_ERRORS[error_code], error_code
+
+    @staticmethod
+    def get_picture_file(picture):
+        """
+        Get a Django-savable file, with a unique filename, for an uploaded picture - either a dict with a base 64
+        'fileSrc' string and a 'name' (JSON uploads), or an UploadedFile instance (multipart uploads) - with the sha256
+        hex digest of its content set
+        Raises ValueError if the picture's MIME type or extension isn't an image, or Pillow can't identify it
+        """
+        filename = Picture.get_upload_filename(original_filename=Picture.get_original_filename(picture=picture))
+        if isinstance(picture, UploadedFile):
+            # Files without a specific content type are checked by their extension
+            content_type = (picture.content_type or '').lower()
+            if content_type in ('', 'application/octet-stream'):
+                content_type = mimetypes.guess_type(filename)[0] or ''
+            check_image_mime_type(mime_type=content_type, filename=filename)
+            # Wrap the uploaded file, as UploadedFile strips the directory (for test files) from its name
+            picture_file = File(picture, name=filename)
+            # Multipart uploads are hashed as they're received (see HashingUploadHandlerMixin), other files (e.g.
+            # staged pictures) are hashed here
+            picture_file.sha256 = getattr(picture, 'sha256', None) or hash_file(file=picture)
+        else:
+            picture_file = convert_base_64_string_to_file(base64_string=picture.get('fileSrc', ''), filename=filename)
+
+        try:
+            identify_image(image_file=picture_file)
+        except ValueError:
+            picture_file.close()
+            raise
+
+        return picture_file
+
+    @staticmethod
+    def normalize_picture_file(picture_file):
+        """
+        Re-encode a picture file with its EXIF orientation applied, its metadata stripped and its size capped (see
+        normalize_image), returning the normalized file - or the file as uploaded if it can't be re-encoded
+        """
+        try:
+            normalized_file = normalize_image(
+                image_file=picture_file, max_dimension=settings.PICTURE_MAX_DIMENSION, quality=settings.PICTURE_QUALITY
+            )
+        except Exception:
+            # Pillow raises a range of errors for unreadable, truncated or oversized images
+            normalized_file = None
+
+        if not normalized_file:
+            return picture_file
+
+        normalized_file.name = picture_file.name
+        return normalized_file
+
+    @staticmethod
+    def get_pictures_by_hash(hashes, include_hidden=False):
+        """
+        Get a dict of the existing (oldest) Picture instance for each of a list of sha256 hashes
+        Hidden pictures are left out, so a picture that's uploaded again after it was hidden is added to the gallery -
+        or, with include_hidden, are only returned if there's no visible picture with the same hash
+        """
+        pictures = Picture.objects.filter(sha256__in=[sha256 for sha256 in hashes if sha256])
+        if not include_hidden:
+            pictures = pictures.filter(hidden=False)
+        pictures = pictures.order_by('-hidden', '-created', '-id')
+        # Later (visible, then older) pictures overwrite earlier (hidden, then newer) pictures with the same hash
+        return {picture.sha256: picture for picture in pictures}
+
+    @staticmethod
+    def store_picture_file(picture_file):
+        """ Save a picture file to the file field's storage, returning the stored name """
+        field = Picture._meta.get_field('file')
+        name = field.generate_filename(None, picture_file.name)
+        return field.storage.save(name, picture_file, max_length=field.max_length)
+
+    @staticmethod
+    def get_rendition_name(name, rendition, image_format):
+        """ Get the storage name of a rendition, next to the original (e.g. memories/picture-abc-thumbnail.webp) """
+        ext = 'jpg' if image_format == 'jpeg' else image_format
+        return f'{os.path.splitext(name)[0]}-{rendition}.{ext}'
+
+    @staticmethod
+    def store_renditions(name, picture_file):
+        """
+        Create the renditions (see PICTURE_RENDITIONS) of a stored picture file, and save them next to it in storage
+        Returns the renditions to record on the Picture, or an empty dict if the file isn't a readable image - the
+        original is served in place of any missing rendition
+        """
+        try:
+            images = create_image_renditions(
+                image_file=picture_file,
+                sizes=PICTURE_RENDITIONS,
+                formats=PICTURE_RENDITION_FORMATS,
+                quality=settings.PICTURE_RENDITION_QUALITY,
+            )
+        except Exception:
+            # Pillow raises a range of errors for unreadable, truncated or oversized images
+            return {}
+
+        storage = Picture._meta.get_field('file').storage
+        renditions = {}
+        for rendition, image in images.items():
+            renditions[rendition] = {
+                'width': image['width'],
+                'height': image['height'],
+                'files': {
+                    image_format: storage.save(Picture.get_rendition_name(name, rendition, image_format), file)
+                    for image_format, file in image['files'].items()
+                },
+            }
+
+        return renditions
+
+    @staticmethod
+    def store_picture(picture_file):
+        """
+        Normalize a picture file, and save it and its renditions to storage, returning the fields of its Picture
+        """
+        original_file_size = picture_file.size
+        picture_file = Picture.normalize_picture_file(picture_file=picture_file)
+        name = Picture.store_picture_file(picture_file=picture_file)
+        try:
+            return {
+                'file': name,
+                'renditions': Picture.store_renditions(name=name, picture_file=picture_file),
+                'original_file_size': original_file_size,
+                'file_size': picture_file.size,
+            }
+        except Exception:
+            Picture._meta.get_field('file').storage.delete(name)
+            raise
+
+    @staticmethod
+    def get_file_url(name):
+        """
+        Get the URL of a stored file - built from the storage's public URL base (see MediaStorage) where it has one, as
+        that's much faster than the storage's url() for a gallery of pictures, each with several renditions
+        """
+        storage = Picture._meta.get_field('file').storage
+        public_url_base = getattr(storage, 'public_url_base', None)
+        if public_url_base is None:
+            return storage.url(name)
+
+        return f'{public_url_base}{filepath_to_uri(name)}'
+
+    def get_url(self):
+        """ Get the URL of the picture's file (see get_file_url) """
+        return Picture.get_file_url(self.file.name)
+
+    def get_stored_names(self):
+        """ Get the storage names of the picture's file and all of its renditions """
+        rendition_names = [
+            name for rendition in self.renditions.values() for name in rendition.get('files', {}).values()
+        ]
+        return [self.file.name, *rendition_names]
+
+    @staticmethod
+    def get_referenced_names(names):
+        """
+        Get which of a list of storage names (e.g. a page of a storage listing) are referenced by a picture, as its
+        file or one of its renditions, with a single query
+        Renditions are named after their original (see get_rendition_name), so the pictures are looked up by the names
+        themselves and by the original name (without its extension) of each name that looks like a rendition
+        """
+        roots = set()
+        for name in names:
+            root = os.path.splitext(name)[0]
+            roots.update(
+                root[:-len(rendition) - 1] for rendition in PICTURE_RENDITIONS if root.endswith(f'-{rendition}')
+            )
+
+        query = models.Q(file__in=names)
+        for root in roots:
+            query |= models.Q(file__startswith=f'{root}.')
+        pictures = Picture.objects.filter(query).only('id', 'file', 'renditions')
+
+        return {name for picture in pictures for name in picture.get_stored_names()}.intersection(names)
+
+    def get_rendition_url(self, rendition, image_format='jpeg'):
+        """ Get the URL of one of the picture's renditions, or of the original if the rendition doesn't exist """
+        name = self.renditions.get(rendition, {}).get('files', {}).get(image_format)
+        return Picture.get_file_url(name) if name else self.get_url()
+
+    def get_srcset(self):
+        """ Get a srcset string (e.g. 'url 200w, url 800w') of the picture's renditions for each format """
+        renditions = sorted(self.renditions.values(), key=lambda rendition: rendition.get('width', 0))
+        srcset = {}
+        for image_format in PICTURE_RENDITION_FORMATS:
+            sources = [
+                f'{Picture.get_file_url(rendition["files"][image_format])} {rendition.get("width")}w'
+                for rendition in renditions if image_format in rendition.get('files', {})
+            ]
+            if sources:
+                srcset[image_format] = ', '.join(sources)
+
+        return srcset
+
+    @staticmethod
+    def delete_stored_files(names):
+        """
+        Delete files from the file field's storage in batches (see custom_storages), e.g. files orphaned by a failed DB
+        insert - returns the names of any files that couldn't be deleted
+        """
+        return Picture._meta.get_field('file').storage.delete_many(names)
+
+    @staticmethod
+    def get_archive_pictures(start='', end='', include_hidden=False):
+        """
+        Get the pictures to archive (see stream_archive), created from the start date or datetime (inclusive) to the end
+        (exclusive), ordered by oldest to newest - so an archive that fails part way can be resumed from the created
+        datetime of the last picture it archived
+        Returns the pictures and an error message if the dates are invalid
+        """
+        try:
+            start, end = parse_datetime_param(start), parse_datetime_param(end)
+        except ValueError:
+            return None, "Sorry, those dates aren't valid"
+
+        pictures = Picture.objects.only('id', 'file', 'created').order_by('created', 'id')
+        if not include_hidden:
+            pictures = pictures.filter(hidden=False)
+        if start:
+            pictures = pictures.filter(created__gte=start)
+        if end:
+            pictures = pictures.filter(created__lt=end)
+
+        return pictures, ''
+
+    @staticmethod
+    def read_archive_file(name, chunk_size):
+        """
+        Open a file to archive and read its first chunk (see stream_archive), returning the chunk and the rest of the
+        file's chunks - or None if the file can't be read
+        """
+        chunks = Picture._meta.get_field('file').storage.iter_chunks(name, chunk_size)
+        try:
+            return next(chunks, b''), chunks
+        except Exception:
+            logger.warning('Unable to read %s to archive', name, exc_info=True)
+            return None
+
+    @staticmethod
+    def stream_archive(pictures, workers=None, chunk_size=None, on_archived=None):
+        """
+        Yield a ZIP64 archive of the pictures' files as it's written (see stream_zip), reading each file from storage in
+        chunks - so multi-GB galleries are archived in constant memory, without the archive being held in memory or on
+        disk
+        The next few files are opened, and their first chunk read, in parallel on a bounded thread pool while the
+        current file is written, so the archive isn't slowed by a request's latency per file - at most workers + 1
+        chunks are held at once
+        Files that can't be read are left out, and on_archived (if set) is called with each picture once it's archived
+        """
+        workers = max(workers or settings.PICTURE_ARCHIVE_PREFETCH, 1)
+        chunk_size = chunk_size or settings.PICTURE_ARCHIVE_CHUNK_SIZE
+        executor = ThreadPoolExecutor(max_workers=workers)
+        prefetched = deque()
+
+        def iter_files():
+            for picture in pictures.iterator(chunk_size=1000):
+                prefetched.append((picture, executor.submit(Picture.read_archive_file, picture.file.name, chunk_size)))
+                if len(prefetched) > workers:
+                    yield from get_next_file()
+            while prefetched:
+                yield from get_next_file()
+
+        def get_next_file():
+            picture, future = prefetched.popleft()
+            file = future.result()
+            if file is None:
+                return
+            first_chunk, chunks = file
+            yield os.path.basename(picture.file.name), timezone.localtime(picture.created).timetuple()[:6], chain(
+                (first_chunk,), chunks
+            )
+            if on_archived:
+                on_archived(picture)
+
+        try:
+            yield from stream_zip(iter_files())
+        finally:
+            # Close any prefetched files if the archive is closed early (e.g. the client disconnects)
+            executor.shutdown(wait=True, cancel_futures=True)
+            for picture, future in prefetched:
+                if not future.cancelled() and future.result() is not None:
+                    future.result()[1].close()
+
+    @staticmethod
+    def upload_pictures(picture_files, check_limits=True):
+        """
+        Create Picture instances from a list of picture files (see get_picture_file), returning the created pictures and
+        the result (success or error) for each file
+        The files are normalized, and written to storage with their renditions, concurrently on a bounded thread pool,
+        then the Picture rows are inserted with a single bulk_create - if the insert fails, the stored files are deleted
+        so they aren't orphaned
+        Pictures that have been uploaded before, or more than once in the list, are matched by their sha256 hash and
+        only stored once - the existing Picture instance is returned for each repeat
+        Multipart uploads are streamed to temp files by Django's upload handlers, and decoded by Pillow at a reduced
+        size where possible, so large uploads are never held in memory in full
+        The upload limits are checked before any picture is decoded (see check_upload_limits) - staged pictures, which
+        were checked when their job was created, are only checked against the max file size (check_limits=False)
+        """
+        results = []
+        if check_limits:
+            sizes, error = Picture.check_upload_limits(picture_files=picture_files)
+            if error:
+                return [], results, error
+        else:
+            sizes = [Picture.get_upload_size(picture=picture) for picture in picture_files]
+
+        # Decode/prepare every file up front, so only valid files are sent to storage
+        picture_files_to_store = []
+        for picture, size in zip(picture_files, sizes):
+            result = {
+                'name': Picture.get_original_filename(picture=picture),
+                'success': False,
+                'picture_uuid': None,
+                'error': '',
+                'error_code': '',
+            }
+            results.append(result)
+            if size > settings.PICTURE_UPLOAD_MAX_FILE_SIZE:
+                Picture.set_result_error(result=result, error_code='too_large')
+                continue
             try:
-                unique_string = generate_random_string()
-                original_filename = picture.get('name', 'new-file')
-                ext = original_filename.split('.')[-1]
-                filename_without_ext = original_filename.replace(f'.{ext}', '')
-                filename = f'{filename_without_ext}-{unique_string}.{ext}'
-                file = picture.get('fileSrc', '')
-                if settings.TESTING:
-                    filename = f'test/{filename}'
-                picture_file = convert_base_64_string_to_file(base64_string=file, filename=filename)
-                new_picture = Picture.objects.create(file=picture_file)
-                picture_uuids.append(new_picture.picture_uuid)
-            except:
+                picture_file = Picture.get_picture_file(picture=picture)
+            except (ValueError, TypeError, AttributeError):
+                Picture.set_result_error(result=result, error_code='unreadable')
                 continue
+            picture_files_to_store.append((result, picture_file, picture_file.sha256))
+
+        # Skip the pictures that already exist, and repeats within the list - repeats get the first picture's result
+        existing_pictures = Picture.get_pictures_by_hash(hashes=[sha256 for *_, sha256 in picture_files_to_store])
+        first_results, repeat_results, unique_picture_files = {}, [], []
+        for result, picture_file, sha256 in picture_files_to_store:
+            if sha256 in existing_pictures:
+                result['success'], result['picture_uuid'] = True, str(existing_pictures[sha256].picture_uuid)
+            elif sha256 in first_results:
+                repeat_results.append((result, first_results[sha256]))
+            else:
+                first_results[sha256] = result
+                unique_picture_files.append((result, picture_file, sha256))
+
+        new_pictures = []
+        if unique_picture_files:
+            workers = min(settings.PICTURE_UPLOAD_WORKERS, len(unique_picture_files))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    (result, sha256, executor.submit(Picture.store_picture, picture_file))
+                    for result, picture_file, sha256 in unique_picture_files
+                ]
+                for result, sha256, future in futures:
+                    try:
+                        # Create the instances in order, so their created dates match the order of the files
+                        new_pictures.append((result, Picture(**future.result(), sha256=sha256)))
+                    except Exception:
+                        logger.exception('Unable to store picture %s', result['name'])
+                        Picture.set_result_error(result=result, error_code='upload_failed')
+
+        if new_pictures:
+            try:
+                with transaction.atomic():
+                    Picture.objects.bulk_create([picture for result, picture in new_pictures])
+            except DatabaseError:
+                logger.exception('Unable to insert %s pictures', len(new_pictures))
+                Picture.delete_stored_files(
+                    names=[name for result, picture in new_pictures for name in picture.get_stored_names()]
+                )
+                for result, picture in new_pictures:
+                    Picture.set_result_error(result=result, error_code='save_failed')
+            else:
+                for result, picture in new_pictures:
+                    result['success'], result['picture_uuid'] = True, str(picture.picture_uuid)
+                Picture.add_to_gallery_manifest(
+                    picture_uuids=[picture.picture_uuid for result, picture in new_pictures]
+                )
+
+        for result, first_result in repeat_results:
+            result.update({key: first_result[key] for key in ('success', 'picture_uuid', 'error', 'error_code')})
 
-        pictures = Picture.objects.filter(picture_uuid__in=picture_uuids).order_by('created')
+        picture_uuids = [result['picture_uuid'] for result in results if result['success']]
+        pictures = Picture.objects.filter(picture_uuid__in=picture_uuids).order_by('created', 'id')
 
-        error = 'We were unable to upload on or more of your pictures, please try again' if has_errors else ''
+        error = '' if picture_uuids else 'We were unable to upload on or more of your pictures, please try again'
+        return pictures, results, error
+
+    @staticmethod
+    def create_pictures(picture_files):
+        """ Create Picture instances from a list of picture files (see upload_pictures) """
+        pictures, results, error = Picture.upload_pictures(picture_files=picture_files)
         return pictures, error
+
+    @staticmethod
+    def create_presigned_uploads(picture_files, method='post'):
+        """
+        Generate a presigned upload for each of a list of picture files - dicts with a 'name' and a 'contentType' - so
+        the pictures can be uploaded straight to storage, without passing through the web server
+        Each upload has a signed token, to pass to confirm_presigned_uploads once the picture has been uploaded
+        """
+        error = Picture.check_upload_count(picture_files=picture_files)
+        if error:
+            return [], error
+
+        field = Picture._meta.get_field('file')
+        if not hasattr(field.storage, 'generate_presigned_upload'):
+            return [], 'Sorry, direct uploads aren\'t available'
+
+        uploads = []
+        for picture in picture_files:
+            name = Picture.get_original_filename(picture=picture)
+            content_type = picture.get('contentType', '') if isinstance(picture, dict) else ''
+            if not name or not str(content_type).startswith('image/'):
+                return [], 'Please only upload pictures'
+
+            key = field.generate_filename(None, Picture.get_upload_filename(original_filename=name))
+            upload = field.storage.generate_presigned_upload(
+                name=key,
+                content_type=content_type,
+                max_size=settings.PRESIGNED_UPLOAD_MAX_SIZE,
+                expires_in=settings.PRESIGNED_UPLOAD_EXPIRY,
+                method=method,
+            )
+            uploads.append({'name': name, 'token': signing.dumps(key, salt=PRESIGNED_UPLOAD_SALT), **upload})
+
+        return uploads, ''
+
+    @staticmethod
+    def get_presigned_upload_metadata(name):
+        """ Get the size and content type of a presigned upload, or None if it hasn't been uploaded """
+        return Picture._meta.get_field('file').storage.get_object_metadata(name)
+
+    @staticmethod
+    def confirm_presigned_uploads(tokens):
+        """
+        Create Picture instances for pictures uploaded with create_presigned_uploads, returning the created pictures
+        and the result (success or error) for each token
+        Each upload is checked with a HEAD request, concurrently, before its Picture row is inserted - the pictures'
+        renditions and hashes are added later by the generate_renditions and dedupe_pictures commands, as their bytes
+        never pass through the web server
+        """
+        results = []
+        if not tokens:
+            return [], results, 'Please upload at least one picture'
+
+        for token in tokens:
+            result = {'name': '', 'success': False, 'picture_uuid': None, 'error': '', 'error_code': ''}
+            results.append(result)
+            try:
+                # Allow the upload to finish just before its URL expires, then be confirmed
+                result['name'] = signing.loads(
+                    token, salt=PRESIGNED_UPLOAD_SALT, max_age=settings.PRESIGNED_UPLOAD_EXPIRY * 2
+                )
+            except (signing.BadSignature, TypeError):
+                Picture.set_result_error(result=result, error_code='invalid_upload')
+
+        # Uploads that have already been confirmed return the existing picture
+        names = {result['name'] for result in results if result['name']}
+        existing_pictures = {picture.file.name: picture for picture in Picture.objects.filter(file__in=names)}
+        new_names = sorted(names - set(existing_pictures))
+
+        new_pictures = {}
+        if new_names:
+            workers = min(settings.PICTURE_UPLOAD_WORKERS, len(new_names))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [(name, executor.submit(Picture.get_presigned_upload_metadata, name)) for name in new_names]
+                errors = {}
+                for name, future in futures:
+                    try:
+                        metadata = future.result()
+                    except Exception:
+                        logger.exception('Unable to check presigned upload %s', name)
+                        errors[name] = 'upload_failed'
+                        continue
+                    if not metadata:
+                        errors[name] = 'not_found'
+                    elif metadata['size'] > settings.PRESIGNED_UPLOAD_MAX_SIZE:
+                        errors[name] = 'too_large'
+                    else:
+                        new_pictures[name] = Picture(
+                            file=name, original_file_size=metadata['size'], file_size=metadata['size']
+                        )
+
+            if new_pictures:
+                try:
+                    with transaction.atomic():
+                        Picture.objects.bulk_create(new_pictures.values())
+                except DatabaseError:
+                    logger.exception('Unable to insert %s pictures', len(new_pictures))
+                    errors.update({name: 'save_failed' for name in new_pictures})
+                    new_pictures = {}
+                else:
+                    Picture.add_to_gallery_manifest(
+                        picture_uuids=[picture.picture_uuid for picture in new_pictures.values()]
+                    )
+
+            for result in results:
+                if result['name'] in errors:
+                    Picture.set_result_error(result=result, error_code=errors[result['name']])
+
+        for result in results:
+            picture = existing_pictures.get(result['name']) or new_pictures.get(result['name'])
+            if picture:
+                result['success'], result['picture_uuid'] = True, str(picture.picture_uuid)
+
+        picture_uuids = [result['picture_uuid'] for result in results if result['success']]
+        pictures = Picture.objects.filter(picture_uuid__in=picture_uuids).order_by('created', 'id')
+
+        error = '' if picture_uuids else 'We were unable to upload on or more of your pictures, please try again'
+        return pictures, results, error
+
+
+UPLOAD_JOB_PICTURE_STATUSES = (
+    ('pending', 'Pending'),
+    ('processing', 'Processing'),
+    ('complete', 'Complete'),
+    ('failed', 'Failed'),
+)
+
+
+class UploadJob(TimeStampedModel):
+    """
+    UploadJob model to allow uploading pictures asynchronously - the raw uploads are staged as UploadJobPicture
+    instances, which are processed in the background by the run_upload_worker command
+    """
+    job_uuid = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
+
+    class Meta:
+        verbose_name = 'Upload Job'
+        verbose_name_plural = 'Upload Jobs'
+
+    def __str__(self):
+        return str(self.job_uuid)
+
+    @staticmethod
+    def create_upload_job(picture_files):
+        """
+        Stage a list of picture files (see Picture.get_picture_file) for background processing, once they're checked
+        against the upload limits (see Picture.check_upload_limits)
+        Each picture is decoded and validated, then staged as raw bytes with its own INSERT, so only one picture is
+        held in memory at a time, and no single query is larger than the max file size
+        """
+        sizes, error = Picture.check_upload_limits(picture_files=picture_files)
+        if error:
+            return None, error
+
+        try:
+            with transaction.atomic():
+                upload_job = UploadJob.objects.create()
+                for picture, size in zip(picture_files, sizes):
+                    UploadJobPicture.stage_picture(upload_job=upload_job, picture=picture, size=size)
+        except DatabaseError:
+            logger.exception('Unable to stage %s pictures', len(picture_files))
+            return None, 'We were unable to upload your pictures, please try again'
+
+        return upload_job, ''
+
+    @staticmethod
+    def get_upload_job(job_uuid):
+        """ Get an upload job by job_uuid """
+        try:
+            upload_job = UploadJob.objects.get(job_uuid=job_uuid)
+        except (UploadJob.DoesNotExist, ValidationError):
+            upload_job = None
+
+        return upload_job
+
+    def get_progress(self):
+        """ Get the number of the job's pictures with each status, and the job's overall status """
+        status_counts = {
+            status: models.Count('id', filter=models.Q(status=status)) for status, label in UPLOAD_JOB_PICTURE_STATUSES
+        }
+        counts = self.pictures.aggregate(total=models.Count('id'), **status_counts)
+        if counts['pending'] == counts['total']:
+            job_status = 'pending'
+        elif counts['pending'] or counts['processing']:
+            job_status = 'processing'
+        else:
+            job_status = 'complete'
+
+        return {'status': job_status, **counts}
+
+
+class UploadJobPicture(TimeStampedModel):
+    """
+    UploadJobPicture model to allow staging a raw picture upload for an UploadJob, and tracking its progress
+    """
+    job = models.ForeignKey(UploadJob, related_name='pictures', on_delete=models.CASCADE)
+    name = models.CharField(max_length=255, blank=True)
+    data = models.BinaryField(blank=True, editable=False)
+    is_base64 = models.BooleanField(default=False)
+    status = models.CharField(choices=UPLOAD_JOB_PICTURE_STATUSES, max_length=20, default='pending')
+    error = models.CharField(max_length=255, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    picture = models.ForeignKey(Picture, related_name='+', blank=True, null=True, on_delete=models.SET_NULL)
+
+    class Meta:
+        verbose_name = 'Upload Job Picture'
+        verbose_name_plural = 'Upload Job Pictures'
+        indexes = [
+            # Supports claiming pending (and timed out) pictures from the queue
+            models.Index(fields=('status', 'modified'), name='upload_job_picture_status_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.name} - {self.get_status_display()}'
+
+    @staticmethod
+    def stage_picture(upload_job, picture, size):
+        """
+        Stage an uploaded picture (see Picture.get_picture_file) for an upload job as its decoded bytes - pictures over
+        the max file size, or that aren't images, are staged as failed, without their data
+        """
+        job_picture = UploadJobPicture(job=upload_job, name=Picture.get_original_filename(picture=picture))
+        if size > settings.PICTURE_UPLOAD_MAX_FILE_SIZE:
+            job_picture.status, job_picture.error = 'failed', UPLOAD_ERRORS['too_large']
+        else:
+            try:
+                picture_file = Picture.get_picture_file(picture=picture)
+            except (ValueError, TypeError, AttributeError):
+                job_picture.status, job_picture.error = 'failed', UPLOAD_ERRORS['unreadable']
+            else:
+                with picture_file:
+                    job_picture.data = picture_file.read()
+        job_picture.save()
+
+        return job_picture
+
+    @staticmethod
+    def claim_pictures(batch_size):
+        """
+        Claim a batch of pending pictures for processing, along with any pictures whose processing timed out (e.g. the
+        worker was stopped), so multiple workers can process the queue concurrently without claiming the same pictures
+        """
+        timed_out = timezone.now() - timedelta(seconds=settings.UPLOAD_JOB_TIMEOUT)
+        claimable = models.Q(status='pending') | models.Q(status='processing', modified__lt=timed_out)
+        with transaction.atomic():
+            picture_ids = list(
+                UploadJobPicture.objects.select_for_update(
+                    skip_locked=connection.features.has_select_for_update_skip_locked
+                ).filter(claimable).order_by('modified').values_list('id', flat=True)[:batch_size]
+            )
+            UploadJobPicture.objects.filter(id__in=picture_ids).update(
+                status='processing', attempts=models.F('attempts') + 1, modified=timezone.now()
+            )
+
+        return list(UploadJobPicture.objects.filter(id__in=picture_ids).order_by('id'))
+
+    @staticmethod
+    def process_pictures(job_pictures):
+        """
+        Decode, validate and store a batch of claimed pictures through the Picture upload pipeline, and record the
+        result for each - pictures that have been attempted too many times are failed without processing
+        A batch can hold pictures from several jobs, so the per-request upload limits aren't applied again
+        """
+        to_process, now = [], timezone.now()
+        for job_picture in job_pictures:
+            if job_picture.attempts > settings.UPLOAD_JOB_MAX_ATTEMPTS:
+                job_picture.status, job_picture.error = 'failed', UPLOAD_ERRORS['upload_failed']
+            else:
+                to_process.append(job_picture)
+
+        if to_process:
+            picture_files = [
+                # Base 64 strings staged before pictures were staged decoded are decoded as bytes, not copied to a str
+                {'fileSrc': bytes(job_picture.data), 'name': job_picture.name} if job_picture.is_base64
+                else SimpleUploadedFile(job_picture.name, bytes(job_picture.data), 'application/octet-stream')
+                for job_picture in to_process
+            ]
+            pictures, results, error = Picture.upload_pictures(picture_files=picture_files, check_limits=False)
+            pictures_by_uuid = {str(picture.picture_uuid): picture for picture in pictures}
+            for job_picture, result in zip(to_process, results):
+                if result.get('success'):
+                    job_picture.status = 'complete'
+                    job_picture.picture = pictures_by_uuid.get(result.get('picture_uuid'))
+                else:
+                    job_picture.status, job_picture.error = 'failed', result.get('error', '')
+
+        # The staged data is no longer needed once the picture has been processed - pictures without a result are left
+        # processing, with their data, to be reclaimed once they time out
+        for job_picture in job_pictures:
+            if job_picture.status != 'processing':
+                job_picture.data = b''
+            job_picture.modified = now
+        UploadJobPicture.objects.bulk_update(job_pictures, fields=('status', 'error', 'picture', 'data', 'modified'))
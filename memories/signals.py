@@ -0,0 +1,20 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Picture, bulk_deletes
+
+
+@receiver(post_save, sender=Picture)
+def update_gallery_manifest(sender, instance, **kwargs):
+    """ Add or update a picture in the gallery manifest once it's saved (or remove it, if it's hidden) """
+    transaction.on_commit(lambda: Picture.update_gallery_manifest(pictures=[instance]))
+
+
+@receiver(post_delete, sender=Picture)
+def remove_from_gallery_manifest(sender, instance, **kwargs):
+    """ Remove a picture from the gallery manifest once it's deleted (including deletes by the admin and commands) """
+    # Bulk deletes update the manifest once, for all the pictures
+    if getattr(bulk_deletes, 'active', False):
+        return
+    transaction.on_commit(lambda: Picture.update_gallery_manifest(deleted_picture_uuids=[instance.picture_uuid]))
@@ -1,7 +1,43 @@
+import base64
+import hashlib
+import json
+import math
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest.mock import patch
+
 from django.conf import settings
-from django.test import TestCase
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, DatabaseError
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.encoding import filepath_to_uri
+
+from PIL import Image
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
 
-from .models import Picture
+from .models import Picture, UploadJob, UploadJobPicture
+from custom_storages import MediaStorage, InMemoryMediaStorage
+from data.constants import (
+    PICTURE_RENDITIONS, PICTURE_RENDITION_FORMATS, PRESIGNED_UPLOAD_SALT, GALLERY_MANIFEST_CACHE_KEY,
+    GALLERY_MANIFEST_ENTRIES_CACHE_KEY, GALLERY_MANIFEST_LOCK_KEY,
+)
+from data.seed_tests import seed_pictures, generate_base_64_images
 from utils.helpers import delete_test_files
 
 
@@ -14,9 +50,9 @@ class PictureTest(TestCase):
         """ Initialise test data """
         cls.temp_picture = Picture()
         cls.pictures = []
-        for i in range(5):
+        for i, image in enumerate(generate_base_64_images(image_count=5)):
             picture = {
-                'fileSrc': settings.TEST_BASE_64_IMAGE,
+                'fileSrc': image,
                 'name': f'picture-{i}.gif',
             }
             cls.pictures.append(picture)
@@ -42,6 +78,61 @@ class PictureTest(TestCase):
         expected_pictures = Picture.objects.all().order_by('created')
         self.assertQuerySetEqual(pictures, expected_pictures)
 
+    #                                                                              get_pictures_page(cursor, page_size)
+    def test_get_pictures_page_returns_first_page(self):
+        """ Confirm we return the first page of pictures, oldest to newest, with a next cursor only """
+        seed_pictures(picture_count=5)
+        page, error = self.temp_picture.get_pictures_page(page_size=2)
+        self.assertEqual(error, '')
+        self.assertEqual(page.get('pictures'), list(Picture.objects.order_by('created', 'id')[:2]))
+        self.assertIsNotNone(page.get('next'))
+        self.assertIsNone(page.get('previous'))
+
+    def test_get_pictures_page_follows_cursors(self):
+        """ Confirm we can page forwards through all pictures, then back again, using the cursors """
+        seed_pictures(picture_count=5)
+        expected_pictures = list(Picture.objects.order_by('created', 'id'))
+        pages, page = [], {'next': ''}
+        while page.get('next') is not None:
+            page, error = self.temp_picture.get_pictures_page(cursor=page.get('next'), page_size=2)
+            pages.append(page)
+        self.assertEqual([picture for page in pages for picture in page.get('pictures')], expected_pictures)
+        previous_page, error = self.temp_picture.get_pictures_page(cursor=pages[-1].get('previous'), page_size=2)
+        self.assertEqual(previous_page.get('pictures'), pages[-2].get('pictures'))
+        self.assertIsNone(pages[-1].get('next'))
+
+    def test_get_pictures_page_single_query(self):
+        """ Confirm we return a page with a single query, regardless of the gallery size """
+        seed_pictures(picture_count=20)
+        page, error = self.temp_picture.get_pictures_page(page_size=5)
+        with self.assertNumQueries(1):
+            self.temp_picture.get_pictures_page(cursor=page.get('next'), page_size=5)
+
+    def test_get_pictures_page_invalid_cursor_returns_error(self):
+        """ Confirm we return an error if the cursor is invalid """
+        page, error = self.temp_picture.get_pictures_page(cursor='invalid')
+        self.assertEqual(page.get('pictures'), [])
+        self.assertEqual(error, 'Sorry, that page isn\'t valid')
+
+    #                                                                                             get_pictures_version()
+    def test_get_pictures_version_changes_when_picture_added(self):
+        """ Confirm the ETag and last modified date change when a picture is added """
+        etag, last_modified = self.temp_picture.get_pictures_version()
+        self.assertIsNone(last_modified)
+        picture = Picture.objects.create(file='memories/test/picture.gif')
+        new_etag, new_last_modified = self.temp_picture.get_pictures_version()
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(new_last_modified, picture.modified)
+
+    def test_get_pictures_version_changes_when_picture_deleted(self):
+        """ Confirm the ETag changes when a picture is deleted """
+        Picture.objects.create(file='memories/test/picture-1.gif')
+        picture = Picture.objects.create(file='memories/test/picture-2.gif')
+        Picture.objects.filter(pk=picture.pk).update(modified=Picture.objects.first().modified)
+        etag, last_modified = self.temp_picture.get_pictures_version()
+        Picture.objects.filter(pk=picture.pk).delete()
+        self.assertNotEqual(self.temp_picture.get_pictures_version()[0], etag)
+
     #                                                                                     create_pictures(picture_files)
     def test_create_pictures_empty_picture_files_list_returns_error(self):
         """ Confirm we return an empty list and error message when passed an empty list """
@@ -65,3 +156,955 @@ class PictureTest(TestCase):
             picture_name = self.pictures[index].get('name', '').split('.')[0]
             url = f'https://{settings.AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com/memories/test/{picture_name}'
             self.assertIn(url, picture.file.url)
+
+    def test_create_pictures_uploaded_files_creates_pictures(self):
+        """ Confirm we create Picture instances from uploaded (multipart) files """
+        images = [base64.b64decode(image.split(';base64,')[-1]) for image in generate_base_64_images(image_count=2)]
+        uploaded_files = [
+            SimpleUploadedFile(f'picture-{i}.gif', image, content_type='image/gif') for i, image in enumerate(images)
+        ]
+        pictures, error = self.temp_picture.create_pictures(picture_files=uploaded_files)
+        self.assertEqual(error, '')
+        self.assertEqual(pictures.count(), 2)
+        for index, picture in enumerate(pictures):
+            self.assertIn(f'memories/test/picture-{index}-', picture.file.name)
+            with picture.file.open('rb') as file:
+                self.assertEqual(file.read(), images[index])
+
+    #                                                                                     upload_pictures(picture_files)
+    def test_upload_pictures_returns_results(self):
+        """ Confirm we return the created pictures and a successful result for each picture, in order """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures)
+        self.assertEqual(error, '')
+        self.assertEqual(pictures.count(), len(self.pictures))
+        self.assertEqual([result.get('name') for result in results], [picture['name'] for picture in self.pictures])
+        self.assertEqual(
+            [result.get('picture_uuid') for result in results], [str(picture.picture_uuid) for picture in pictures]
+        )
+
+    @override_settings(PICTURE_UPLOAD_MAX_FILE_SIZE=100)
+    def test_upload_pictures_too_large_picture_returns_error_for_picture(self):
+        """ Confirm we return an error for a picture over the max file size, without decoding it """
+        large_picture = {'name': 'large.gif', 'fileSrc': f'data:image/gif;base64,{"A" * 200}'}
+        with patch('memories.models.Picture.get_picture_file', wraps=Picture.get_picture_file) as get_picture_file:
+            pictures, results, error = self.temp_picture.upload_pictures(picture_files=[large_picture, *self.pictures])
+        self.assertEqual(error, '')
+        self.assertEqual(pictures.count(), len(self.pictures))
+        self.assertEqual(get_picture_file.call_count, len(self.pictures))
+        self.assertEqual(results[0].get('error_code'), 'too_large')
+        self.assertEqual(results[0].get('error'), 'This picture is too large')
+
+    @override_settings(PICTURE_UPLOAD_MAX_TOTAL_SIZE=100)
+    def test_upload_pictures_over_total_size_returns_error(self):
+        """ Confirm we return an error, and don't create any pictures, if the pictures are over the max total size """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures * 3)
+        self.assertFalse(pictures)
+        self.assertEqual(
+            error, 'Your pictures are too large to upload at once, please upload fewer pictures at a time'
+        )
+
+    def test_get_upload_size_returns_decoded_size(self):
+        """ Confirm we return the decoded size of base 64 and multipart uploads, and 0 if the upload is invalid """
+        image = generate_base_64_images(image_count=1)[0]
+        decoded_size = len(base64.b64decode(image.split(';base64,')[1]))
+        self.assertEqual(Picture.get_upload_size(picture={'fileSrc': image}), decoded_size)
+        self.assertEqual(Picture.get_upload_size(picture=SimpleUploadedFile('picture.gif', b'123')), 3)
+        self.assertEqual(Picture.get_upload_size(picture={'fileSrc': None}), 0)
+
+    def test_upload_pictures_single_insert_query(self):
+        """ Confirm we insert all the Picture rows with a single query """
+        with CaptureQueriesContext(connection) as context:
+            self.temp_picture.upload_pictures(picture_files=self.pictures)
+        inserts = [query for query in context.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+
+    @override_settings(PICTURE_UPLOAD_WORKERS=2)
+    def test_upload_pictures_storage_error_returns_error_for_picture(self):
+        """ Confirm we return an error for a picture that fails to upload, and create the other pictures """
+        storage = Picture._meta.get_field('file').storage
+        save = storage.save
+
+        def save_or_fail(name, content, max_length=None):
+            if 'picture-2' in name:
+                raise OSError('Upload failed')
+            return save(name, content, max_length=max_length)
+
+        with patch.object(storage, 'save', side_effect=save_or_fail), self.assertLogs('memories.models', 'ERROR'):
+            pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures)
+        self.assertEqual(pictures.count(), len(self.pictures) - 1)
+        self.assertFalse(results[2].get('success'))
+        self.assertEqual(results[2].get('error'), 'We were unable to upload this picture')
+        self.assertEqual(results[2].get('error_code'), 'upload_failed')
+
+    def test_upload_pictures_db_error_deletes_stored_files(self):
+        """ Confirm we delete the stored files if the Picture rows can't be inserted """
+        storage = Picture._meta.get_field('file').storage
+        with patch.object(storage, 'delete', wraps=storage.delete) as delete:
+            with patch('memories.models.Picture.objects.bulk_create', side_effect=DatabaseError), \
+                    self.assertLogs('memories.models', 'ERROR'):
+                pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:2])
+        self.assertFalse(pictures.exists())
+        self.assertEqual(error, 'We were unable to upload on or more of your pictures, please try again')
+        for result in results:
+            self.assertEqual(result.get('error'), 'We were unable to save this picture')
+        # The original and each rendition, in each format, of both pictures
+        self.assertEqual(delete.call_count, 2 * (1 + len(PICTURE_RENDITIONS) * len(PICTURE_RENDITION_FORMATS)))
+        for call in delete.call_args_list:
+            self.assertFalse(storage.exists(call.args[0]))
+
+    #                                                                         normalize_picture_file(picture_file)
+    @override_settings(PICTURE_MAX_DIMENSION=500)
+    def test_upload_pictures_normalizes_pictures_and_records_sizes(self):
+        """ Confirm we store the normalized picture, and record its size before and after normalization """
+        buffer = BytesIO()
+        Image.new('RGB', (2000, 1000)).save(buffer, format='JPEG', quality=100)
+        pictures, results, error = self.temp_picture.upload_pictures(
+            picture_files=[SimpleUploadedFile('large.jpg', buffer.getvalue(), content_type='image/jpeg')]
+        )
+        picture = pictures.first()
+        with picture.file.open('rb') as file:
+            self.assertEqual(Image.open(file).size, (500, 250))
+        self.assertEqual(picture.original_file_size, len(buffer.getvalue()))
+        self.assertEqual(picture.file_size, picture.file.size)
+        self.assertLess(picture.file_size, picture.original_file_size)
+
+    def test_upload_pictures_multipart_non_image_returns_unreadable_result(self):
+        """ Confirm we reject multipart files whose content type or extension isn't an image, or that aren't images """
+        image = base64.b64decode(settings.TEST_BASE_64_IMAGE.split(';base64,')[-1])
+        picture_files = [
+            SimpleUploadedFile('evil.html', b'<script>alert(1)</script>', content_type='text/html'),
+            SimpleUploadedFile('evil.html', image, content_type='image/gif'),
+            SimpleUploadedFile('evil.gif', b'<script>alert(1)</script>', content_type='image/gif'),
+            SimpleUploadedFile('picture.gif', image, content_type='application/octet-stream'),
+        ]
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=picture_files)
+        self.assertEqual([result['error_code'] for result in results], ['unreadable'] * 3 + [''])
+        self.assertEqual(pictures.count(), 1)
+
+    def test_normalize_picture_file_unreadable_image_returns_file(self):
+        """ Confirm we return the file as uploaded if it can't be normalized """
+        picture_file = SimpleUploadedFile('invalid.gif', b'invalid')
+        self.assertIs(Picture.normalize_picture_file(picture_file=picture_file), picture_file)
+
+    #                                                                              store_renditions(name, picture_file)
+    def test_upload_pictures_stores_renditions(self):
+        """ Confirm we store each rendition, in each format, next to the original and record them on the picture """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:1])
+        picture = pictures.first()
+        storage = picture.file.storage
+        root = picture.file.name.rsplit('.', 1)[0]
+        self.assertEqual(set(picture.renditions), set(PICTURE_RENDITIONS))
+        for rendition, data in picture.renditions.items():
+            self.assertEqual(data.get('files'), {'webp': f'{root}-{rendition}.webp', 'jpeg': f'{root}-{rendition}.jpg'})
+            for name in data.get('files', {}).values():
+                self.assertTrue(storage.exists(name))
+
+    def test_store_renditions_resizes_to_each_size(self):
+        """ Confirm each rendition's longest edge is capped at its size, keeping the aspect ratio """
+        buffer = BytesIO()
+        Image.new('RGB', (2000, 1000)).save(buffer, format='PNG')
+        picture_file = SimpleUploadedFile('large.png', buffer.getvalue())
+        renditions = Picture.store_renditions(name='memories/test/large.png', picture_file=picture_file)
+        for rendition, size in PICTURE_RENDITIONS.items():
+            self.assertEqual((renditions[rendition]['width'], renditions[rendition]['height']), (size, size // 2))
+            with Picture._meta.get_field('file').storage.open(renditions[rendition]['files']['webp']) as file:
+                self.assertEqual(Image.open(file).size, (size, size // 2))
+
+    def test_store_renditions_unreadable_image_returns_empty_dict(self):
+        """ Confirm we don't create renditions for a file that isn't a readable image """
+        picture_file = SimpleUploadedFile('invalid.gif', b'invalid')
+        self.assertEqual(Picture.store_renditions(name='memories/test/invalid.gif', picture_file=picture_file), {})
+
+    #                                                                                                      get_srcset()
+    def test_get_srcset_returns_renditions_by_width(self):
+        """ Confirm we return a srcset string for each format, with the renditions ordered by width """
+        picture = Picture(file='memories/test/a.gif', renditions={
+            'medium': {'width': 800, 'height': 600, 'files': {'webp': 'memories/test/a-medium.webp'}},
+            'thumbnail': {'width': 200, 'height': 150, 'files': {'webp': 'memories/test/a-thumbnail.webp'}},
+        })
+        url = picture.file.storage.url
+        self.assertEqual(picture.get_srcset(), {
+            'webp': f'{url("memories/test/a-thumbnail.webp")} 200w, {url("memories/test/a-medium.webp")} 800w'
+        })
+
+    def test_get_file_url_uses_public_url_base(self):
+        """ Confirm we build the URL from the storage's public URL base, or use the storage's url() if it has none """
+        storage = Picture._meta.get_field('file').storage
+        name = 'memories/test/a picture.gif'
+        with patch.object(storage, 'public_url_base', 'https://cdn.example.com/', create=True):
+            with patch.object(storage, 'url') as url:
+                self.assertEqual(Picture.get_file_url(name), 'https://cdn.example.com/memories/test/a%20picture.gif')
+        url.assert_not_called()
+        with patch.object(storage, 'public_url_base', None, create=True):
+            self.assertEqual(Picture.get_file_url(name), storage.url(name))
+
+    def test_get_rendition_url_no_renditions_returns_original_url(self):
+        """ Confirm we fall back to the original's URL if the picture has no renditions """
+        picture = Picture(file='memories/test/a.gif')
+        self.assertEqual(picture.get_rendition_url(rendition='thumbnail'), picture.file.url)
+        self.assertEqual(picture.get_srcset(), {})
+
+    #                                                                                                   reconcile_media
+    def test_delete_picture_files_deleted_by_reconcile_media(self):
+        """ Confirm a deleted picture's files are kept on the request path, and deleted by reconcile_media """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:2])
+        picture, kept_picture = pictures
+        names = picture.get_stored_names()
+        with self.captureOnCommitCallbacks(execute=True):
+            picture.delete()
+        storage = picture.file.storage
+        self.assertTrue(all(storage.exists(name) for name in names))
+
+        stdout = StringIO()
+        call_command('reconcile_media', prefix='memories/test/', min_age=0, check_missing=True, stdout=stdout)
+        self.assertFalse(any(storage.exists(name) for name in names))
+        self.assertTrue(all(storage.exists(name) for name in kept_picture.get_stored_names()))
+        self.assertIn('Missing: 0 files', stdout.getvalue())
+
+    def test_reconcile_media_keeps_recent_files(self):
+        """ Confirm orphaned files newer than the min age, and all files with --dry-run, aren't deleted """
+        storage = Picture._meta.get_field('file').storage
+        name = storage.save('memories/test/orphan.gif', ContentFile(b'orphan'))
+        call_command('reconcile_media', prefix='memories/test/', stdout=StringIO())
+        self.assertTrue(storage.exists(name))
+        call_command('reconcile_media', prefix='memories/test/', min_age=0, dry_run=True, stdout=StringIO())
+        self.assertTrue(storage.exists(name))
+
+    def test_reconcile_media_reports_missing_files(self):
+        """ Confirm pictures whose files aren't in storage are reported """
+        picture = Picture.objects.create(file='memories/test/missing.gif')
+        stdout, stderr = StringIO(), StringIO()
+        call_command(
+            'reconcile_media', prefix='memories/test/', min_age=0, check_missing=True, stdout=stdout, stderr=stderr
+        )
+        self.assertIn(f'Missing: {picture.file.name}', stderr.getvalue())
+        self.assertIn('Missing: 1 files', stdout.getvalue())
+        self.assertTrue(Picture.objects.filter(id=picture.id).exists())
+
+    def test_reconcile_media_looks_up_pictures_for_each_page(self):
+        """ Confirm the pictures are looked up for each page of files, keeping renditions listed on other pages """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:2])
+        storage = Picture._meta.get_field('file').storage
+        orphan = storage.save('memories/test/orphan.gif', ContentFile(b'orphan'))
+        names = [name for picture in pictures for name in picture.get_stored_names()]
+        stdout = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('reconcile_media', prefix='memories/test/', min_age=0, batch_size=3, stdout=stdout)
+        # Files left by other tests are listed (and deleted) too
+        listed = int(stdout.getvalue().split('Files: ')[1].split(' listed')[0])
+        self.assertEqual(len(queries), math.ceil(listed / 3))
+        self.assertTrue(all(storage.exists(name) for name in names))
+        self.assertFalse(storage.exists(orphan))
+        self.assertIn(f'{len(names)} referenced by pictures', stdout.getvalue())
+
+    #                                                                                               generate_renditions
+    def test_generate_renditions_backfills_pictures_without_renditions(self):
+        """ Confirm the command creates renditions for pictures without them, and updates their modified date """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:2])
+        Picture.objects.update(renditions={})
+        modified = {picture.id: picture.modified for picture in Picture.objects.all()}
+        call_command('generate_renditions', '--workers', '2', stderr=StringIO())
+        for picture in Picture.objects.all():
+            self.assertEqual(set(picture.renditions), set(PICTURE_RENDITIONS))
+            self.assertGreater(picture.modified, modified[picture.id])
+
+    #                                                                                               sha256 deduplication
+    def test_upload_pictures_existing_picture_returns_existing_picture(self):
+        """ Confirm we return the existing picture for a picture that's uploaded again, without storing it again """
+        existing_pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:1])
+        storage = Picture._meta.get_field('file').storage
+        with patch.object(storage, 'save', wraps=storage.save) as save:
+            pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:2])
+        self.assertEqual(Picture.objects.count(), 2)
+        self.assertEqual(results[0].get('picture_uuid'), str(existing_pictures.first().picture_uuid))
+        self.assertTrue(results[0].get('success'))
+        # Only the new picture, and its renditions, are stored
+        self.assertEqual(save.call_count, 1 + len(PICTURE_RENDITIONS) * len(PICTURE_RENDITION_FORMATS))
+
+    def test_upload_pictures_repeated_picture_stored_once(self):
+        """ Confirm a picture repeated in the same upload is only stored once, and each repeat gets its result """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=[self.pictures[0]] * 3)
+        picture = Picture.objects.get()
+        self.assertEqual(picture.sha256, hashlib.sha256(base64.b64decode(
+            self.pictures[0]['fileSrc'].split(';base64,')[-1]
+        )).hexdigest())
+        for result in results:
+            self.assertEqual((result.get('success'), result.get('picture_uuid')), (True, str(picture.picture_uuid)))
+
+    def test_get_pictures_by_hash_single_query(self):
+        """ Confirm we look up the existing pictures for a list of hashes with a single query """
+        self.temp_picture.upload_pictures(picture_files=self.pictures[:2])
+        hashes = list(Picture.objects.values_list('sha256', flat=True))
+        with self.assertNumQueries(1):
+            pictures = Picture.get_pictures_by_hash(hashes=[*hashes, 'unknown'])
+        self.assertEqual(set(pictures), set(hashes))
+
+    def test_dedupe_pictures_deletes_newer_duplicates(self):
+        """ Confirm the command hashes pictures without a hash, and deletes all but the oldest of each duplicate """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:2])
+        oldest = pictures.first()
+        # A copy of the oldest picture's file, uploaded before hashes were recorded
+        with oldest.file.open('rb') as file:
+            name = oldest.file.storage.save('memories/test/duplicate.gif', ContentFile(file.read()))
+        duplicate = Picture.objects.create(file=name)
+        UploadJob.create_upload_job(picture_files=self.pictures[:1])
+        UploadJobPicture.objects.update(picture=duplicate)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_pictures', stderr=StringIO())
+        self.assertEqual(set(Picture.objects.all()), set(pictures))
+        self.assertEqual(UploadJobPicture.objects.get().picture, oldest)
+        self.assertFalse(oldest.file.storage.exists(name))
+
+    def test_dedupe_pictures_deletes_each_batch_files(self):
+        """ Confirm the duplicates' files are deleted for every batch, once the command's changes are committed """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:2])
+        storage = Picture._meta.get_field('file').storage
+        names = []
+        for index, picture in enumerate(pictures):
+            with picture.file.open('rb') as file:
+                names.append(storage.save(f'memories/test/duplicate-{index}.gif', ContentFile(file.read())))
+            Picture.objects.create(file=names[-1], sha256=picture.sha256)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_pictures', '--batch-size', '1', stderr=StringIO())
+        self.assertEqual(set(Picture.objects.all()), set(pictures))
+        self.assertEqual([storage.exists(name) for name in names], [False, False])
+
+    def test_upload_pictures_hidden_duplicate_uploaded_again(self):
+        """ Confirm a picture that's uploaded again after its match was hidden is stored, and added to the gallery """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:1])
+        hidden_picture = pictures.first()
+        Picture.objects.filter(id=hidden_picture.id).update(hidden=True)
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:1])
+        self.assertNotEqual(results[0].get('picture_uuid'), str(hidden_picture.picture_uuid))
+        self.assertEqual(list(Picture.get_pictures()), list(pictures))
+
+    def test_dedupe_pictures_keeps_visible_picture(self):
+        """ Confirm the command keeps a visible picture, rather than an older hidden duplicate """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:1])
+        hidden_picture = pictures.first()
+        Picture.objects.filter(id=hidden_picture.id).update(hidden=True)
+        visible_picture = Picture.objects.create(file='memories/test/visible.gif', sha256=hidden_picture.sha256)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_pictures', stderr=StringIO())
+        self.assertEqual(list(Picture.objects.all()), [visible_picture])
+
+    def test_dedupe_pictures_dry_run_deletes_nothing(self):
+        """ Confirm the command doesn't delete any pictures with --dry-run """
+        pictures, results, error = self.temp_picture.upload_pictures(picture_files=self.pictures[:1])
+        Picture.objects.create(file=pictures.first().file.name, sha256=pictures.first().sha256)
+        call_command('dedupe_pictures', '--dry-run', stderr=StringIO())
+        self.assertEqual(Picture.objects.count(), 2)
+
+    #                                                                   create_presigned_uploads(picture_files, method)
+    def test_create_presigned_uploads_returns_upload_for_each_picture(self):
+        """ Confirm we return a presigned upload, with a token for its unique name, for each picture """
+        storage = Picture._meta.get_field('file').storage
+        presigned_upload = {'method': 'POST', 'url': 'https://upload', 'fields': {}, 'headers': {}}
+        with patch.object(storage, 'generate_presigned_upload', create=True, return_value=presigned_upload) as presign:
+            uploads, error = Picture.create_presigned_uploads(
+                picture_files=[{'name': f'picture-{i}.jpg', 'contentType': 'image/jpeg'} for i in range(2)]
+            )
+        self.assertEqual(error, '')
+        self.assertEqual([upload.get('name') for upload in uploads], ['picture-0.jpg', 'picture-1.jpg'])
+        for upload, call in zip(uploads, presign.call_args_list):
+            self.assertEqual(signing.loads(upload.get('token'), salt=PRESIGNED_UPLOAD_SALT), call.kwargs.get('name'))
+            self.assertTrue(call.kwargs.get('name').startswith('memories/test/picture-'))
+            self.assertEqual(upload.get('url'), 'https://upload')
+
+    def test_create_presigned_uploads_non_image_returns_error(self):
+        """ Confirm we return an error if a file isn't an image """
+        storage = Picture._meta.get_field('file').storage
+        with patch.object(storage, 'generate_presigned_upload', create=True):
+            uploads, error = Picture.create_presigned_uploads(
+                picture_files=[{'name': 'script.js', 'contentType': 'application/javascript'}]
+            )
+        self.assertEqual(uploads, [])
+        self.assertEqual(error, 'Please only upload pictures')
+
+    #                                                                                 confirm_presigned_uploads(tokens)
+    def test_confirm_presigned_uploads_creates_uploaded_pictures(self):
+        """ Confirm we create a picture for each uploaded file, and return an error for files that weren't uploaded """
+        names = ['memories/test/uploaded.jpg', 'memories/test/missing.jpg']
+        tokens = [signing.dumps(name, salt=PRESIGNED_UPLOAD_SALT) for name in names]
+        storage = Picture._meta.get_field('file').storage
+        metadata = {names[0]: {'size': 100, 'content_type': 'image/jpeg'}}
+        with patch.object(storage, 'get_object_metadata', create=True, side_effect=metadata.get):
+            pictures, results, error = Picture.confirm_presigned_uploads(tokens=[*tokens, 'invalid'])
+        picture = Picture.objects.get()
+        self.assertEqual(list(pictures), [picture])
+        self.assertEqual((picture.file.name, picture.file_size), (names[0], 100))
+        self.assertEqual(results[0].get('picture_uuid'), str(picture.picture_uuid))
+        self.assertEqual(results[1].get('error'), 'We couldn\'t find this picture, please upload it again')
+        self.assertEqual(results[2].get('error'), 'Sorry, that upload isn\'t valid')
+
+    def test_confirm_presigned_uploads_already_confirmed_returns_existing_picture(self):
+        """ Confirm we return the existing picture, without checking storage, if an upload is confirmed again """
+        picture = Picture.objects.create(file='memories/test/uploaded.jpg')
+        storage = Picture._meta.get_field('file').storage
+        with patch.object(storage, 'get_object_metadata', create=True) as get_object_metadata:
+            pictures, results, error = Picture.confirm_presigned_uploads(
+                tokens=[signing.dumps(picture.file.name, salt=PRESIGNED_UPLOAD_SALT)]
+            )
+        get_object_metadata.assert_not_called()
+        self.assertEqual(results[0].get('picture_uuid'), str(picture.picture_uuid))
+        self.assertEqual(Picture.objects.count(), 1)
+
+
+class GalleryManifestTest(TestCase):
+    """ Test suite for the Picture gallery manifest """
+
+    def setUp(self):
+        """ Clear the cached gallery manifest between tests """
+        cache.clear()
+
+    @staticmethod
+    def get_entries():
+        """ Get the cached gallery manifest entries """
+        Picture.get_gallery_manifest()
+        return cache.get(GALLERY_MANIFEST_ENTRIES_CACHE_KEY)
+
+    @override_settings(CACHE_IS_SHARED=True)
+    def test_get_gallery_manifest_cached(self):
+        """ Confirm we build the manifest once, then return it from the cache """
+        seed_pictures(picture_count=2)
+        with self.assertNumQueries(1):
+            manifest = Picture.get_gallery_manifest()
+        with self.assertNumQueries(0):
+            self.assertEqual(Picture.get_gallery_manifest(), manifest)
+        self.assertEqual(json.loads(manifest['content']).get('pictures'), [
+            json.loads(entry['content']) for entry in cache.get(GALLERY_MANIFEST_ENTRIES_CACHE_KEY).values()
+        ])
+        self.assertNotIn('entries', manifest)
+
+    @override_settings(CACHE_IS_SHARED=False)
+    def test_get_gallery_manifest_not_shared_rebuilt_if_out_of_date(self):
+        """
+        Confirm we check the manifest against the gallery's version if the cache isn't shared, and rebuild it if
+        pictures were changed by another process (which doesn't update this process's manifest)
+        """
+        seed_pictures(picture_count=2)
+        manifest = Picture.get_gallery_manifest()
+        with self.assertNumQueries(1):
+            self.assertEqual(Picture.get_gallery_manifest(), manifest)
+        # bulk_create doesn't update the manifest, like changes made in another process
+        Picture.objects.bulk_create([Picture(file='memories/test/other-process.gif')])
+        self.assertEqual(len(json.loads(Picture.get_gallery_manifest()['content']).get('pictures')), 3)
+        Picture.objects.filter(file='memories/test/other-process.gif').update(modified=timezone.now())
+        self.assertNotEqual(Picture.get_gallery_manifest()['modified'], manifest['modified'])
+
+    def test_update_gallery_manifest_updates_incrementally(self):
+        """ Confirm we only encode the changed pictures when a picture is added or deleted """
+        seed_pictures(picture_count=3)
+        Picture.get_gallery_manifest()
+        with patch.object(Picture, 'encode_gallery_entries', wraps=Picture.encode_gallery_entries) as encode:
+            with self.captureOnCommitCallbacks(execute=True):
+                picture = Picture.objects.create(file='memories/test/new.gif')
+                Picture.objects.first().delete()
+        self.assertEqual([len(list(call.args[0])) for call in encode.call_args_list], [1, 0])
+        manifest = Picture.get_gallery_manifest()
+        self.assertEqual(manifest, Picture.build_gallery_manifest(
+            entries=Picture.encode_gallery_entries(Picture.get_pictures()), last_modified=manifest['last_modified']
+        ))
+        self.assertEqual(list(self.get_entries())[-1], str(picture.picture_uuid))
+
+    def test_update_gallery_manifest_locked_drops_manifest(self):
+        """ Confirm we drop the manifest, so it's rebuilt, if another update holds the lock """
+        Picture.get_gallery_manifest()
+        cache.set(GALLERY_MANIFEST_LOCK_KEY, True)
+        Picture.update_gallery_manifest(pictures=seed_pictures(picture_count=1))
+        self.assertIsNone(cache.get(GALLERY_MANIFEST_CACHE_KEY))
+        self.assertIsNone(cache.get(GALLERY_MANIFEST_ENTRIES_CACHE_KEY))
+
+    def test_update_gallery_manifest_entries_evicted_drops_manifest(self):
+        """ Confirm we drop the manifest, so it's rebuilt, if its entries have been evicted from the cache """
+        Picture.get_gallery_manifest()
+        cache.delete(GALLERY_MANIFEST_ENTRIES_CACHE_KEY)
+        Picture.update_gallery_manifest(pictures=seed_pictures(picture_count=1))
+        self.assertIsNone(cache.get(GALLERY_MANIFEST_CACHE_KEY))
+
+    #                                                                        set_pictures_hidden(pictures, hidden)
+    def test_set_pictures_hidden_hides_and_restores_pictures(self):
+        """ Confirm hidden pictures are left out of the gallery and its manifest, and restored pictures are put back """
+        pictures = seed_pictures(picture_count=3)
+        hidden_picture = pictures.first()
+        Picture.get_gallery_manifest()
+        etag, last_modified = Picture.get_pictures_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(Picture.set_pictures_hidden(pictures=pictures.filter(id=hidden_picture.id)), 1)
+        self.assertNotIn(hidden_picture, Picture.get_pictures())
+        self.assertNotIn(hidden_picture, Picture.get_pictures_page()[0]['pictures'])
+        self.assertNotIn(str(hidden_picture.picture_uuid), self.get_entries())
+        self.assertNotEqual(Picture.get_pictures_version()[0], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(Picture.set_pictures_hidden(pictures=Picture.objects.all(), hidden=False), 1)
+        hidden_picture.refresh_from_db()
+        self.assertIn(str(hidden_picture.picture_uuid), self.get_entries())
+        self.assertGreater(hidden_picture.modified, last_modified)
+
+    def test_set_pictures_hidden_single_update_query(self):
+        """ Confirm we hide any number of pictures with a single update query """
+        seed_pictures(picture_count=5)
+        with CaptureQueriesContext(connection) as context:
+            Picture.set_pictures_hidden(pictures=Picture.objects.all())
+        updates = [query for query in context.captured_queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+
+    #                                                                                        delete_pictures(pictures)
+    def test_delete_pictures_updates_manifest_once(self):
+        """ Confirm we delete the pictures, keeping their files, and update the manifest once for all of them """
+        pictures = seed_pictures(picture_count=3)
+        names = [picture.file.name for picture in pictures[:2]]
+        Picture.get_gallery_manifest()
+        with patch.object(Picture, 'update_gallery_manifest', wraps=Picture.update_gallery_manifest) as update:
+            with self.captureOnCommitCallbacks(execute=True):
+                deleted, deleted_names = Picture.delete_pictures(pictures=pictures.filter(file__in=names))
+        self.assertEqual((deleted, sorted(deleted_names)), (2, sorted(names)))
+        self.assertEqual(update.call_count, 1)
+        self.assertEqual(len(self.get_entries()), 1)
+
+
+class PictureAdminTest(TestCase):
+    """ Test suite for PictureAdmin """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        seed_pictures(picture_count=3)
+        User = get_user_model()
+        cls.admin = User.objects.create(email='admin@admin.co.uk', username='admin@admin.co.uk')
+        cls.url = reverse('admin:memories_picture_changelist')
+
+    def setUp(self):
+        """ Log in as the admin """
+        self.client.force_login(self.admin)
+
+    def post_action(self, action, pictures):
+        """ Run a changelist action on some pictures """
+        return self.client.post(self.url, {
+            'action': action, ACTION_CHECKBOX_NAME: [picture.id for picture in pictures],
+        })
+
+    def test_changelist_query_count_independent_of_pictures(self):
+        """ Confirm the changelist doesn't query each picture, or count the whole gallery """
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(self.url)
+        seed_pictures(picture_count=10)
+        with self.assertNumQueries(len(context.captured_queries)):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_hide_and_restore_pictures_actions(self):
+        """ Confirm the actions hide the selected pictures, then restore them """
+        pictures = list(Picture.objects.all()[:2])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post_action('hide_pictures', pictures)
+        self.assertEqual(set(Picture.objects.filter(hidden=True)), set(pictures))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.post_action('restore_pictures', pictures)
+        self.assertFalse(Picture.objects.filter(hidden=True).exists())
+
+    def test_delete_pictures_action_deletes_files_in_background(self):
+        """ Confirm the action deletes the selected pictures, then deletes their files in the background """
+        pictures = list(Picture.objects.all()[:2])
+        with patch('memories.admin.run_in_background') as run_in_background:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.post_action('delete_pictures', pictures)
+        self.assertEqual(Picture.objects.count(), 1)
+        run_in_background.assert_called_once()
+        self.assertEqual(run_in_background.call_args.args, (Picture.delete_stored_files,))
+        self.assertEqual(
+            sorted(run_in_background.call_args.kwargs['names']),
+            sorted(name for picture in pictures for name in picture.get_stored_names()),
+        )
+
+
+class PictureArchiveTest(TestCase):
+    """ Test suite for Picture archive methods, and the export_pictures command """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data - pictures with files, created on consecutive days """
+        cls.contents = {}
+        for i in range(3):
+            name = default_storage.save(f'memories/test/archive-{i}.gif', ContentFile(f'picture-{i}'.encode() * 100))
+            picture = Picture.objects.create(file=name)
+            Picture.objects.filter(id=picture.id).update(created=timezone.make_aware(timezone.datetime(2024, 6, i + 1)))
+            cls.contents[os.path.basename(name)] = f'picture-{i}'.encode() * 100
+        cls.names = list(cls.contents)
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Custom teardown to delete temp files created in tests """
+        # For deleting S3 bucket files
+        delete_test_files()
+
+        super().tearDownClass()
+
+    @staticmethod
+    def read_archive(content):
+        """ Read an archive's files into a dict of {name: content} """
+        with zipfile.ZipFile(BytesIO(content)) as archive:
+            return {name: archive.read(name) for name in archive.namelist()}
+
+    def test_stream_archive_contains_pictures_in_order(self):
+        """ Confirm the archive contains every picture's file, oldest first, read in chunks """
+        pictures, error = Picture.get_archive_pictures()
+        archived = []
+        content = b''.join(
+            Picture.stream_archive(pictures=pictures, workers=2, chunk_size=64, on_archived=archived.append)
+        )
+        self.assertEqual(error, '')
+        self.assertEqual(list(self.read_archive(content).items()), list(self.contents.items()))
+        self.assertEqual(archived, list(pictures))
+
+    def test_get_archive_pictures_filters_dates_and_hidden(self):
+        """ Confirm we only archive pictures created in the date range, and hidden pictures if requested """
+        pictures, error = Picture.get_archive_pictures(start='2024-06-02', end='2024-06-03')
+        self.assertEqual([os.path.basename(picture.file.name) for picture in pictures], self.names[1:2])
+        Picture.objects.filter(file__endswith=self.names[0]).update(hidden=True)
+        pictures, error = Picture.get_archive_pictures()
+        self.assertEqual(len(pictures), 2)
+        pictures, error = Picture.get_archive_pictures(include_hidden=True)
+        self.assertEqual(len(pictures), 3)
+
+    def test_get_archive_pictures_invalid_dates_returns_error(self):
+        """ Confirm we return an error if the dates are invalid """
+        pictures, error = Picture.get_archive_pictures(start='invalid')
+        self.assertIsNone(pictures)
+        self.assertEqual(error, 'Sorry, those dates aren\'t valid')
+
+    def test_stream_archive_skips_unreadable_files(self):
+        """ Confirm pictures whose files can't be read are left out of the archive """
+        Picture.objects.create(file='memories/test/missing.gif')
+        pictures, error = Picture.get_archive_pictures(include_hidden=True)
+        with self.assertLogs('memories.models', 'WARNING'):
+            content = b''.join(Picture.stream_archive(pictures=pictures))
+        self.assertEqual(self.read_archive(content), self.contents)
+
+    def test_export_pictures_command_writes_archive(self):
+        """ Confirm the command writes the archive of the pictures in the date range to a file """
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'pictures.zip')
+            stderr = StringIO()
+            call_command('export_pictures', output=output, start='2024-06-02', stderr=stderr)
+            with open(output, 'rb') as file:
+                self.assertEqual(self.read_archive(file.read()), {name: self.contents[name] for name in self.names[1:]})
+        self.assertIn('Exported 2 pictures', stderr.getvalue())
+
+    def test_export_pictures_command_failure_reports_resume_start(self):
+        """ Confirm the command reports the created datetime to resume from if the export fails part way """
+        read_archive_file = Picture.read_archive_file
+
+        def fail_chunks():
+            raise OSError('Unable to read')
+            yield
+
+        def fail_last_file(name, chunk_size):
+            file = read_archive_file(name, chunk_size)
+            return (file[0], fail_chunks()) if name.endswith(self.names[-1]) else file
+
+        with tempfile.TemporaryDirectory() as directory:
+            with patch.object(Picture, 'read_archive_file', side_effect=fail_last_file):
+                with self.assertRaisesMessage(CommandError, 'resume with --start 2024-06-02'):
+                    call_command('export_pictures', output=os.path.join(directory, 'pictures.zip'))
+
+
+class MediaStorageTest(TestCase):
+    """ Test suite for MediaStorage presigned uploads """
+
+    def setUp(self):
+        """ Initialise a storage with a stubbed S3 client, so no requests are made """
+        self.storage = MediaStorage(access_key='test', secret_key='test', region_name='us-east-1')
+        self.stubber = Stubber(self.storage.connection.meta.client)
+        self.stubber.activate()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def test_generate_presigned_upload_post_limits_size_and_type(self):
+        """ Confirm the presigned POST is for the file's key, and its policy limits the size and content type """
+        upload = self.storage.generate_presigned_upload(
+            name='memories/picture.jpg', content_type='image/jpeg', max_size=100, expires_in=60
+        )
+        policy = json.loads(base64.b64decode(upload['fields']['policy']))
+        self.assertEqual(upload['method'], 'POST')
+        self.assertEqual(upload['fields']['key'], 'memories/picture.jpg')
+        self.assertIn(['content-length-range', 1, 100], policy['conditions'])
+        self.assertIn({'Content-Type': 'image/jpeg'}, policy['conditions'])
+
+    def test_generate_presigned_upload_put(self):
+        """ Confirm the presigned PUT URL is for the file's key """
+        upload = self.storage.generate_presigned_upload(
+            name='memories/picture.jpg', content_type='image/jpeg', max_size=100, expires_in=60, method='put'
+        )
+        self.assertEqual(upload['method'], 'PUT')
+        self.assertIn('/memories/picture.jpg?', upload['url'])
+        self.assertEqual(upload['headers'].get('Content-Type'), 'image/jpeg')
+
+    def test_public_url_base_matches_storage_url(self):
+        """ Confirm URLs built from the public URL base match the storage's URLs, including names that need quoting """
+        names = ('memories/picture.jpg', 'memories/a picture #1 (café).jpg', 'memories/test/picture-thumbnail.webp')
+        for name in names:
+            self.assertEqual(f'{self.storage.public_url_base}{filepath_to_uri(name)}', self.storage.url(name))
+
+    def test_public_url_base_signed_urls_returns_none(self):
+        """ Confirm there's no public URL base if file URLs are signed, or there's no custom domain """
+        self.assertIsNone(MediaStorage(querystring_auth=True, cloudfront_signer=lambda: None).public_url_base)
+        self.assertIsNone(MediaStorage(custom_domain=None).public_url_base)
+
+    def test_get_object_metadata(self):
+        """ Confirm we return the file's size and content type from a HEAD request, or None if it doesn't exist """
+        bucket_name = self.storage.bucket_name
+        self.stubber.add_response(
+            'head_object', {'ContentLength': 100, 'ContentType': 'image/jpeg'},
+            {'Bucket': bucket_name, 'Key': 'memories/picture.jpg'},
+        )
+        self.stubber.add_client_error('head_object', service_error_code='404', http_status_code=404)
+        self.assertEqual(
+            self.storage.get_object_metadata('memories/picture.jpg'), {'size': 100, 'content_type': 'image/jpeg'}
+        )
+        self.assertIsNone(self.storage.get_object_metadata('memories/missing.jpg'))
+
+    def test_connection_shared_by_storages(self):
+        """ Confirm storages with the same credentials share a connection, whichever thread they're used from """
+        storage = MediaStorage(access_key='test', secret_key='test', region_name='us-east-1')
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            connection = executor.submit(lambda: storage.connection).result()
+        self.assertIs(connection, self.storage.connection)
+        other_storage = MediaStorage(access_key='other', secret_key='test', region_name='us-east-1')
+        self.assertIsNot(other_storage.connection, connection)
+
+    def test_delete_many_deletes_in_batches(self):
+        """ Confirm we delete up to 1,000 files per request, and return the names of any that couldn't be deleted """
+        names = [f'memories/picture-{index}.jpg' for index in range(1500)]
+        for batch in (names[:1000], names[1000:]):
+            self.stubber.add_response(
+                'delete_objects',
+                {'Errors': [{'Key': batch[0], 'Code': 'AccessDenied'}]},
+                {
+                    'Bucket': self.storage.bucket_name,
+                    'Delete': {'Objects': [{'Key': name} for name in batch], 'Quiet': True},
+                },
+            )
+        self.assertEqual(self.storage.delete_many(names), [names[0], names[1000]])
+        self.stubber.assert_no_pending_responses()
+
+    def test_list_names_lists_every_page(self):
+        """ Confirm we list the name of every file under the prefix, across pages """
+        bucket_name = self.storage.bucket_name
+        self.stubber.add_response(
+            'list_objects_v2',
+            {
+                'Contents': [{'Key': 'memories/a.jpg', 'Size': 1, 'LastModified': timezone.now()}],
+                'IsTruncated': True,
+                'NextContinuationToken': 'next',
+            },
+            {'Bucket': bucket_name, 'Prefix': 'memories/'},
+        )
+        self.stubber.add_response(
+            'list_objects_v2',
+            {'Contents': [{'Key': 'memories/b.jpg', 'Size': 1, 'LastModified': timezone.now()}], 'IsTruncated': False},
+            {'Bucket': bucket_name, 'Prefix': 'memories/', 'ContinuationToken': 'next'},
+        )
+        self.assertEqual(list(self.storage.list_names('memories/')), ['memories/a.jpg', 'memories/b.jpg'])
+
+    def test_iter_chunks_streams_object(self):
+        """ Confirm we stream the file from the bucket in chunks """
+        content = b'0123456789' * 10
+        self.stubber.add_response(
+            'get_object',
+            {'Body': StreamingBody(BytesIO(content), len(content)), 'ContentLength': len(content)},
+            {'Bucket': self.storage.bucket_name, 'Key': 'memories/picture.jpg'},
+        )
+        chunks = list(self.storage.iter_chunks('memories/picture.jpg', chunk_size=30))
+        self.assertEqual(b''.join(chunks), content)
+        self.assertEqual([len(chunk) for chunk in chunks], [30, 30, 30, 10])
+
+
+class InMemoryMediaStorageTest(TestCase):
+    """ Test suite for the in-memory media storage used by tests """
+
+    def setUp(self):
+        self.storage = InMemoryMediaStorage()
+        for name in ('memories/a.jpg', 'memories/test/b.jpg', 'other/c.jpg'):
+            self.storage.save(name, ContentFile(b'123'))
+
+    def test_url_matches_bucket_url(self):
+        """ Confirm file URLs match the URLs they'd have in the S3 bucket """
+        self.assertEqual(self.storage.url('memories/a.jpg'), f'https://{settings.AWS_S3_CUSTOM_DOMAIN}/memories/a.jpg')
+        self.assertEqual(f'{self.storage.public_url_base}memories/a.jpg', self.storage.url('memories/a.jpg'))
+
+    def test_list_names_and_delete_many(self):
+        """ Confirm we list every file under a prefix, including subdirectories, and delete them """
+        names = sorted(self.storage.list_names('memories/'))
+        self.assertEqual(names, ['memories/a.jpg', 'memories/test/b.jpg'])
+        self.assertEqual(list(self.storage.list_names('missing/')), [])
+        self.assertEqual(self.storage.delete_many(names), [])
+        self.assertFalse(any(self.storage.exists(name) for name in names))
+        self.assertTrue(self.storage.exists('other/c.jpg'))
+
+    def test_get_object_metadata(self):
+        """ Confirm we return the file's size and content type, or None if it doesn't exist """
+        self.assertEqual(self.storage.get_object_metadata('memories/a.jpg'), {'size': 3, 'content_type': 'image/jpeg'})
+        self.assertIsNone(self.storage.get_object_metadata('memories/missing.jpg'))
+
+
+class UploadJobTest(TestCase):
+    """ Test suite for UploadJob and UploadJobPicture models """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        images = generate_base_64_images(image_count=3)
+        cls.pictures = [{'fileSrc': image, 'name': f'picture-{i}.gif'} for i, image in enumerate(images)]
+
+    @classmethod
+    def tearDownClass(cls):
+        """ Custom teardown to delete temp files created in tests """
+        # For deleting S3 bucket files
+        delete_test_files()
+
+        super().tearDownClass()
+
+    #                                                                                 create_upload_job(picture_files)
+    def test_create_upload_job_empty_picture_files_list_returns_error(self):
+        """ Confirm we return an error and don't create a job if there are no pictures """
+        upload_job, error = UploadJob.create_upload_job(picture_files=[])
+        self.assertIsNone(upload_job)
+        self.assertEqual(error, 'Please upload at least one picture')
+        self.assertFalse(UploadJob.objects.exists())
+
+    def test_create_upload_job_stages_pictures_without_processing(self):
+        """ Confirm we stage the decoded uploads as pending pictures, without creating any Picture instances """
+        image = base64.b64decode(settings.TEST_BASE_64_IMAGE.split(';base64,')[-1])
+        upload_job, error = UploadJob.create_upload_job(
+            picture_files=[*self.pictures, SimpleUploadedFile('upload.gif', image, content_type='image/gif')]
+        )
+        self.assertEqual(error, '')
+        job_pictures = list(upload_job.pictures.order_by('id'))
+        self.assertEqual(
+            [job_picture.name for job_picture in job_pictures[:3]], [picture['name'] for picture in self.pictures]
+        )
+        self.assertEqual(bytes(job_pictures[0].data), base64.b64decode(self.pictures[0]['fileSrc'].split(',')[-1]))
+        self.assertFalse(job_pictures[0].is_base64)
+        self.assertEqual(bytes(job_pictures[-1].data), image)
+        self.assertFalse(job_pictures[-1].is_base64)
+        self.assertTrue(all(job_picture.status == 'pending' for job_picture in job_pictures))
+        self.assertFalse(Picture.objects.exists())
+
+    def test_create_upload_job_stages_each_picture_with_its_own_insert(self):
+        """ Confirm each picture is staged with its own INSERT, and invalid pictures are staged as failed """
+        with CaptureQueriesContext(connection) as context:
+            upload_job, error = UploadJob.create_upload_job(
+                picture_files=[*self.pictures, {'fileSrc': 'invalid', 'name': 'invalid.gif'}]
+            )
+        sqls = [query['sql'] for query in context.captured_queries]
+        self.assertEqual(len([sql for sql in sqls if sql.startswith('INSERT INTO "memories_uploadjobpicture"')]), 4)
+        job_picture = upload_job.pictures.get(name='invalid.gif')
+        self.assertEqual((job_picture.status, bytes(job_picture.data)), ('failed', b''))
+
+    def test_create_upload_job_database_error_returns_error(self):
+        """ Confirm we return an error, and don't leave a partial job, if the pictures can't be staged """
+        with patch.object(UploadJobPicture, 'save', side_effect=DatabaseError('Unable to insert')):
+            with self.assertLogs('memories.models', 'ERROR'):
+                upload_job, error = UploadJob.create_upload_job(picture_files=self.pictures)
+        self.assertIsNone(upload_job)
+        self.assertEqual(error, 'We were unable to upload your pictures, please try again')
+        self.assertFalse(UploadJob.objects.exists())
+
+    #                                                                                                    get_progress()
+    def test_get_progress_returns_status_counts(self):
+        """ Confirm we return the number of pictures with each status and the job's overall status """
+        upload_job, error = UploadJob.create_upload_job(picture_files=self.pictures)
+        self.assertEqual(upload_job.get_progress(), {
+            'status': 'pending', 'total': 3, 'pending': 3, 'processing': 0, 'complete': 0, 'failed': 0
+        })
+        UploadJobPicture.process_pictures(job_pictures=UploadJobPicture.claim_pictures(batch_size=2))
+        self.assertEqual(upload_job.get_progress().get('status'), 'processing')
+        UploadJobPicture.process_pictures(job_pictures=UploadJobPicture.claim_pictures(batch_size=2))
+        self.assertEqual(upload_job.get_progress(), {
+            'status': 'complete', 'total': 3, 'pending': 0, 'processing': 0, 'complete': 3, 'failed': 0
+        })
+
+    #                                                                                       claim_pictures(batch_size)
+    def test_claim_pictures_claims_pending_pictures(self):
+        """ Confirm we claim up to batch_size pending pictures, and don't claim them again """
+        UploadJob.create_upload_job(picture_files=self.pictures)
+        claimed = UploadJobPicture.claim_pictures(batch_size=2)
+        self.assertEqual(len(claimed), 2)
+        self.assertTrue(all(job_picture.status == 'processing' for job_picture in claimed))
+        self.assertTrue(all(job_picture.attempts == 1 for job_picture in claimed))
+        remaining = UploadJobPicture.claim_pictures(batch_size=2)
+        self.assertEqual(len(remaining), 1)
+        self.assertNotIn(remaining[0], claimed)
+
+    @override_settings(UPLOAD_JOB_TIMEOUT=60)
+    def test_claim_pictures_reclaims_timed_out_pictures(self):
+        """ Confirm we reclaim pictures that have been processing for longer than the timeout """
+        UploadJob.create_upload_job(picture_files=self.pictures[:1])
+        UploadJobPicture.claim_pictures(batch_size=1)
+        self.assertEqual(UploadJobPicture.claim_pictures(batch_size=1), [])
+        UploadJobPicture.objects.update(modified=timezone.now() - timedelta(seconds=120))
+        reclaimed = UploadJobPicture.claim_pictures(batch_size=1)
+        self.assertEqual(len(reclaimed), 1)
+        self.assertEqual(reclaimed[0].attempts, 2)
+
+    #                                                                                  process_pictures(job_pictures)
+    def test_process_pictures_creates_pictures_and_records_results(self):
+        """ Confirm we create the pictures, record the result for each, and clear the staged data """
+        upload_job, error = UploadJob.create_upload_job(
+            picture_files=[*self.pictures, {'fileSrc': 'invalid', 'name': 'invalid.gif'}]
+        )
+        UploadJobPicture.process_pictures(job_pictures=UploadJobPicture.claim_pictures(batch_size=10))
+        job_pictures = list(upload_job.pictures.order_by('id'))
+        self.assertEqual(Picture.objects.count(), 3)
+        self.assertEqual([job_picture.status for job_picture in job_pictures], ['complete'] * 3 + ['failed'])
+        self.assertEqual({job_picture.picture for job_picture in job_pictures[:3]}, set(Picture.objects.all()))
+        self.assertEqual(job_pictures[-1].error, 'We were unable to read this picture')
+        self.assertTrue(all(bytes(job_picture.data) == b'' for job_picture in job_pictures))
+
+    @override_settings(PICTURE_UPLOAD_MAX_FILES=3)
+    def test_process_pictures_batch_across_jobs_ignores_request_limits(self):
+        """ Confirm a batch of pictures from several jobs is processed even if it's over the per-request limits """
+        images = generate_base_64_images(image_count=6)
+        upload_jobs = [
+            UploadJob.create_upload_job(
+                picture_files=[{'fileSrc': image, 'name': f'batch-{i}.gif'} for i, image in enumerate(job_images)]
+            )[0]
+            for job_images in (images[:3], images[3:])
+        ]
+        UploadJobPicture.process_pictures(job_pictures=UploadJobPicture.claim_pictures(batch_size=10))
+        self.assertEqual(Picture.objects.count(), 6)
+        for upload_job in upload_jobs:
+            self.assertEqual(upload_job.get_progress().get('complete'), 3)
+        self.assertTrue(all(bytes(job_picture.data) == b'' for job_picture in UploadJobPicture.objects.all()))
+
+    def test_process_pictures_keeps_data_of_pictures_without_result(self):
+        """ Confirm pictures that don't get a result are left processing, with their staged data, to be retried """
+        UploadJob.create_upload_job(picture_files=self.pictures[:2])
+        with patch.object(Picture, 'upload_pictures', return_value=([], [], 'error')):
+            UploadJobPicture.process_pictures(job_pictures=UploadJobPicture.claim_pictures(batch_size=10))
+        for job_picture in UploadJobPicture.objects.all():
+            self.assertEqual(job_picture.status, 'processing')
+            self.assertNotEqual(bytes(job_picture.data), b'')
+
+    @override_settings(UPLOAD_JOB_MAX_ATTEMPTS=1)
+    def test_process_pictures_fails_pictures_over_max_attempts(self):
+        """ Confirm we fail pictures that have been attempted too many times, without processing them """
+        UploadJob.create_upload_job(picture_files=self.pictures[:1])
+        job_pictures = UploadJobPicture.claim_pictures(batch_size=1)
+        job_pictures[0].attempts = 2
+        UploadJobPicture.process_pictures(job_pictures=job_pictures)
+        job_picture = UploadJobPicture.objects.get()
+        self.assertEqual(job_picture.status, 'failed')
+        self.assertEqual(job_picture.error, 'We were unable to upload this picture')
+        self.assertFalse(Picture.objects.exists())
+
+    #                                                                                              run_upload_worker
+    def test_run_upload_worker_processes_queue(self):
+        """ Confirm the worker processes every staged picture and exits once the queue is empty """
+        upload_job, error = UploadJob.create_upload_job(picture_files=self.pictures)
+        call_command('run_upload_worker', '--once', '--batch-size', '2', stderr=StringIO())
+        self.assertEqual(upload_job.get_progress().get('complete'), 3)
+        self.assertEqual(Picture.objects.count(), 3)
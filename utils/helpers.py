@@ -1,46 +1,402 @@
-import random
+import csv
+import hashlib
+import json
+import mimetypes
+import secrets
 import string
+import tempfile
+import threading
+import time
+import zipfile
 import base64
-import boto3
+import binascii
+from io import BytesIO
+
+from PIL import Image, ImageOps
 
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date, quote_etag
+
+from data.constants import RANDOM_STRING_LENGTH, CACHE_COUNTER_KEY
+
 
-from data.constants import RANDOM_STRING_LENGTH
+RANDOM_STRING_CHARACTERS = string.ascii_lowercase + string.digits
 
 
 def generate_random_string(length=RANDOM_STRING_LENGTH):
-    """ Generate a random alphanumeric string of a specified length """
-    return ''.join(random.choices(string.ascii_letters + string.digits, k=length)).lower()
+    """ Generate a random lowercase alphanumeric string of a specified length """
+    return ''.join(secrets.choice(RANDOM_STRING_CHARACTERS) for _ in range(length))
+
+
+def generate_random_strings(count, length=RANDOM_STRING_LENGTH):
+    """ Generate a set of distinct random lowercase alphanumeric strings of a specified length """
+    random_strings = set()
+    while len(random_strings) < count:
+        random_strings.add(generate_random_string(length=length))
+
+    return random_strings
+
+
+# Length of each chunk of a base 64 string decoded by convert_base_64_string_to_file - a multiple of 4, so each chunk
+# decodes on its own (768KB decoded)
+BASE_64_DECODE_CHUNK_SIZE = 4 * 256 * 1024
+
+
+def check_image_mime_type(mime_type, filename):
+    """ Raise ValueError if a MIME type isn't an image, or doesn't match the type of the filename's extension """
+    expected_mime_type = mimetypes.guess_type(filename)[0]
+    if not mime_type.startswith('image/') or (expected_mime_type and mime_type != expected_mime_type):
+        raise ValueError(f'Invalid MIME type {mime_type} for {filename}')
+
+
+def identify_image(image_file):
+    """
+    Raise ValueError if Pillow can't identify a file as an image - only the file's header is read, and the file is
+    rewound after
+    """
+    try:
+        with Image.open(image_file):
+            pass
+    except Exception as error:
+        # Pillow raises a range of errors for unidentified or oversized images
+        raise ValueError(f'Unable to identify image {image_file.name}') from error
+    finally:
+        image_file.seek(0)
 
 
 def convert_base_64_string_to_file(base64_string, filename):
-    """ Convert a base 64 string to a Django-savable file format """
-    # Get the format, string and extension
-    file_format, file_string = base64_string.split(';base64,')
-    name = filename
-    data = ContentFile(base64.b64decode(file_string), name=name)
+    """
+    Convert a base 64 data URI (str or bytes) to a Django-savable file, with its size and sha256 hex digest set
+    The data is decoded in chunks into a SpooledTemporaryFile, so only one chunk is copied at a time, and large files
+    are written to disk rather than held in memory (see FILE_UPLOAD_MAX_MEMORY_SIZE) - each chunk is hashed as it's
+    decoded, so the file isn't read again to hash it
+    Raises ValueError if the data URI is invalid, or its MIME type isn't an image or doesn't match the filename
+    """
+    separator = ';base64,' if isinstance(base64_string, str) else b';base64,'
+    header_end = base64_string.find(separator)
+    if header_end == -1:
+        raise ValueError('Invalid data URI')
+
+    # e.g. data:image/jpeg;base64,... - the header is only sliced (copied) on its own
+    header = base64_string[:header_end]
+    header = header if isinstance(header, str) else header.decode('ascii', errors='replace')
+    check_image_mime_type(mime_type=header.removeprefix('data:').split(';')[0].lower(), filename=filename)
+
+    # Slicing a memoryview doesn't copy the data, whereas slicing bytes does
+    data = base64_string if isinstance(base64_string, str) else memoryview(base64_string)
+    file = tempfile.SpooledTemporaryFile(
+        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, dir=settings.FILE_UPLOAD_TEMP_DIR
+    )
+    size, file_hash = 0, hashlib.sha256()
+    try:
+        for start in range(header_end + len(separator), len(data), BASE_64_DECODE_CHUNK_SIZE):
+            chunk = binascii.a2b_base64(data[start:start + BASE_64_DECODE_CHUNK_SIZE])
+            file_hash.update(chunk)
+            size += file.write(chunk)
+    except Exception:
+        file.close()
+        raise
+    file.seek(0)
+
+    picture_file = File(file, name=filename)
+    picture_file.size, picture_file.sha256 = size, file_hash.hexdigest()
+    return picture_file
+
+
+class HashingUploadHandlerMixin:
+    """ Upload handler mixin that hashes each file it receives, and sets its sha256 hex digest on the uploaded file """
+
+    def new_file(self, *args, **kwargs):
+        self.file_hash = hashlib.sha256()
+        return super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super().receive_data_chunk(raw_data, start)
+        # The chunk is only passed on (returned) if the handler hasn't written it
+        if data is None:
+            self.file_hash.update(raw_data)
+        return data
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.sha256 = self.file_hash.hexdigest()
+        return uploaded_file
 
-    return data
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    """ Upload handler for files up to FILE_UPLOAD_MAX_MEMORY_SIZE, which are held in memory """
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    """ Upload handler for larger files, which are streamed to a temp file """
+
+
+def hash_file(file):
+    """
+    Get the sha256 hex digest of a file's content, reading it in chunks so it's never copied in full - for files that
+    weren't hashed as they were received (see convert_base_64_string_to_file and HashingUploadHandlerMixin)
+    """
+    file_hash = hashlib.sha256()
+    for chunk in file.chunks():
+        file_hash.update(chunk)
+    file.seek(0)
+
+    return file_hash.hexdigest()
+
+
+# Formats that are re-encoded by normalize_image, and the format each is saved in - others (e.g. animated GIFs) are
+# stored as uploaded
+NORMALIZED_IMAGE_FORMATS = {'JPEG': 'JPEG', 'MPO': 'JPEG', 'PNG': 'PNG', 'WEBP': 'WEBP'}
+
+
+def normalize_image(image_file, max_dimension, quality):
+    """
+    Re-encode an image with its EXIF orientation applied, its metadata stripped and its longest edge capped at
+    max_dimension, returning the re-encoded image as a ContentFile - or None if the image's format isn't re-encoded
+    JPEGs are decoded in draft mode, at the smallest scale (1/2, 1/4 or 1/8) that is still larger than max_dimension,
+    so pictures at least twice max_dimension (e.g. large phone pictures) are never decoded at full size
+    Raises OSError (including PIL.UnidentifiedImageError) if the file isn't a readable image
+    """
+    image_file.seek(0)
+    with Image.open(image_file) as original:
+        image_format = NORMALIZED_IMAGE_FORMATS.get(original.format)
+        # Animated images would lose their animation - MPOs (phone JPEGs with an embedded preview) are kept as JPEGs
+        if not image_format or (getattr(original, 'n_frames', 1) > 1 and image_format != 'JPEG'):
+            image_file.seek(0)
+            return None
+
+        icc_profile = original.info.get('icc_profile')
+        # Only JPEGs support draft mode - thumbnail would otherwise draft at twice the size, to reduce aliasing
+        original.draft(None, (max_dimension, max_dimension))
+        # Resize (in place) before applying the orientation, so only the resized image is copied - exif_transpose
+        # returns a copy without the orientation tag
+        original.thumbnail((max_dimension, max_dimension))
+        image = ImageOps.exif_transpose(original)
+        if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+    buffer = BytesIO()
+    # Only the colour profile is kept - EXIF (including GPS) and other metadata aren't written
+    options = {'optimize': True} if image_format == 'PNG' else {'quality': quality}
+    image.save(buffer, format=image_format, icc_profile=icc_profile, **options)
+    image_file.seek(0)
+
+    return ContentFile(buffer.getvalue())
+
+
+def create_image_renditions(image_file, sizes, formats, quality):
+    """
+    Create resized copies of an image, capped at each size (longest edge), in each format (e.g. 'webp', 'jpeg')
+    Returns a dict of {rendition: {'width', 'height', 'files': {format: ContentFile}}} - each rendition is resized from
+    the previous (larger) one, so the original is only decoded once
+    Raises OSError (including PIL.UnidentifiedImageError) if the file isn't a readable image
+    """
+    image_file.seek(0)
+    renditions = {}
+    with Image.open(image_file) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+        for rendition, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+            image.thumbnail((size, size))
+            files = {}
+            for image_format in formats:
+                buffer = BytesIO()
+                image.save(buffer, format=image_format.upper(), quality=quality)
+                files[image_format] = ContentFile(buffer.getvalue())
+            renditions[rendition] = {'width': image.width, 'height': image.height, 'files': files}
+    image_file.seek(0)
+
+    return renditions
 
 
 def delete_test_files():
-    """ Delete all test files on TearDown in test suites """
+    """ Delete all test files on TearDown in test suites, in batches through the media storage (see custom_storages) """
+    default_storage.delete_many(default_storage.list_names('memories/test/'))
+
+
+def run_in_background(function, **kwargs):
+    """ Run a function in a daemon thread, e.g. storage calls that needn't delay a response - returns the thread """
+    thread = threading.Thread(target=function, kwargs=kwargs, daemon=True)
+    thread.start()
+
+    return thread
 
-    # Initiate the S3 client
-    s3_client = boto3.resource(
-        's3',
-        aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY
-    )
-    bucket_name = settings.AWS_STORAGE_BUCKET_NAME
-    bucket = s3_client.Bucket(bucket_name)
 
-    objects_to_delete = []
-    objects = bucket.objects.filter(Prefix=f'memories/test/')
-    objects_to_delete.extend(
-        [{'Key': o.key} for o in objects]
+def increment_cache_counter(name, counter):
+    """ Increment a named cache counter (e.g. hits or misses), creating it if it doesn't exist """
+    key = CACHE_COUNTER_KEY.format(name=name, counter=counter)
+    # add() is a no-op if the key exists, so the counter is never reset by a concurrent request
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter was evicted between add() and incr()
+        cache.set(key, 1, timeout=None)
+
+
+def get_cache_stats(name):
+    """ Return the hit and miss counters for a named cache """
+    keys = {counter: CACHE_COUNTER_KEY.format(name=name, counter=counter) for counter in ('hits', 'misses')}
+    values = cache.get_many(keys.values())
+    return {counter: values.get(key, 0) for counter, key in keys.items()}
+
+
+def take_rate_limit_tokens(key, tokens, rate, capacity):
+    """
+    Take tokens from a token bucket in the cache, which holds up to capacity tokens and is refilled at rate tokens per
+    second - returns 0 if the tokens were taken, else the number of seconds until they can be, or None if they never
+    can be (there are more tokens than the bucket holds)
+    The bucket is read and written without a lock, so concurrent requests may occasionally take more than the limit
+    """
+    if tokens > capacity:
+        return None
+
+    now = time.time()
+    available, updated = cache.get(key) or (capacity, now)
+    available = min(capacity, available + (now - updated) * rate)
+    wait = 0 if tokens <= available else (tokens - available) / rate
+    if not wait:
+        available -= tokens
+    # The bucket is full again (so needn't be stored) once it's been refilled for capacity / rate seconds
+    cache.set(key, (available, now), timeout=int(capacity / rate) + 1)
+
+    return wait
+
+
+def get_base_64_decoded_size(base64_string):
+    """ Get the size (bytes) of a base 64 string (or data URI), str or bytes, once it's decoded, without decoding it """
+    separator, pad = (';base64,', '=') if isinstance(base64_string, str) else (b';base64,', b'=')
+    header_end = base64_string.find(separator)
+    length = len(base64_string) - (header_end + len(separator) if header_end != -1 else 0)
+    padding = 2 if base64_string.endswith(pad * 2) else 1 if base64_string.endswith(pad) else 0
+
+    return max(length * 3 // 4 - padding, 0)
+
+
+class Echo:
+    """ A file-like object that returns each written value, rather than storing it - for streaming CSV rows """
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows, fields):
+    """ Yield a CSV header line, then a CSV line for each row (dict) """
+    writer = csv.DictWriter(Echo(), fieldnames=fields, extrasaction='ignore')
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_json(rows):
+    """ Yield a JSON array of rows (dicts) one row at a time """
+    yield '['
+    for index, row in enumerate(rows):
+        yield f'{"," if index else ""}{json.dumps(row, default=str)}'
+    yield ']'
+
+
+class ZipStream:
+    """ An unseekable file-like object that collects the bytes written to it, so stream_zip can yield them """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """ Return (and clear) the bytes written since the last pop """
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def stream_zip(files):
+    """
+    Yield a ZIP64 archive of files - (name, date_time, chunks) tuples, where chunks is an iterable of bytes - as it's
+    written, so neither the archive nor any file is held in memory in full
+    Files are stored without compression (pictures are already compressed), each followed by a data descriptor with
+    its size and CRC, as the stream can't be seeked back to write them in its header
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for name, date_time, chunks in files:
+            with archive.open(zipfile.ZipInfo(name, date_time=date_time), mode='w', force_zip64=True) as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    yield stream.pop()
+            yield stream.pop()
+    yield stream.pop()
+
+
+def parse_datetime_param(value):
+    """
+    Parse an ISO date or datetime (e.g. a query param) as an aware datetime - dates are parsed as midnight, and naive
+    datetimes in the current timezone - or None if it's empty
+    Raises ValueError if the value isn't a valid date or datetime
+    """
+    if not value:
+        return None
+
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError(f'Invalid date {value}')
+        parsed = timezone.datetime(date.year, date.month, date.day)
+
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+
+def generate_etag(data):
+    """ Generate a quoted ETag from a hash of JSON-serializable data """
+    content = json.dumps(data, sort_keys=True, default=str).encode()
+    return quote_etag(hashlib.md5(content, usedforsecurity=False).hexdigest())
+
+
+def generate_content_etag(content):
+    """ Generate a quoted ETag from a hash of encoded content (bytes) """
+    return quote_etag(hashlib.md5(content, usedforsecurity=False).hexdigest())
+
+
+def get_not_modified_response(request, etag, last_modified):
+    """
+    Return a 304 Not Modified response if the client's copy (If-None-Match/If-Modified-Since) is current, else None
+    """
+    return get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified.timestamp()) if last_modified else None
     )
 
-    if len(objects_to_delete):
-        s3_client.meta.client.delete_objects(Bucket=bucket_name, Delete={'Objects': objects_to_delete})
+
+def set_conditional_headers(response, etag, last_modified, **cache_control):
+    """ Set the ETag, Last-Modified and Cache-Control headers to allow clients to make conditional requests """
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_cache_control(response, **cache_control)
+
+    return response
+
+
+def encode_cursor(values):
+    """ Encode a list of JSON-serializable values as an opaque, URL-safe pagination cursor """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ Decode a pagination cursor created by encode_cursor - raises ValueError if the cursor is invalid """
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, json.JSONDecodeError) as error:
+        raise ValueError('Invalid cursor') from error
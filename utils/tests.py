@@ -1,8 +1,24 @@
-from django.test import TestCase
-from django.core.files.base import ContentFile
+import base64
+import hashlib
+import json
+import os
+import zipfile
+from datetime import datetime, timezone as dt_timezone
+from io import BytesIO
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.core.files.base import ContentFile, File
 from django.conf import settings
+from django.utils import timezone
+
+from PIL import Image
 
-from .helpers import generate_random_string, convert_base_64_string_to_file
+from .helpers import (
+    generate_random_string, generate_random_strings, convert_base_64_string_to_file, increment_cache_counter,
+    get_cache_stats, stream_csv, stream_json, encode_cursor, decode_cursor, normalize_image, take_rate_limit_tokens,
+    get_base_64_decoded_size, BASE_64_DECODE_CHUNK_SIZE, stream_zip, parse_datetime_param,
+)
 from data.constants import RANDOM_STRING_LENGTH
 
 
@@ -22,6 +38,23 @@ class GenerateRandomStringTest(TestCase):
         self.assertEqual(len(random_string), custom_length)
         self.assertTrue(random_string.isalnum())
 
+    def test_generate_random_string_lowercase(self):
+        """ Confirm we return a lowercase string """
+        random_string = generate_random_string()
+        self.assertEqual(random_string, random_string.lower())
+
+
+class GenerateRandomStringsTest(TestCase):
+    """ Test module for generate_random_strings helper method """
+
+    def test_generate_random_strings_returns_distinct_strings(self):
+        """ Confirm we return a set of the specified number of alphanumeric strings """
+        random_strings = generate_random_strings(count=100)
+        self.assertEqual(len(random_strings), 100)
+        for random_string in random_strings:
+            self.assertEqual(len(random_string), RANDOM_STRING_LENGTH)
+            self.assertTrue(random_string.isalnum())
+
 
 class ConvertBase64StringToFileHelperTest(TestCase):
     """ Test module for convert_base_64_string_to_file helper method """
@@ -34,5 +67,209 @@ class ConvertBase64StringToFileHelperTest(TestCase):
     def test_convert_base_64_string_to_file_image_returns_correct_file_convert_extension_false(self):
         """ Confirm we return a file instance when passed a base 64 string gif image """
         data = convert_base_64_string_to_file(base64_string=self.image, filename='test-image.gif')
-        self.assertIsInstance(data, ContentFile)
+        self.assertIsInstance(data, File)
         self.assertEqual('test-image.gif', data.name)
+        self.assertEqual(data.read(), base64.b64decode(self.image.split(';base64,')[-1]))
+        self.assertEqual(data.size, len(base64.b64decode(self.image.split(';base64,')[-1])))
+
+    def test_convert_base_64_string_to_file_bytes_returns_correct_file(self):
+        """ Confirm we decode a base 64 data URI passed as bytes """
+        data = convert_base_64_string_to_file(base64_string=self.image.encode(), filename='test-image.gif')
+        self.assertEqual(data.read(), base64.b64decode(self.image.split(';base64,')[-1]))
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=1024)
+    def test_convert_base_64_string_to_file_large_file_decoded_in_chunks_to_disk(self):
+        """ Confirm we decode a file larger than a chunk, and write it to disk once it's over the max memory size """
+        content = os.urandom(BASE_64_DECODE_CHUNK_SIZE * 2)
+        base64_string = f'data:image/jpeg;base64,{base64.b64encode(content).decode()}'
+        data = convert_base_64_string_to_file(base64_string=base64_string, filename='test-image.jpg')
+        self.assertEqual(data.size, len(content))
+        self.assertTrue(data.file._rolled)
+        self.assertEqual(data.read(), content)
+        self.assertEqual(data.sha256, hashlib.sha256(content).hexdigest())
+
+    def test_convert_base_64_string_to_file_mismatched_mime_type_raises_error(self):
+        """ Confirm we raise a ValueError if the MIME type isn't an image, or doesn't match the file extension """
+        with self.assertRaises(ValueError):
+            convert_base_64_string_to_file(base64_string=self.image, filename='test-image.png')
+        with self.assertRaises(ValueError):
+            convert_base_64_string_to_file(base64_string='data:text/html;base64,PGI+', filename='test-image')
+
+    def test_convert_base_64_string_to_file_invalid_data_uri_raises_error(self):
+        """ Confirm we raise a ValueError if the string isn't a base 64 data URI """
+        with self.assertRaises(ValueError):
+            convert_base_64_string_to_file(base64_string='invalid', filename='test-image.gif')
+
+
+class CacheCounterHelpersTest(TestCase):
+    """ Test module for increment_cache_counter and get_cache_stats helper methods """
+
+    def setUp(self):
+        """ Clear the cache counters between tests """
+        cache.clear()
+
+    def test_get_cache_stats_default(self):
+        """ Confirm we return zero hits and misses for a cache that hasn't been used """
+        self.assertEqual(get_cache_stats(name='test'), {'hits': 0, 'misses': 0})
+
+    def test_increment_cache_counter(self):
+        """ Confirm we increment the specified counter """
+        increment_cache_counter(name='test', counter='hits')
+        increment_cache_counter(name='test', counter='hits')
+        increment_cache_counter(name='test', counter='misses')
+        self.assertEqual(get_cache_stats(name='test'), {'hits': 2, 'misses': 1})
+
+
+class StreamHelpersTest(TestCase):
+    """ Test module for stream_csv and stream_json helper methods """
+
+    @classmethod
+    def setUpTestData(cls):
+        """ Initialise test data """
+        cls.rows = [{'name': 'Luke', 'party': True}, {'name': 'Leia', 'party': False}]
+
+    def test_stream_csv(self):
+        """ Confirm we yield a header line followed by a line per row """
+        lines = list(stream_csv(rows=iter(self.rows), fields=('name', 'party')))
+        self.assertEqual(lines, ['name,party\r\n', 'Luke,True\r\n', 'Leia,False\r\n'])
+
+    def test_stream_json(self):
+        """ Confirm we yield a valid JSON list of the rows """
+        content = ''.join(stream_json(rows=iter(self.rows)))
+        self.assertEqual(json.loads(content), self.rows)
+
+    def test_stream_json_no_rows(self):
+        """ Confirm we yield an empty JSON list if there are no rows """
+        self.assertEqual(''.join(stream_json(rows=iter([]))), '[]')
+
+    def test_stream_zip(self):
+        """ Confirm we yield a valid ZIP64 archive of the files, with a part for each chunk """
+        files = [
+            ('a.jpg', (2024, 6, 1, 12, 0, 0), iter([b'a' * 10, b'b' * 10])),
+            ('b.jpg', (2024, 6, 2, 12, 0, 0), iter([b'c' * 5])),
+        ]
+        parts = list(stream_zip(files=iter(files)))
+        with zipfile.ZipFile(BytesIO(b''.join(parts))) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(), ['a.jpg', 'b.jpg'])
+            self.assertEqual(archive.read('a.jpg'), b'a' * 10 + b'b' * 10)
+            self.assertEqual(archive.read('b.jpg'), b'c' * 5)
+            self.assertEqual(archive.getinfo('b.jpg').date_time, (2024, 6, 2, 12, 0, 0))
+        self.assertGreater(len(parts), len(files))
+
+
+class ParseDatetimeParamHelperTest(TestCase):
+    """ Test module for parse_datetime_param helper method """
+
+    def test_parse_dates_and_datetimes(self):
+        """ Confirm we parse dates as midnight, and return aware datetimes """
+        self.assertEqual(parse_datetime_param('2024-06-01'), timezone.make_aware(datetime(2024, 6, 1)))
+        self.assertEqual(
+            parse_datetime_param('2024-06-01T12:30:00+00:00'), datetime(2024, 6, 1, 12, 30, tzinfo=dt_timezone.utc)
+        )
+        self.assertIsNone(parse_datetime_param(''))
+
+    def test_invalid_value_raises_error(self):
+        """ Confirm we raise a ValueError if the value isn't a date or datetime """
+        for value in ('invalid', '2024-13-01'):
+            with self.assertRaises(ValueError):
+                parse_datetime_param(value)
+
+
+class CursorHelpersTest(TestCase):
+    """ Test module for encode_cursor and decode_cursor helper methods """
+
+    def test_encode_decode_cursor(self):
+        """ Confirm we decode the values encoded in a cursor """
+        values = ['next', '2025-01-18T01:02:03.456789+00:00', 5]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+
+    def test_decode_cursor_invalid_raises_error(self):
+        """ Confirm we raise a ValueError if the cursor is invalid """
+        with self.assertRaises(ValueError):
+            decode_cursor('invalid')
+
+
+class NormalizeImageHelperTest(TestCase):
+    """ Test module for normalize_image helper method """
+
+    @staticmethod
+    def create_image(size, image_format='JPEG', orientation=None, frames=1):
+        """ Create an image file, with an EXIF orientation and GPS tag if specified """
+        buffer = BytesIO()
+        images = [Image.new('RGB', size, color=(index * 50, 0, 0)) for index in range(frames)]
+        exif = Image.Exif()
+        if orientation:
+            exif[0x0112] = orientation
+            exif[0x8825] = {1: 'N'}
+        options = {'save_all': True, 'append_images': images[1:]} if frames > 1 else {}
+        images[0].save(buffer, format=image_format, exif=exif, **options)
+        return ContentFile(buffer.getvalue())
+
+    def test_normalize_image_caps_longest_edge(self):
+        """ Confirm we cap the image's longest edge at max_dimension, keeping the aspect ratio """
+        normalized_file = normalize_image(self.create_image((3000, 1500)), max_dimension=1000, quality=80)
+        self.assertEqual(Image.open(normalized_file).size, (1000, 500))
+
+    def test_normalize_image_applies_orientation_and_strips_metadata(self):
+        """ Confirm we rotate the image by its EXIF orientation, and don't keep the EXIF data """
+        normalized_file = normalize_image(self.create_image((300, 100), orientation=6), max_dimension=1000, quality=80)
+        image = Image.open(normalized_file)
+        self.assertEqual(image.size, (100, 300))
+        self.assertEqual(dict(image.getexif()), {})
+
+    def test_normalize_image_keeps_format(self):
+        """ Confirm we re-encode the image in its original format """
+        normalized_file = normalize_image(self.create_image((100, 100), 'PNG'), max_dimension=1000, quality=80)
+        self.assertEqual(Image.open(normalized_file).format, 'PNG')
+
+    def test_normalize_image_animated_image_returns_none(self):
+        """ Confirm we don't re-encode animated images, so they keep their animation """
+        image_file = self.create_image((100, 100), 'GIF', frames=2)
+        self.assertIsNone(normalize_image(image_file, max_dimension=1000, quality=80))
+
+    def test_normalize_image_invalid_image_raises_error(self):
+        """ Confirm we raise an OSError if the file isn't an image """
+        with self.assertRaises(OSError):
+            normalize_image(ContentFile(b'invalid'), max_dimension=1000, quality=80)
+
+
+class RateLimitHelperTest(TestCase):
+    """ Test module for take_rate_limit_tokens helper method """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_take_rate_limit_tokens_within_capacity_returns_zero(self):
+        """ Confirm we take tokens until the bucket is empty """
+        self.assertEqual(take_rate_limit_tokens('test', tokens=3, rate=1, capacity=5), 0)
+        self.assertEqual(take_rate_limit_tokens('test', tokens=2, rate=1, capacity=5), 0)
+
+    def test_take_rate_limit_tokens_over_capacity_returns_wait(self):
+        """ Confirm we return the seconds until the tokens can be taken, and don't take them, once it's empty """
+        take_rate_limit_tokens('test', tokens=5, rate=0.5, capacity=5)
+        wait = take_rate_limit_tokens('test', tokens=2, rate=0.5, capacity=5)
+        self.assertGreater(wait, 3.9)
+        self.assertLessEqual(wait, 4)
+        self.assertGreater(take_rate_limit_tokens('test', tokens=1, rate=0.5, capacity=5), 0)
+
+    def test_take_rate_limit_tokens_over_bucket_capacity_returns_none(self):
+        """ Confirm we return None, and don't take any tokens, if there are more tokens than the bucket holds """
+        self.assertIsNone(take_rate_limit_tokens('test', tokens=6, rate=1, capacity=5))
+        self.assertEqual(take_rate_limit_tokens('test', tokens=5, rate=1, capacity=5), 0)
+
+    def test_take_rate_limit_tokens_separate_keys(self):
+        """ Confirm each key has its own bucket """
+        take_rate_limit_tokens('test', tokens=5, rate=1, capacity=5)
+        self.assertEqual(take_rate_limit_tokens('other', tokens=5, rate=1, capacity=5), 0)
+
+
+class Base64DecodedSizeHelperTest(TestCase):
+    """ Test module for get_base_64_decoded_size helper method """
+
+    def test_get_base_64_decoded_size(self):
+        """ Confirm we return the decoded size of base 64 strings and data URIs, with and without padding """
+        for content in (b'a', b'ab', b'abc', b'abcd' * 100):
+            encoded = base64.b64encode(content).decode()
+            self.assertEqual(get_base_64_decoded_size(encoded), len(content))
+            self.assertEqual(get_base_64_decoded_size(f'data:image/gif;base64,{encoded}'), len(content))